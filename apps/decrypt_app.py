@@ -1,46 +1,268 @@
+import codecs
 import json
 import logging
+import os
 import sys
+import threading
 from pathlib import Path
 
-import pyperclip
+if getattr(sys, "frozen", False) and hasattr(sys, "_MEIPASS"):
+    sys.path.append(sys._MEIPASS)
+else:
+    sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.startup_profile import StartupProfiler
+
+PROFILER = StartupProfiler.from_argv(sys.argv)
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+from PyQt5.QtGui import QFontDatabase, QTextCursor
 from PyQt5.QtWidgets import (
     QApplication,
     QFileDialog,
+    QInputDialog,
     QLabel,
     QLineEdit,
     QMessageBox,
+    QPlainTextEdit,
+    QProgressBar,
     QPushButton,
     QTextEdit,
     QVBoxLayout,
     QWidget,
 )
 
-if getattr(sys, "frozen", False) and hasattr(sys, "_MEIPASS"):
-    sys.path.append(sys._MEIPASS)
-else:
-    sys.path.append(str(Path(__file__).resolve().parents[1]))
+from cryptography.fernet import InvalidToken
 
 from src.crypto_utils import (
-    KeyPackage,
+    OperationCancelled,
     decrypt_bytes,
-    decrypt_text,
+    decrypt_file,
     key_fingerprint,
+    parse_key_package,
     unwrap_key_with_passphrase,
 )
+from src.metrics import configure_logging, export_metrics_at_exit
 
-logging.basicConfig(
-    filename="decrypt_app.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
+PROFILER.checkpoint("module imports")
+
+COPY_LIMIT = 1024 * 1024
+VIEWER_PAGE_SIZE = 64 * 1024
+VIEWER_LIMIT = 16 * 1024 * 1024
+HEX_ROW_SIZE = 16
+
+_HEX_PRINTABLE = bytes(byte if 32 <= byte < 127 else ord(".") for byte in range(256))
+
+configure_logging("decrypt_app.log")
+export_metrics_at_exit()
+
+
+def copy_to_clipboard(text: str) -> None:
+    # pyperclip is only needed when something is copied, so it is imported on first use.
+    import pyperclip
+
+    pyperclip.copy(text)
+
+
+def connect_agent():
+    """A connection to the running key agent, or None when no agent is listening."""
+    # The key agent is optional, so its module is imported on first use.
+    from src.key_agent import KeyAgentClient, KeyAgentError
+
+    try:
+        return KeyAgentClient()
+    except KeyAgentError:
+        return None
+
+
+class UnwrapSignals(QObject):
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+
+class UnwrapJob(QRunnable):
+    """Unwraps a key package off the GUI thread; the KDF can take a second or more."""
+
+    def __init__(self, raw_package: str, passphrase: str, recipient: str | None) -> None:
+        super().__init__()
+        self.raw_package = raw_package
+        self.passphrase = passphrase
+        self.recipient = recipient
+        self.signals = UnwrapSignals()
+
+    def run(self) -> None:
+        try:
+            key_package = parse_key_package(self.raw_package)
+            key = unwrap_key_with_passphrase(key_package, self.passphrase, recipient=self.recipient)
+            self.signals.finished.emit(key)
+        except (json.JSONDecodeError, KeyError, ValueError) as exc:
+            self.signals.failed.emit(f"Invalid key package: {exc}")
+        except InvalidToken:
+            self.signals.failed.emit("Failed to load key: wrong passphrase, or the key package is damaged.")
+        except Exception as exc:  # pragma: no cover - worker safety net
+            self.signals.failed.emit(f"Failed to load key: {exc}")
+
+
+class FileJobSignals(QObject):
+    progress = pyqtSignal(int)
+    finished = pyqtSignal(str, object)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+
+class FileJob(QRunnable):
+    """Decrypts a file off the GUI thread, reporting progress in tenths of a percent.
+
+    With an agent fingerprint instead of a key, the key agent decrypts the
+    file; it reports no progress and cannot be cancelled.
+    """
+
+    def __init__(
+        self, source_path: str, save_path: str, key: bytes | None, agent_fingerprint: str | None = None
+    ) -> None:
+        super().__init__()
+        self.source_path = source_path
+        self.save_path = save_path
+        self.key = key
+        self.agent_fingerprint = agent_fingerprint
+        self.total = max(os.path.getsize(source_path), 1)
+        self.cancel_event = threading.Event()
+        self.signals = FileJobSignals()
+
+    def run(self) -> None:
+        try:
+            if self.agent_fingerprint is not None:
+                from src.key_agent import KeyAgentClient
+
+                with KeyAgentClient() as client:
+                    size = client.decrypt_file(self.agent_fingerprint, self.source_path, self.save_path)
+            else:
+                size = decrypt_file(
+                    self.source_path, self.save_path, self.key, progress=self._report, cancel=self.cancel_event
+                )
+            self.signals.finished.emit(self.save_path, size)
+        except OperationCancelled:
+            self.signals.cancelled.emit()
+        except Exception as exc:  # pragma: no cover - worker safety net
+            self.signals.failed.emit(str(exc))
+
+    def _report(self, done: int) -> None:
+        self.signals.progress.emit(min(1000, done * 1000 // self.total))
+
+
+class PagedViewer(QPlainTextEdit):
+    """Read-only preview of a decrypted payload that loads more pages as it is scrolled.
+
+    Payloads that decode as UTF-8 are shown as text, anything else as a hex
+    dump. Files are read a page at a time from disk and loading stops at
+    VIEWER_LIMIT bytes, so the widget never holds a whole large payload.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.setReadOnly(True)
+        self.is_binary = False
+        self._source: str | bytes | None = None
+        self._size = 0
+        self._offset = 0
+        self._decoder = None
+        self.verticalScrollBar().valueChanged.connect(self._on_scrolled)
+
+    def show_message(self, message: str) -> None:
+        self._source = None
+        self._set_binary(False)
+        self.setPlainText(message)
+
+    def show_file(self, path: str) -> None:
+        with open(path, "rb") as file_handle:
+            head = file_handle.read(VIEWER_PAGE_SIZE)
+        self._start(path, os.path.getsize(path), head)
+
+    def show_bytes(self, payload: bytes) -> None:
+        self._start(payload, len(payload), payload[:VIEWER_PAGE_SIZE])
+
+    def _start(self, source: str | bytes, size: int, head: bytes) -> None:
+        self._source = None
+        self.clear()
+        self._set_binary(_looks_binary(head, final=size <= len(head)))
+        self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self._source = source
+        self._size = size
+        self._offset = 0
+        self._load_page()
+        # Keep loading until the view can scroll, or there is nothing left.
+        while self._source is not None and self.verticalScrollBar().maximum() == 0:
+            self._load_page()
+
+    def _set_binary(self, binary: bool) -> None:
+        self.is_binary = binary
+        if binary:
+            self.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+            self.setLineWrapMode(QPlainTextEdit.NoWrap)
+        else:
+            self.setFont(QFontDatabase.systemFont(QFontDatabase.GeneralFont))
+            self.setLineWrapMode(QPlainTextEdit.WidgetWidth)
+
+    def _on_scrolled(self, value: int) -> None:
+        scroll_bar = self.verticalScrollBar()
+        if self._source is not None and value >= scroll_bar.maximum() - scroll_bar.pageStep():
+            self._load_page()
+
+    def _load_page(self) -> None:
+        data = self._read(self._offset, VIEWER_PAGE_SIZE)
+        start = self._offset
+        self._offset += len(data)
+        finished = self._offset >= self._size
+        if self.is_binary:
+            text = _hex_rows(data, start)
+        else:
+            text = self._decoder.decode(data, final=finished)
+        if not finished and self._offset >= VIEWER_LIMIT:
+            text += f"\n[Preview stops at {VIEWER_LIMIT // (1024 * 1024)} MB; open the saved file to see the rest]"
+            finished = True
+        if finished:
+            self._source = None
+        cursor = QTextCursor(self.document())
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(text)
+
+    def _read(self, offset: int, size: int) -> bytes:
+        if isinstance(self._source, bytes):
+            return self._source[offset : offset + size]
+        with open(self._source, "rb") as file_handle:
+            file_handle.seek(offset)
+            return file_handle.read(size)
+
+
+def _looks_binary(head: bytes, final: bool) -> bool:
+    if b"\x00" in head:
+        return True
+    try:
+        codecs.getincrementaldecoder("utf-8")("strict").decode(head, final=final)
+    except UnicodeDecodeError:
+        return True
+    return False
+
+
+def _hex_rows(data: bytes, offset: int) -> str:
+    rows = []
+    for start in range(0, len(data), HEX_ROW_SIZE):
+        row = data[start : start + HEX_ROW_SIZE]
+        ascii_column = row.translate(_HEX_PRINTABLE).decode("ascii")
+        rows.append(f"{offset + start:08x}  {row.hex(' '):<47}  |{ascii_column}|\n")
+    return "".join(rows)
 
 
 class DecryptApp(QWidget):
     def __init__(self) -> None:
         super().__init__()
         self.key: bytes | None = None
+        self.agent_fingerprint: str | None = None
         self.decrypted_value: str | None = None
+        self.decrypted_payload: bytes | None = None
+        self.file_job: FileJob | None = None
+        self.key_package_panel: QWidget | None = None
+        self.file_panel: QWidget | None = None
         self.init_ui()
 
     def init_ui(self) -> None:
@@ -51,16 +273,14 @@ class DecryptApp(QWidget):
 
         self.key_label = QLabel("Encryption Key (paste or load from package):")
         self.key_entry = QLineEdit()
+        self.key_entry.textEdited.connect(self._on_key_edited)
 
-        self.key_package_label = QLabel("Key Package (JSON):")
-        self.key_package_text = QTextEdit()
+        # Rarely used panels are built the first time they are opened.
+        self.key_package_toggle = QPushButton("Load Key from a Key Package…")
+        self.key_package_toggle.clicked.connect(self.show_key_package_panel)
 
-        self.passphrase_label = QLabel("Passphrase (for key package):")
-        self.passphrase_entry = QLineEdit()
-        self.passphrase_entry.setEchoMode(QLineEdit.Password)
-
-        self.load_key_button = QPushButton("Load Key from Package")
-        self.load_key_button.clicked.connect(self.load_key_from_package)
+        self.agent_key_button = QPushButton("Use a Key Held by the Key Agent…")
+        self.agent_key_button.clicked.connect(self.use_agent_key)
 
         self.fingerprint_label = QLabel("Key Fingerprint:")
         self.fingerprint_value = QLineEdit()
@@ -70,44 +290,103 @@ class DecryptApp(QWidget):
         self.decrypt_button.clicked.connect(self.decrypt_data)
 
         self.decrypted_label = QLabel("Decrypted Data:")
-        self.decrypted_text = QTextEdit()
-        self.decrypted_text.setReadOnly(True)
+        self.decrypted_text = PagedViewer()
 
         self.copy_button = QPushButton("Copy Decrypted Data")
         self.copy_button.clicked.connect(self.copy_decrypted_data)
         self.copy_button.setEnabled(False)
 
-        self.file_label = QLabel("File Decryption:")
-        self.file_path_entry = QLineEdit()
-        self.file_path_entry.setReadOnly(True)
-        self.file_select_button = QPushButton("Select Encrypted File")
-        self.file_select_button.clicked.connect(self.select_file)
-        self.decrypt_file_button = QPushButton("Decrypt File")
-        self.decrypt_file_button.clicked.connect(self.decrypt_file)
+        self.save_button = QPushButton("Save Decrypted Data…")
+        self.save_button.clicked.connect(self.save_decrypted_data)
+        self.save_button.setEnabled(False)
+
+        self.file_toggle = QPushButton("Decrypt a File…")
+        self.file_toggle.clicked.connect(self.show_file_panel)
 
         layout = QVBoxLayout()
         layout.addWidget(self.encrypted_label)
         layout.addWidget(self.encrypted_text)
         layout.addWidget(self.key_label)
         layout.addWidget(self.key_entry)
-        layout.addWidget(self.key_package_label)
-        layout.addWidget(self.key_package_text)
-        layout.addWidget(self.passphrase_label)
-        layout.addWidget(self.passphrase_entry)
-        layout.addWidget(self.load_key_button)
+        layout.addWidget(self.key_package_toggle)
+        layout.addWidget(self.agent_key_button)
         layout.addWidget(self.fingerprint_label)
         layout.addWidget(self.fingerprint_value)
         layout.addWidget(self.decrypt_button)
         layout.addWidget(self.decrypted_label)
         layout.addWidget(self.decrypted_text)
         layout.addWidget(self.copy_button)
-        layout.addWidget(self.file_label)
-        layout.addWidget(self.file_path_entry)
-        layout.addWidget(self.file_select_button)
-        layout.addWidget(self.decrypt_file_button)
+        layout.addWidget(self.save_button)
+        layout.addWidget(self.file_toggle)
 
         self.setLayout(layout)
 
+    def show_key_package_panel(self) -> None:
+        if self.key_package_panel is None:
+            self.key_package_label = QLabel("Key Package (JSON):")
+            self.key_package_text = QTextEdit()
+
+            self.passphrase_label = QLabel("Passphrase (for key package):")
+            self.passphrase_entry = QLineEdit()
+            self.passphrase_entry.setEchoMode(QLineEdit.Password)
+
+            self.recipient_label = QLabel("Your Name (for packages shared with several recipients):")
+            self.recipient_entry = QLineEdit()
+
+            self.load_key_button = QPushButton("Load Key from Package")
+            self.load_key_button.clicked.connect(self.load_key_from_package)
+
+            self.key_package_panel = self._insert_panel(
+                self.key_package_toggle,
+                self.key_package_label,
+                self.key_package_text,
+                self.passphrase_label,
+                self.passphrase_entry,
+                self.recipient_label,
+                self.recipient_entry,
+                self.load_key_button,
+            )
+        self.key_package_toggle.hide()
+        self.key_package_text.setFocus()
+
+    def show_file_panel(self) -> None:
+        if self.file_panel is None:
+            self.file_label = QLabel("File Decryption:")
+            self.file_path_entry = QLineEdit()
+            self.file_path_entry.setReadOnly(True)
+            self.file_select_button = QPushButton("Select Encrypted File")
+            self.file_select_button.clicked.connect(self.select_file)
+            self.decrypt_file_button = QPushButton("Decrypt File")
+            self.decrypt_file_button.clicked.connect(self.decrypt_file)
+            self.file_progress = QProgressBar()
+            self.file_progress.setRange(0, 1000)
+            self.file_progress.setTextVisible(False)
+            self.cancel_file_button = QPushButton("Cancel")
+            self.cancel_file_button.clicked.connect(self.cancel_file_operation)
+            self.cancel_file_button.setEnabled(False)
+
+            self.file_panel = self._insert_panel(
+                self.file_toggle,
+                self.file_label,
+                self.file_path_entry,
+                self.file_select_button,
+                self.decrypt_file_button,
+                self.file_progress,
+                self.cancel_file_button,
+            )
+        self.file_toggle.hide()
+
+    def _insert_panel(self, toggle: QPushButton, *widgets: QWidget) -> QWidget:
+        panel = QWidget()
+        panel_layout = QVBoxLayout()
+        panel_layout.setContentsMargins(0, 0, 0, 0)
+        for widget in widgets:
+            panel_layout.addWidget(widget)
+        panel.setLayout(panel_layout)
+        layout = self.layout()
+        layout.insertWidget(layout.indexOf(toggle) + 1, panel)
+        return panel
+
     def load_key_from_package(self) -> None:
         raw_package = self.key_package_text.toPlainText().strip()
         passphrase = self.passphrase_entry.text().strip()
@@ -120,19 +399,89 @@ class DecryptApp(QWidget):
             logging.error("No passphrase provided for key package.")
             return
 
-        try:
-            key_package = KeyPackage.from_json(raw_package)
-            self.key = unwrap_key_with_passphrase(key_package, passphrase)
-            self.key_entry.setText(self.key.decode())
-            self.fingerprint_value.setText(key_fingerprint(self.key))
+        job = UnwrapJob(raw_package, passphrase, self.recipient_entry.text().strip() or None)
+        job.signals.finished.connect(self._on_key_unwrapped)
+        job.signals.failed.connect(self._on_unwrap_failed)
+        self.load_key_button.setEnabled(False)
+        self.load_key_button.setText("Unwrapping Key…")
+        QThreadPool.globalInstance().start(job)
+
+    def _on_key_unwrapped(self, key: bytes) -> None:
+        self._reset_load_key_button()
+        self._use_key(key)
+        logging.info("Key loaded from package.")
+        agent = connect_agent()
+        if agent is None:
             QMessageBox.information(self, "Loaded", "Key loaded from package successfully.")
-            logging.info("Key loaded from package.")
-        except (json.JSONDecodeError, KeyError, ValueError) as exc:
-            QMessageBox.critical(self, "Error", f"Invalid key package: {exc}")
-            logging.error("Invalid key package: %s", exc)
+            return
+        with agent:
+            answer = QMessageBox.question(
+                self,
+                "Loaded",
+                "Key loaded from package successfully. Also add it to the running key agent, so later sessions "
+                "and scripts can use it without the passphrase?",
+            )
+            if answer != QMessageBox.Yes:
+                return
+            try:
+                agent.add_key(key)
+                logging.info("Key added to the key agent.")
+            except Exception as exc:  # pragma: no cover - GUI safety net
+                QMessageBox.critical(self, "Error", f"Could not add the key to the agent: {exc}")
+                logging.error("Could not add key to the agent: %s", exc)
+
+    def _on_unwrap_failed(self, message: str) -> None:
+        self._reset_load_key_button()
+        QMessageBox.critical(self, "Error", message)
+        logging.error("Loading key from package failed: %s", message)
+
+    def _reset_load_key_button(self) -> None:
+        self.load_key_button.setEnabled(True)
+        self.load_key_button.setText("Load Key from Package")
+
+    def use_agent_key(self) -> None:
+        agent = connect_agent()
+        if agent is None:
+            QMessageBox.critical(self, "Error", "No key agent is running. Start one with: python -m src agent")
+            logging.error("No key agent is running.")
+            return
+        try:
+            with agent:
+                fingerprints = [key.fingerprint for key in agent.list_keys()]
         except Exception as exc:  # pragma: no cover - GUI safety net
-            QMessageBox.critical(self, "Error", f"Failed to load key: {exc}")
-            logging.error("Failed to load key: %s", exc)
+            QMessageBox.critical(self, "Error", f"Could not list the agent's keys: {exc}")
+            logging.error("Could not list the agent's keys: %s", exc)
+            return
+        if not fingerprints:
+            QMessageBox.critical(self, "Error", "The key agent holds no keys. Load a key from a package first.")
+            logging.error("The key agent holds no keys.")
+            return
+        fingerprint = fingerprints[0]
+        if len(fingerprints) > 1:
+            fingerprint, chosen = QInputDialog.getItem(self, "Key Agent", "Key fingerprint:", fingerprints, 0, False)
+            if not chosen:
+                return
+        # The key stays in the agent; decryption is sent there by fingerprint.
+        self.key = None
+        self.agent_fingerprint = fingerprint
+        self.key_entry.clear()
+        self.key_entry.setPlaceholderText("Held by the key agent")
+        self.fingerprint_value.setText(fingerprint)
+        logging.info("Using the key agent's key %s.", fingerprint)
+
+    def _use_key(self, key: bytes) -> None:
+        self.key = key
+        self.agent_fingerprint = None
+        self.key_entry.setPlaceholderText("")
+        self.key_entry.setText(key.decode())
+        self.fingerprint_value.setText(key_fingerprint(key))
+
+    def _on_key_edited(self, _text: str) -> None:
+        # A typed key replaces the agent's.
+        if self.agent_fingerprint is not None:
+            self.agent_fingerprint = None
+            self.key_entry.setPlaceholderText("")
+            self.fingerprint_value.clear()
 
     def decrypt_data(self) -> None:
         encrypted_data = self.encrypted_text.toPlainText().strip()
@@ -142,16 +491,23 @@ class DecryptApp(QWidget):
             return
 
         raw_key = self.key_entry.text().strip()
-        if not raw_key:
+        if not raw_key and self.agent_fingerprint is None:
             QMessageBox.critical(self, "Error", "Please provide the encryption key or load it from a package.")
             logging.error("No key provided for decryption.")
             return
 
         try:
-            self.key = raw_key.encode()
-            self.decrypted_value = decrypt_text(encrypted_data, self.key)
-            self.decrypted_text.setText(self.decrypted_value)
-            self.fingerprint_value.setText(key_fingerprint(self.key))
+            if self.agent_fingerprint is not None:
+                agent = connect_agent()
+                if agent is None:
+                    raise ValueError("the key agent is no longer running")
+                with agent:
+                    self.decrypted_payload = agent.decrypt(self.agent_fingerprint, encrypted_data.encode())
+            else:
+                self._use_key(raw_key.encode())
+                self.decrypted_payload = decrypt_bytes(encrypted_data.encode(), self.key)
+            self.decrypted_text.show_bytes(self.decrypted_payload)
+            self.decrypted_value = self._copyable_text(self.decrypted_payload)
             self._update_button_states()
             QMessageBox.information(self, "Success", "Data decrypted successfully.")
             logging.info("Data decrypted successfully.")
@@ -161,15 +517,39 @@ class DecryptApp(QWidget):
 
     def copy_decrypted_data(self) -> None:
         if self.decrypted_value:
-            pyperclip.copy(self.decrypted_value)
+            copy_to_clipboard(self.decrypted_value)
             QMessageBox.information(self, "Copied", "Decrypted data copied to clipboard.")
             logging.info("Decrypted data copied to clipboard.")
         else:
             QMessageBox.critical(self, "Error", "No decrypted data to copy.")
             logging.error("No decrypted data to copy.")
 
+    def save_decrypted_data(self) -> None:
+        if self.decrypted_payload is None:
+            return
+        save_path, _ = QFileDialog.getSaveFileName(self, "Save Decrypted Data")
+        if not save_path:
+            return
+        try:
+            with open(save_path, "wb") as file_handle:
+                file_handle.write(self.decrypted_payload)
+            logging.info("Decrypted data saved: %s", save_path)
+        except OSError as exc:
+            QMessageBox.critical(self, "Error", f"Saving failed: {exc}")
+            logging.error("Saving decrypted data failed: %s", exc)
+
+    def _copyable_text(self, payload: bytes) -> str | None:
+        # Only small text payloads go to the clipboard; the rest are saved to a file.
+        if self.decrypted_text.is_binary or len(payload) > COPY_LIMIT:
+            return None
+        try:
+            return payload.decode("utf-8")
+        except UnicodeDecodeError:
+            return None
+
     def _update_button_states(self) -> None:
         self.copy_button.setEnabled(self.decrypted_value is not None)
+        self.save_button.setEnabled(self.decrypted_payload is not None)
 
     def select_file(self) -> None:
         file_path, _ = QFileDialog.getOpenFileName(self, "Select Encrypted File", "", "Encrypted Files (*.fernet);;All Files (*)")
@@ -184,46 +564,87 @@ class DecryptApp(QWidget):
             return
 
         raw_key = self.key_entry.text().strip()
-        if not raw_key:
+        if not raw_key and self.agent_fingerprint is None:
             QMessageBox.critical(self, "Error", "Please provide the encryption key or load it from a package.")
             logging.error("No key provided for file decryption.")
             return
 
         try:
-            self.key = raw_key.encode()
-            with open(file_path, "rb") as file_handle:
-                encrypted_payload = file_handle.read()
-            decrypted_payload = decrypt_bytes(encrypted_payload, self.key)
+            if self.agent_fingerprint is None:
+                self._use_key(raw_key.encode())
             save_path, _ = QFileDialog.getSaveFileName(self, "Save Decrypted File")
             if not save_path:
                 logging.info("File decryption canceled (no save path selected).")
                 return
-            with open(save_path, "wb") as file_handle:
-                file_handle.write(decrypted_payload)
-
-            # Try to decode as text for display and copy functionality
-            try:
-                self.decrypted_value = decrypted_payload.decode('utf-8')
-                self.decrypted_text.setText(self.decrypted_value)
-            except UnicodeDecodeError:
-                # Binary file - show info message instead
-                self.decrypted_value = None
-                self.decrypted_text.setText("[Binary file decrypted - cannot display as text]")
-
-            self.fingerprint_value.setText(key_fingerprint(self.key))
-            self._update_button_states()
-            QMessageBox.information(self, "Success", "File decrypted and saved successfully.")
-            logging.info("File decrypted successfully: %s", save_path)
+            self.file_job = FileJob(file_path, save_path, self.key, self.agent_fingerprint)
+            self.file_job.signals.progress.connect(self.file_progress.setValue)
+            self.file_job.signals.finished.connect(self._on_file_decrypted)
+            self.file_job.signals.failed.connect(self._on_file_failed)
+            self.file_job.signals.cancelled.connect(self._on_file_cancelled)
+            self._set_file_busy(True, cancellable=self.agent_fingerprint is None)
+            QThreadPool.globalInstance().start(self.file_job)
+            logging.info("File decryption started: %s", file_path)
         except Exception as exc:  # pragma: no cover - GUI safety net
             QMessageBox.critical(self, "Error", f"File decryption failed: {exc}")
             logging.error("File decryption failed: %s", exc)
 
+    def cancel_file_operation(self) -> None:
+        if self.file_job:
+            self.file_job.cancel_event.set()
+            self.cancel_file_button.setEnabled(False)
+
+    def _on_file_decrypted(self, save_path: str, decrypted_size: int) -> None:
+        self._set_file_busy(False)
+        # The output is already on disk; the viewer pages through it from there.
+        self.decrypted_payload = None
+        self.decrypted_value = None
+        try:
+            self.decrypted_text.show_file(save_path)
+            if decrypted_size <= COPY_LIMIT and not self.decrypted_text.is_binary:
+                with open(save_path, "rb") as file_handle:
+                    self.decrypted_value = self._copyable_text(file_handle.read())
+        except OSError as exc:
+            self.decrypted_text.show_message(f"[Decrypted file saved, but it could not be previewed: {exc}]")
+
+        self._update_button_states()
+        QMessageBox.information(self, "Success", "File decrypted and saved successfully.")
+        logging.info("File decrypted successfully: %s", save_path)
+
+    def _on_file_failed(self, message: str) -> None:
+        self._set_file_busy(False)
+        QMessageBox.critical(self, "Error", f"File decryption failed: {message}")
+        logging.error("File decryption failed: %s", message)
+
+    def _on_file_cancelled(self) -> None:
+        self._set_file_busy(False)
+        QMessageBox.information(self, "Canceled", "File decryption canceled.")
+        logging.info("File decryption canceled by user.")
+
+    def _set_file_busy(self, busy: bool, cancellable: bool = True) -> None:
+        if not busy:
+            self.file_job = None
+        # Jobs the key agent runs report no progress, so the bar just shows activity.
+        self.file_progress.setRange(0, 1000 if cancellable or not busy else 0)
+        self.file_progress.setValue(0)
+        self.file_select_button.setEnabled(not busy)
+        self.decrypt_file_button.setEnabled(not busy)
+        self.cancel_file_button.setEnabled(busy and cancellable)
+
+    def closeEvent(self, event) -> None:
+        # Cancel a running file job so its temp output is removed before exit.
+        self.cancel_file_operation()
+        QThreadPool.globalInstance().waitForDone()
+        super().closeEvent(event)
+
 
 if __name__ == "__main__":
     try:
         app = QApplication(sys.argv)
+        PROFILER.checkpoint("QApplication")
         ex = DecryptApp()
+        PROFILER.checkpoint("DecryptApp init")
         ex.show()
+        PROFILER.finish_after_first_frame(app)
         sys.exit(app.exec_())
     except Exception as exc:  # pragma: no cover - GUI safety net
         logging.critical("Unhandled exception: %s", exc)
@@ -1,38 +1,204 @@
+import json
 import logging
+import os
 import sys
+import threading
 from pathlib import Path
 
-import pyperclip
+if getattr(sys, "frozen", False) and hasattr(sys, "_MEIPASS"):
+    sys.path.append(sys._MEIPASS)
+else:
+    sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.startup_profile import StartupProfiler
+
+PROFILER = StartupProfiler.from_argv(sys.argv)
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, QTimer, pyqtSignal
+from PyQt5.QtGui import QTextBlock, QTextDocument
 from PyQt5.QtWidgets import (
     QApplication,
+    QComboBox,
     QFileDialog,
     QLabel,
     QLineEdit,
     QMessageBox,
+    QPlainTextEdit,
+    QProgressBar,
     QPushButton,
     QTextEdit,
     QVBoxLayout,
     QWidget,
 )
 
-if getattr(sys, "frozen", False) and hasattr(sys, "_MEIPASS"):
-    sys.path.append(sys._MEIPASS)
-else:
-    sys.path.append(str(Path(__file__).resolve().parents[1]))
-
 from src.crypto_utils import (
+    DEFAULT_CIPHER,
+    OperationCancelled,
     encrypt_bytes,
-    encrypt_text,
+    encrypt_file,
     generate_key,
     key_fingerprint,
+    wrap_key_for_recipients,
     wrap_key_with_passphrase,
 )
+from src.metrics import configure_logging, export_metrics_at_exit
+
+PROFILER.checkpoint("module imports")
+
+KEY_PACKAGE_DEBOUNCE_MS = 400
+# Above this size data is encrypted to a file instead of the window and clipboard.
+LARGE_PAYLOAD_SIZE = 1024 * 1024
+SOURCE_PREVIEW_SIZE = 64 * 1024
+OUTPUT_PREVIEW_SIZE = 4 * 1024
+CIPHER_LABELS = {
+    "fernet": "Fernet (readable by older versions)",
+    "aes-256-gcm": "AES-256-GCM (fastest, smallest files)",
+    "chacha20-poly1305": "ChaCha20-Poly1305 (fast without AES hardware)",
+}
+
+configure_logging("encrypt_app.log")
+export_metrics_at_exit()
+
+
+def copy_to_clipboard(text: str) -> None:
+    # pyperclip is only needed when something is copied, so it is imported on first use.
+    import pyperclip
+
+    pyperclip.copy(text)
+
+
+def preview_file(path: str, limit: int) -> str:
+    """The start of a file as text, or as hex for binary data, noting how much more there is."""
+    with open(path, "rb") as file_handle:
+        head = file_handle.read(limit)
+    size = os.path.getsize(path)
+    text = head.hex(" ") if b"\x00" in head else head.decode("utf-8", "replace")
+    if size > len(head):
+        text += f"\n… [first {len(head):,} of {size:,} bytes of {path}]"
+    return text
+
+
+class DocumentReader:
+    """read(size) over a text document as UTF-8, with surrounding whitespace stripped as str.strip() does.
+
+    Blocks are encoded as they are read, so the text is never held as one bytes
+    object. A QTextDocument may only be used from one thread at a time, so a
+    background job reads a clone() of the editor's document, not the document itself.
+    """
+
+    def __init__(self, document: QTextDocument) -> None:
+        self.document = document
+        self._pending = bytearray()
+        block = document.firstBlock()
+        while block.isValid() and not block.text().strip():
+            block = block.next()
+        self._block = block
+        if not block.isValid():
+            self.characters = 0
+            return
+        text = block.text()
+        self._head = len(text) - len(text.lstrip())
+        last = document.lastBlock()
+        while not last.text().strip():
+            last = last.previous()
+        kept = last.text().rstrip()
+        self._last = last.blockNumber()
+        self._tail = len(kept)
+        # Characters as Qt counts them (UTF-16 units, newlines between blocks included); never more than UTF-8 bytes.
+        self.characters = last.position() + len(kept.encode("utf-16-le")) // 2 - block.position() - self._head
+
+    def read(self, size: int = -1) -> bytes:
+        while self._block.isValid() and (size < 0 or len(self._pending) < size):
+            text = self._block.text()
+            number = self._block.blockNumber()
+            start, self._head = self._head, 0
+            if number == self._last:
+                self._pending += text[start : self._tail].encode()
+                self._block = QTextBlock()
+            else:
+                self._pending += text[start:].encode() + b"\n"
+                self._block = self._block.next()
+        if size < 0:
+            size = len(self._pending)
+        data = bytes(self._pending[:size])
+        del self._pending[:size]
+        return data
+
+
+class KeyPackageSignals(QObject):
+    finished = pyqtSignal(int, str)
+    failed = pyqtSignal(int, str)
+
+
+class KeyPackageJob(QRunnable):
+    """Wraps the key off the GUI thread; stale generations are skipped or discarded.
+
+    A {recipient: passphrase} dict instead of one passphrase builds a multi-recipient package.
+    """
+
+    def __init__(self, generation: int, key: bytes, passphrase: str | dict[str, str], current_generation) -> None:
+        super().__init__()
+        self.generation = generation
+        self.key = key
+        self.passphrase = passphrase
+        self.current_generation = current_generation
+        self.signals = KeyPackageSignals()
+
+    def run(self) -> None:
+        if self.generation != self.current_generation():
+            return
+        try:
+            if isinstance(self.passphrase, dict):
+                key_package = wrap_key_for_recipients(self.key, self.passphrase)
+            else:
+                key_package = wrap_key_with_passphrase(self.key, self.passphrase)
+            self.signals.finished.emit(self.generation, key_package.to_json())
+        except Exception as exc:  # pragma: no cover - worker safety net
+            self.signals.failed.emit(self.generation, str(exc))
 
-logging.basicConfig(
-    filename="encrypt_app.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
+
+class FileJobSignals(QObject):
+    progress = pyqtSignal(int)
+    finished = pyqtSignal(str, object)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+
+class FileJob(QRunnable):
+    """Encrypts a file, or typed text read through a DocumentReader, off the GUI thread.
+
+    Progress is reported in tenths of a percent; for text it is estimated from the character count.
+    """
+
+    def __init__(self, source: str | DocumentReader, save_path: str, key: bytes, cipher: str = DEFAULT_CIPHER) -> None:
+        super().__init__()
+        self.source = source
+        self.save_path = save_path
+        self.key = key
+        self.cipher = cipher
+        size = os.path.getsize(source) if isinstance(source, str) else source.characters
+        self.total = max(size, 1)
+        self.cancel_event = threading.Event()
+        self.signals = FileJobSignals()
+
+    def run(self) -> None:
+        try:
+            size = encrypt_file(
+                self.source,
+                self.save_path,
+                self.key,
+                progress=self._report,
+                cancel=self.cancel_event,
+                cipher=self.cipher,
+            )
+            self.signals.finished.emit(self.save_path, size)
+        except OperationCancelled:
+            self.signals.cancelled.emit()
+        except Exception as exc:  # pragma: no cover - worker safety net
+            self.signals.failed.emit(str(exc))
+
+    def _report(self, done: int) -> None:
+        self.signals.progress.emit(min(1000, done * 1000 // self.total))
 
 
 class EncryptApp(QWidget):
@@ -41,13 +207,25 @@ class EncryptApp(QWidget):
         self.key: bytes | None = None
         self.encrypted_data: str | None = None
         self.key_package_json: str | None = None
+        self.key_package_generation = 0
+        self.file_job: FileJob | None = None
+        self.source_path: str | None = None
+        self.key_package_panel: QWidget | None = None
+        self.file_panel: QWidget | None = None
         self.init_ui()
 
     def init_ui(self) -> None:
         self.setWindowTitle("Data Encryption")
 
         self.label = QLabel("Enter the data to encrypt:")
-        self.text_edit = QTextEdit()
+        self.text_edit = QPlainTextEdit()
+
+        # Large inputs are read from their file when encrypted, never loaded into the editor whole.
+        self.load_source_button = QPushButton("Load Data from File…")
+        self.load_source_button.clicked.connect(self.load_source_file)
+        self.type_data_button = QPushButton("Type Data Instead")
+        self.type_data_button.clicked.connect(self.clear_source_file)
+        self.type_data_button.hide()
 
         self.encrypt_button = QPushButton("Encrypt")
         self.encrypt_button.clicked.connect(self.encrypt_data)
@@ -64,18 +242,9 @@ class EncryptApp(QWidget):
         self.copy_key_button.clicked.connect(self.copy_key)
         self.copy_key_button.setEnabled(False)
 
-        self.passphrase_label = QLabel("Optional Passphrase (protects key package):")
-        self.passphrase_entry = QLineEdit()
-        self.passphrase_entry.setEchoMode(QLineEdit.Password)
-        self.passphrase_entry.textChanged.connect(self._update_key_package)
-
-        self.key_package_label = QLabel("Key Package (JSON for passphrase unlock):")
-        self.key_package_text = QTextEdit()
-        self.key_package_text.setReadOnly(True)
-
-        self.copy_key_package_button = QPushButton("Copy Key Package")
-        self.copy_key_package_button.clicked.connect(self.copy_key_package)
-        self.copy_key_package_button.setEnabled(False)
+        # Rarely used panels are built the first time they are opened.
+        self.key_package_toggle = QPushButton("Protect Key with a Passphrase…")
+        self.key_package_toggle.clicked.connect(self.show_key_package_panel)
 
         self.encrypted_data_label = QLabel("Encrypted Data:")
         self.encrypted_data_text = QTextEdit()
@@ -85,53 +254,165 @@ class EncryptApp(QWidget):
         self.copy_data_button.clicked.connect(self.copy_data)
         self.copy_data_button.setEnabled(False)
 
-        self.file_label = QLabel("File Encryption:")
-        self.file_path_entry = QLineEdit()
-        self.file_path_entry.setReadOnly(True)
-        self.file_select_button = QPushButton("Select File")
-        self.file_select_button.clicked.connect(self.select_file)
-        self.encrypt_file_button = QPushButton("Encrypt File")
-        self.encrypt_file_button.clicked.connect(self.encrypt_file)
+        self.file_toggle = QPushButton("Encrypt a File…")
+        self.file_toggle.clicked.connect(self.show_file_panel)
 
         layout = QVBoxLayout()
         layout.addWidget(self.label)
         layout.addWidget(self.text_edit)
+        layout.addWidget(self.load_source_button)
+        layout.addWidget(self.type_data_button)
         layout.addWidget(self.encrypt_button)
         layout.addWidget(self.key_label)
         layout.addWidget(self.key_entry)
         layout.addWidget(self.key_fingerprint_label)
         layout.addWidget(self.key_fingerprint_value)
         layout.addWidget(self.copy_key_button)
-        layout.addWidget(self.passphrase_label)
-        layout.addWidget(self.passphrase_entry)
-        layout.addWidget(self.key_package_label)
-        layout.addWidget(self.key_package_text)
-        layout.addWidget(self.copy_key_package_button)
+        layout.addWidget(self.key_package_toggle)
         layout.addWidget(self.encrypted_data_label)
         layout.addWidget(self.encrypted_data_text)
         layout.addWidget(self.copy_data_button)
-        layout.addWidget(self.file_label)
-        layout.addWidget(self.file_path_entry)
-        layout.addWidget(self.file_select_button)
-        layout.addWidget(self.encrypt_file_button)
+        layout.addWidget(self.file_toggle)
 
         self.setLayout(layout)
 
+    def show_key_package_panel(self) -> None:
+        if self.key_package_panel is None:
+            self.passphrase_label = QLabel("Optional Passphrase (protects key package):")
+            self.passphrase_entry = QLineEdit()
+            self.passphrase_entry.setEchoMode(QLineEdit.Password)
+            self.passphrase_entry.textChanged.connect(self._on_passphrase_changed)
+
+            self.key_package_timer = QTimer(self)
+            self.key_package_timer.setSingleShot(True)
+            self.key_package_timer.setInterval(KEY_PACKAGE_DEBOUNCE_MS)
+            self.key_package_timer.timeout.connect(self._start_key_package_job)
+
+            self.key_package_label = QLabel("Key Package (JSON for passphrase unlock):")
+            self.key_package_text = QTextEdit()
+            self.key_package_text.setReadOnly(True)
+
+            self.copy_key_package_button = QPushButton("Copy Key Package")
+            self.copy_key_package_button.clicked.connect(self.copy_key_package)
+            self.copy_key_package_button.setEnabled(False)
+
+            self.recipients_button = QPushButton("Wrap for a Recipients File…")
+            self.recipients_button.setToolTip(
+                'JSON file of {"recipient name": "passphrase", ...}: one package every recipient can open.'
+            )
+            self.recipients_button.clicked.connect(self.wrap_for_recipients)
+
+            self.key_package_panel = self._insert_panel(
+                self.key_package_toggle,
+                self.passphrase_label,
+                self.passphrase_entry,
+                self.key_package_label,
+                self.key_package_text,
+                self.copy_key_package_button,
+                self.recipients_button,
+            )
+        self.key_package_toggle.hide()
+        self.passphrase_entry.setFocus()
+
+    def show_file_panel(self) -> None:
+        if self.file_panel is None:
+            self.file_label = QLabel("File Encryption:")
+            self.file_path_entry = QLineEdit()
+            self.file_path_entry.setReadOnly(True)
+            self.file_select_button = QPushButton("Select File")
+            self.file_select_button.clicked.connect(self.select_file)
+            self.cipher_combo = QComboBox()
+            for cipher, label in CIPHER_LABELS.items():
+                self.cipher_combo.addItem(label, cipher)
+            self.encrypt_file_button = QPushButton("Encrypt File")
+            self.encrypt_file_button.clicked.connect(self.encrypt_file)
+            self.file_progress = QProgressBar()
+            self.file_progress.setRange(0, 1000)
+            self.file_progress.setTextVisible(False)
+            self.cancel_file_button = QPushButton("Cancel")
+            self.cancel_file_button.clicked.connect(self.cancel_file_operation)
+            self.cancel_file_button.setEnabled(False)
+
+            self.file_panel = self._insert_panel(
+                self.file_toggle,
+                self.file_label,
+                self.file_path_entry,
+                self.file_select_button,
+                self.cipher_combo,
+                self.encrypt_file_button,
+                self.file_progress,
+                self.cancel_file_button,
+            )
+        self.file_toggle.hide()
+
+    def _insert_panel(self, toggle: QPushButton, *widgets: QWidget) -> QWidget:
+        panel = QWidget()
+        panel_layout = QVBoxLayout()
+        panel_layout.setContentsMargins(0, 0, 0, 0)
+        for widget in widgets:
+            panel_layout.addWidget(widget)
+        panel.setLayout(panel_layout)
+        layout = self.layout()
+        layout.insertWidget(layout.indexOf(toggle) + 1, panel)
+        return panel
+
+    def load_source_file(self) -> None:
+        path, _ = QFileDialog.getOpenFileName(self, "Select Data to Encrypt")
+        if not path:
+            return
+        try:
+            if os.path.getsize(path) <= LARGE_PAYLOAD_SIZE:
+                with open(path, "rb") as file_handle:
+                    raw = file_handle.read()
+                try:
+                    text = raw.decode("utf-8")
+                except UnicodeDecodeError:
+                    text = None  # Binary data cannot be edited, so it is encrypted from its file like a large one.
+                if text is not None:
+                    self.text_edit.setPlainText(text)
+                    self.clear_source_file(keep_text=True)
+                    logging.info("Data loaded from %s.", path)
+                    return
+            preview = preview_file(path, SOURCE_PREVIEW_SIZE)
+        except OSError as exc:
+            QMessageBox.critical(self, "Error", f"Could not load the file: {exc}")
+            logging.error("Could not load data file: %s", exc)
+            return
+        self.source_path = path
+        self.text_edit.setPlainText(preview)
+        self.text_edit.setReadOnly(True)
+        self.type_data_button.show()
+        logging.info("Data file selected: %s", path)
+
+    def clear_source_file(self, keep_text: bool = False) -> None:
+        self.source_path = None
+        self.text_edit.setReadOnly(False)
+        if not keep_text:
+            self.text_edit.clear()
+        self.type_data_button.hide()
+
     def encrypt_data(self) -> None:
-        data = self.text_edit.toPlainText().strip()
-        if not data:
+        if self.source_path is not None:
+            self._encrypt_in_background(self.source_path)
+            return
+        # Typed text is stripped and encoded the same way whichever path it takes. It goes to a file once it
+        # is over LARGE_PAYLOAD_SIZE bytes as UTF-8. That is certain from the character count alone for
+        # long text, so only text short enough to hold in memory is encoded here to measure it.
+        reader = DocumentReader(self.text_edit.document())
+        if not reader.characters:
             QMessageBox.critical(self, "Error", "Please enter some data to encrypt.")
             logging.error("No data entered for encryption.")
             return
+        payload = reader.read() if reader.characters <= LARGE_PAYLOAD_SIZE else None
+        if payload is None or len(payload) > LARGE_PAYLOAD_SIZE:
+            del payload
+            self._encrypt_in_background()
+            return
 
         try:
-            self.key = generate_key()
-            self.encrypted_data = encrypt_text(data, self.key)
-            self.key_entry.setText(self.key.decode())
-            self.key_fingerprint_value.setText(key_fingerprint(self.key))
+            self._set_key(generate_key())
+            self.encrypted_data = encrypt_bytes(payload, self.key).decode()
             self.encrypted_data_text.setText(self.encrypted_data)
-
-            self._update_key_package()
             self._update_button_states()
 
             QMessageBox.information(
@@ -139,14 +420,47 @@ class EncryptApp(QWidget):
                 "Success",
                 "Data encrypted successfully. Share the key separately or use the key package with a passphrase.",
             )
-            logging.info("Data encrypted successfully.")
+            logging.info("Data encrypted successfully (%d bytes).", len(payload))
         except Exception as exc:  # pragma: no cover - GUI safety net
             QMessageBox.critical(self, "Error", f"Encryption failed: {exc}")
             logging.error("Encryption failed: %s", exc)
 
+    def _encrypt_in_background(self, source_path: str | None = None) -> None:
+        # Loaded files and typed data too large for the window are streamed into a chunked container
+        # in the background, exactly as the file panel does, so memory use stays flat and the output
+        # only appears once complete. Without a source path the job reads a snapshot of the editor's
+        # text, encoding it a block at a time, so the editor stays usable meanwhile.
+        if self.file_job is not None:
+            QMessageBox.critical(self, "Error", "Wait for the current file to finish encrypting.")
+            return
+        suggested = "encrypted.fernet" if source_path is None else f"{source_path}.fernet"
+        save_path = self._ask_save_path("Save Encrypted Data", suggested)
+        if not save_path:
+            logging.info("Encryption canceled (no save path selected for large data).")
+            return
+        self._set_key(generate_key())
+        self.show_file_panel()
+        if source_path is None:
+            self.file_path_entry.clear()
+            self._start_file_job(DocumentReader(self.text_edit.document().clone()), save_path)
+        else:
+            self.file_path_entry.setText(source_path)
+            self._start_file_job(source_path, save_path)
+
+    def _set_key(self, key: bytes) -> None:
+        self.key = key
+        self.key_entry.setText(key.decode())
+        self.key_fingerprint_value.setText(key_fingerprint(key))
+        self._update_key_package()
+        self._update_button_states()
+
+    def _ask_save_path(self, title: str, suggested: str) -> str:
+        save_path, _ = QFileDialog.getSaveFileName(self, title, suggested, "Encrypted Files (*.fernet);;All Files (*)")
+        return save_path
+
     def copy_key(self) -> None:
         if self.key:
-            pyperclip.copy(self.key.decode())
+            copy_to_clipboard(self.key.decode())
             QMessageBox.information(self, "Copied", "Encryption key copied to clipboard.")
             logging.info("Encryption key copied to clipboard.")
         else:
@@ -155,7 +469,7 @@ class EncryptApp(QWidget):
 
     def copy_key_package(self) -> None:
         if self.key_package_json:
-            pyperclip.copy(self.key_package_json)
+            copy_to_clipboard(self.key_package_json)
             QMessageBox.information(self, "Copied", "Key package copied to clipboard.")
             logging.info("Key package copied to clipboard.")
         else:
@@ -164,27 +478,93 @@ class EncryptApp(QWidget):
 
     def copy_data(self) -> None:
         if self.encrypted_data:
-            pyperclip.copy(self.encrypted_data)
+            copy_to_clipboard(self.encrypted_data)
             QMessageBox.information(self, "Copied", "Encrypted data copied to clipboard.")
             logging.info("Encrypted data copied to clipboard.")
         else:
             QMessageBox.critical(self, "Error", "No encrypted data to copy.")
             logging.error("No encrypted data to copy.")
 
-    def _update_key_package(self) -> None:
+    def _on_passphrase_changed(self, _text: str) -> None:
+        self._update_key_package(debounce=True)
+
+    def _update_key_package(self, debounce: bool = False) -> None:
+        # Any change invalidates in-flight derivations; only the newest generation is shown.
+        self.key_package_generation += 1
+        self.key_package_json = None
+        if self.key_package_panel is None:
+            self._update_button_states()
+            return
         passphrase = self.passphrase_entry.text().strip()
         if passphrase and self.key:
-            key_package = wrap_key_with_passphrase(self.key, passphrase)
-            self.key_package_json = key_package.to_json()
-            self.key_package_text.setText(self.key_package_json)
+            self.key_package_text.setText("Deriving key package…")
+            if debounce:
+                self.key_package_timer.start()
+            else:
+                self.key_package_timer.stop()
+                self._start_key_package_job()
         else:
-            self.key_package_json = None
+            self.key_package_timer.stop()
             self.key_package_text.clear()
         self._update_button_states()
 
+    def wrap_for_recipients(self) -> None:
+        if not self.key:
+            QMessageBox.critical(self, "Error", "Encrypt some data or a file first, so there is a key to wrap.")
+            logging.error("No key to wrap for recipients.")
+            return
+        path, _ = QFileDialog.getOpenFileName(self, "Select Recipients File", "", "JSON files (*.json);;All files (*)")
+        if not path:
+            return
+        try:
+            with open(path, encoding="utf-8") as file_handle:
+                passphrases = json.load(file_handle)
+            if not isinstance(passphrases, dict) or not all(isinstance(value, str) for value in passphrases.values()):
+                raise ValueError("expected a JSON object of recipient names to passphrases")
+        except (OSError, ValueError) as exc:
+            QMessageBox.critical(self, "Error", f"Could not read the recipients file: {exc}")
+            logging.error("Could not read recipients file: %s", exc)
+            return
+        self.key_package_generation += 1
+        self.key_package_json = None
+        self.key_package_timer.stop()
+        self.key_package_text.setText(f"Deriving key package for {len(passphrases)} recipients…")
+        self._update_button_states()
+        job = KeyPackageJob(self.key_package_generation, self.key, passphrases, lambda: self.key_package_generation)
+        job.signals.finished.connect(self._on_key_package_ready)
+        job.signals.failed.connect(self._on_key_package_failed)
+        QThreadPool.globalInstance().start(job)
+        logging.info("Wrapping key for %d recipients.", len(passphrases))
+
+    def _start_key_package_job(self) -> None:
+        passphrase = self.passphrase_entry.text().strip()
+        if not (passphrase and self.key):
+            return
+        job = KeyPackageJob(self.key_package_generation, self.key, passphrase, lambda: self.key_package_generation)
+        job.signals.finished.connect(self._on_key_package_ready)
+        job.signals.failed.connect(self._on_key_package_failed)
+        QThreadPool.globalInstance().start(job)
+
+    def _on_key_package_ready(self, generation: int, key_package_json: str) -> None:
+        if generation != self.key_package_generation:
+            return
+        self.key_package_json = key_package_json
+        self.key_package_text.setText(key_package_json)
+        self._update_button_states()
+        logging.info("Key package derived.")
+
+    def _on_key_package_failed(self, generation: int, message: str) -> None:
+        if generation != self.key_package_generation:
+            return
+        self.key_package_text.clear()
+        self._update_button_states()
+        QMessageBox.critical(self, "Error", f"Key package derivation failed: {message}")
+        logging.error("Key package derivation failed: %s", message)
+
     def _update_button_states(self) -> None:
         self.copy_key_button.setEnabled(self.key is not None)
-        self.copy_key_package_button.setEnabled(self.key_package_json is not None)
+        if self.key_package_panel is not None:
+            self.copy_key_package_button.setEnabled(self.key_package_json is not None)
         self.copy_data_button.setEnabled(self.encrypted_data is not None)
 
     def select_file(self) -> None:
@@ -199,39 +579,74 @@ class EncryptApp(QWidget):
             logging.error("No file selected for encryption.")
             return
 
+        if not self.key:
+            self._set_key(generate_key())
+        save_path = self._ask_save_path("Save Encrypted File", f"{file_path}.fernet")
+        if not save_path:
+            logging.info("File encryption canceled (no save path selected).")
+            return
+        self._start_file_job(file_path, save_path)
+
+    def _start_file_job(self, source: str | DocumentReader, save_path: str) -> None:
         try:
-            if not self.key:
-                self.key = generate_key()
-                self.key_entry.setText(self.key.decode())
-                self.key_fingerprint_value.setText(key_fingerprint(self.key))
-                self._update_key_package()
-                self._update_button_states()
-            with open(file_path, "rb") as file_handle:
-                payload = file_handle.read()
-            encrypted_payload = encrypt_bytes(payload, self.key)
-            save_path, _ = QFileDialog.getSaveFileName(
-                self,
-                "Save Encrypted File",
-                f"{file_path}.fernet",
-                "Encrypted Files (*.fernet);;All Files (*)",
-            )
-            if not save_path:
-                logging.info("File encryption canceled (no save path selected).")
-                return
-            with open(save_path, "wb") as file_handle:
-                file_handle.write(encrypted_payload)
-            QMessageBox.information(self, "Success", "File encrypted and saved successfully.")
-            logging.info("File encrypted successfully: %s", save_path)
+            self.file_job = FileJob(source, save_path, self.key, self.cipher_combo.currentData())
+            self.file_job.signals.progress.connect(self.file_progress.setValue)
+            self.file_job.signals.finished.connect(self._on_file_encrypted)
+            self.file_job.signals.failed.connect(self._on_file_failed)
+            self.file_job.signals.cancelled.connect(self._on_file_cancelled)
+            self._set_file_busy(True)
+            QThreadPool.globalInstance().start(self.file_job)
+            logging.info("File encryption started: %s", source if isinstance(source, str) else "typed data")
         except Exception as exc:  # pragma: no cover - GUI safety net
             QMessageBox.critical(self, "Error", f"File encryption failed: {exc}")
             logging.error("File encryption failed: %s", exc)
 
+    def cancel_file_operation(self) -> None:
+        if self.file_job:
+            self.file_job.cancel_event.set()
+            self.cancel_file_button.setEnabled(False)
+
+    def _on_file_encrypted(self, save_path: str, size: int) -> None:
+        self._set_file_busy(False)
+        self.encrypted_data = None
+        self.encrypted_data_text.setPlainText(preview_file(save_path, OUTPUT_PREVIEW_SIZE))
+        self._update_button_states()
+        QMessageBox.information(self, "Success", "File encrypted and saved successfully.")
+        logging.info("File encrypted successfully: %s (%d bytes)", save_path, size)
+
+    def _on_file_failed(self, message: str) -> None:
+        self._set_file_busy(False)
+        QMessageBox.critical(self, "Error", f"File encryption failed: {message}")
+        logging.error("File encryption failed: %s", message)
+
+    def _on_file_cancelled(self) -> None:
+        self._set_file_busy(False)
+        QMessageBox.information(self, "Canceled", "File encryption canceled.")
+        logging.info("File encryption canceled by user.")
+
+    def _set_file_busy(self, busy: bool) -> None:
+        if not busy:
+            self.file_job = None
+        self.file_progress.setValue(0)
+        self.file_select_button.setEnabled(not busy)
+        self.encrypt_file_button.setEnabled(not busy)
+        self.cancel_file_button.setEnabled(busy)
+
+    def closeEvent(self, event) -> None:
+        # Cancel a running file job so its temp output is removed before exit.
+        self.cancel_file_operation()
+        QThreadPool.globalInstance().waitForDone()
+        super().closeEvent(event)
+
 
 if __name__ == "__main__":
     try:
         app = QApplication(sys.argv)
+        PROFILER.checkpoint("QApplication")
         ex = EncryptApp()
+        PROFILER.checkpoint("EncryptApp init")
         ex.show()
+        PROFILER.finish_after_first_frame(app)
         sys.exit(app.exec_())
     except Exception as exc:  # pragma: no cover - GUI safety net
         logging.critical("Unhandled exception: %s", exc)
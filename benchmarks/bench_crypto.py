@@ -0,0 +1,309 @@
+"""Benchmark and regression check for the crypto hot paths.
+
+    python benchmarks/bench_crypto.py --output results.json
+    python benchmarks/bench_crypto.py --baseline baseline.json --threshold 0.2
+
+It also checks that content-defined chunking (src/incremental.py) keeps a
+one-byte insert into structured data local, failing the run otherwise.
+
+Each case runs in a fresh process, and its RSS is measured from the end of
+its setup, so fixtures (payloads, tokens) are not counted as the
+operation's memory. Results are written as JSON; with --baseline the run
+fails (exit 1) when a case's median latency or RSS increase regresses
+beyond the threshold.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.crypto_utils import (  # noqa: E402
+    decrypt_bytes,
+    decrypt_stream,
+    decrypt_text,
+    encrypt_bytes,
+    encrypt_stream,
+    encrypt_text,
+    generate_key,
+    key_fingerprint,
+    unwrap_key_with_passphrase,
+    wrap_key_with_passphrase,
+)
+from src.incremental import _cdc_chunks, _cdc_table  # noqa: E402
+
+PAYLOAD_SIZES = (100, 10_000, 1_000_000, 100_000_000, 1_000_000_000)
+KDF_ITERATIONS = (10_000, 100_000, 200_000)
+PAYLOAD_KINDS = ("encrypt_text", "decrypt_text", "encrypt_bytes", "decrypt_bytes", "encrypt_stream", "decrypt_stream")
+KDF_KINDS = ("wrap_key", "unwrap_key")
+CDC_CHECK_KEYS = 8
+CDC_CHECK_MAX_CHANGED = 3
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", help="Write results JSON here (default: stdout).")
+    parser.add_argument("--baseline", help="Compare against this results JSON and fail on regressions.")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed relative regression (0.2 = 20%%).")
+    parser.add_argument("--max-size", type=int, default=max(PAYLOAD_SIZES), help="Skip payloads larger than this.")
+    parser.add_argument("--min-time", type=float, default=1.0, help="Minimum seconds spent timing each case.")
+    parser.add_argument("--max-runs", type=int, default=1000, help="Upper bound on timed runs per case.")
+    parser.add_argument("--only", help="Run only cases whose name contains this substring.")
+    parser.add_argument("--quick", action="store_true", help="Payloads up to 1 MB, short timing windows.")
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.max_size = min(args.max_size, 1_000_000)
+        args.min_time = min(args.min_time, 0.2)
+
+    cases = [case for case in build_cases(args.max_size) if not args.only or args.only in case_name(case)]
+    results = {}
+    for case in cases:
+        name = case_name(case)
+        results[name] = run_isolated(case, args.min_time, args.max_runs)
+        print(f"{name:<32} {format_result(results[name])}", file=sys.stderr)
+
+    failures = []
+    checks = {}
+    if not args.only or args.only in "cdc_locality":
+        checks["cdc_locality"] = check_cdc_locality()
+        failures += checks["cdc_locality"]["failures"]
+        check = checks["cdc_locality"]
+        status = "FAILED" if failures else "ok"
+        print(
+            f"{'cdc_locality':<32} {status}: a 1-byte insert changed at most {check['max_changed_chunks']} of "
+            f"{check['chunks']} chunks",
+            file=sys.stderr,
+        )
+
+    report = {"meta": environment(), "results": results, "checks": checks}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file_handle:
+            json.dump(report, file_handle, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    regressions = list(failures)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file_handle:
+            baseline = json.load(file_handle)["results"]
+        regressions += compare(results, baseline, args.threshold)
+    for message in regressions:
+        print(f"REGRESSION {message}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+def build_cases(max_size: int) -> list[tuple[str, int]]:
+    cases = [(kind, size) for size in PAYLOAD_SIZES if size <= max_size for kind in PAYLOAD_KINDS]
+    cases += [(kind, iterations) for iterations in KDF_ITERATIONS for kind in KDF_KINDS]
+    cases.append(("key_fingerprint", 0))
+    return cases
+
+
+def case_name(case: tuple[str, int]) -> str:
+    kind, parameter = case
+    if kind in KDF_KINDS:
+        return f"{kind}[{parameter} iter]"
+    if kind == "key_fingerprint":
+        return kind
+    return f"{kind}[{format_size(parameter)}]"
+
+
+def run_isolated(case: tuple[str, int], min_time: float, max_runs: int) -> dict:
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(run_case, case, min_time, max_runs).result()
+
+
+def run_case(case: tuple[str, int], min_time: float, max_runs: int) -> dict:
+    operation, payload_bytes = prepare(*case)
+    setup_rss = start_rss_window()
+    operation()  # Warm-up: imports, cipher cache, allocator.
+    samples = []
+    started = time.perf_counter()
+    while len(samples) < max_runs and (len(samples) < 3 or time.perf_counter() - started < min_time):
+        begin = time.perf_counter()
+        operation()
+        samples.append(time.perf_counter() - begin)
+
+    peak = peak_rss()
+    samples.sort()
+    median = statistics.median(samples)
+    return {
+        "runs": len(samples),
+        "payload_bytes": payload_bytes,
+        "min_s": samples[0],
+        "mean_s": statistics.fmean(samples),
+        "p50_s": median,
+        "p90_s": percentile(samples, 0.90),
+        "p99_s": percentile(samples, 0.99),
+        "throughput_bps": payload_bytes / median if payload_bytes and median else None,
+        "setup_rss_bytes": setup_rss,
+        "peak_rss_bytes": peak,
+        "rss_increase_bytes": max(peak - setup_rss, 0),
+    }
+
+
+def prepare(kind: str, parameter: int):
+    key = generate_key()
+    if kind == "key_fingerprint":
+        return (lambda: key_fingerprint(key)), 0
+    if kind == "wrap_key":
+        return (lambda: wrap_key_with_passphrase(key, "benchmark passphrase", parameter)), 0
+    if kind == "unwrap_key":
+        key_package = wrap_key_with_passphrase(key, "benchmark passphrase", parameter)
+        return (lambda: unwrap_key_with_passphrase(key_package, "benchmark passphrase")), 0
+
+    if kind in ("encrypt_text", "decrypt_text"):
+        # Built at the target size directly: slicing a longer hex string would double setup memory.
+        text = os.urandom(parameter // 2).hex() + ("0" if parameter % 2 else "")
+        if kind == "encrypt_text":
+            return (lambda: encrypt_text(text, key)), parameter
+        token = encrypt_text(text, key)
+        del text
+        return (lambda: decrypt_text(token, key)), parameter
+
+    payload = os.urandom(parameter)
+    if kind == "encrypt_bytes":
+        return (lambda: encrypt_bytes(payload, key)), parameter
+    if kind == "decrypt_bytes":
+        token = encrypt_bytes(payload, key)
+        del payload
+        return (lambda: decrypt_bytes(token, key)), parameter
+    if kind == "encrypt_stream":
+        return (lambda: encrypt_stream(io.BytesIO(payload), _NullSink(), key)), parameter
+    if kind == "decrypt_stream":
+        sink = io.BytesIO()
+        encrypt_stream(io.BytesIO(payload), sink, key)
+        container = sink.getvalue()
+        del payload, sink
+        return (lambda: decrypt_stream(io.BytesIO(container), _NullSink(), key)), parameter
+    raise ValueError(f"Unknown benchmark case: {kind}")
+
+
+def check_cdc_locality() -> dict:
+    """Insert one byte near the start of structured data and count the chunks that change.
+
+    CSV rows and runs of binary counters (as in database pages) are where a
+    weak rolling hash stops finding cut points and every chunk runs to the
+    maximum size, so the whole file changes. Each key gets its own chunk
+    boundaries, so several are tried.
+    """
+    samples = {
+        "csv": b"".join(b"%08d,foo,bar,baz,%d\n" % (row, row * 7) for row in range(100_000)),
+        "counters": b"".join(row.to_bytes(8, "little") for row in range(200_000)),
+    }
+    worst = 0
+    chunks = 0
+    failures = []
+    for _ in range(CDC_CHECK_KEYS):
+        table = _cdc_table(generate_key())
+        for name, data in samples.items():
+            before = {digest for _, digest in _cdc_chunks(io.BytesIO(data), table)}
+            edited = data[:1000] + b"x" + data[1000:]
+            after = [digest for _, digest in _cdc_chunks(io.BytesIO(edited), table)]
+            changed = sum(digest not in before for digest in after)
+            if changed >= worst:
+                worst, chunks = changed, len(after)
+            if changed > CDC_CHECK_MAX_CHANGED:
+                failures.append(
+                    f"cdc_locality: a 1-byte insert into {name} data changed {changed} of {len(after)} chunks"
+                )
+    return {"max_changed_chunks": worst, "chunks": chunks, "failures": failures}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for metric in ("p50_s", "rss_increase_bytes"):
+            # Baselines from before rss_increase_bytes existed only gate on latency.
+            if previous.get(metric) and current[metric] > previous[metric] * (1 + threshold):
+                change = current[metric] / previous[metric] - 1
+                regressions.append(f"{name} {metric}: {previous[metric]:.6g} -> {current[metric]:.6g} (+{change:.0%})")
+    return regressions
+
+
+def percentile(sorted_samples: list[float], fraction: float) -> float:
+    index = min(len(sorted_samples) - 1, round(fraction * (len(sorted_samples) - 1)))
+    return sorted_samples[index]
+
+
+def start_rss_window() -> int:
+    """Start measuring peak RSS from now; returns the RSS to measure the increase from.
+
+    On Linux, writing 5 to /proc/self/clear_refs resets the peak (VmHWM) to
+    the current RSS, so transient setup allocations do not count. Elsewhere
+    ru_maxrss cannot be reset, and the increase is over the setup's peak.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as file_handle:
+            file_handle.write("5")
+        return _proc_status_bytes("VmRSS")
+    except OSError:
+        return peak_rss()
+
+
+def peak_rss() -> int:
+    try:
+        return _proc_status_bytes("VmHWM")
+    except OSError:
+        pass
+    # ru_maxrss is KiB on Linux and bytes on macOS.
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+def _proc_status_bytes(field: str) -> int:
+    with open("/proc/self/status", encoding="ascii") as file_handle:
+        for line in file_handle:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+    raise OSError(f"{field} is not in /proc/self/status")
+
+
+def environment() -> dict:
+    import cryptography
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "cryptography": cryptography.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def format_result(result: dict) -> str:
+    throughput = result["throughput_bps"]
+    rate = f"{throughput / 1_000_000:9.1f} MB/s" if throughput else " " * 14
+    return (
+        f"p50 {result['p50_s'] * 1e3:10.3f} ms  p99 {result['p99_s'] * 1e3:10.3f} ms  "
+        f"{rate}  rss +{result['rss_increase_bytes'] / 1_048_576:8.1f} MiB  ({result['runs']} runs)"
+    )
+
+
+def format_size(size: int) -> str:
+    for unit, scale in (("GB", 1_000_000_000), ("MB", 1_000_000), ("KB", 1_000)):
+        if size >= scale:
+            return f"{size // scale}{unit}"
+    return f"{size}B"
+
+
+class _NullSink:
+    def write(self, data: bytes) -> int:
+        return len(data)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
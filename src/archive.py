@@ -0,0 +1,283 @@
+"""Multi-file encrypted archives with an encrypted table of contents.
+
+An archive is an ordinary chunked .fernet container (version 2 or later)
+whose plaintext is every member's bytes back to back, followed by a JSON
+table of contents and a fixed-size archive footer. The table of contents
+records each member's name, size, offset into the plaintext, SHA-256 and
+mtime. Because the container has a chunk index, listing decrypts only the
+index and the last chunk or two, and extracting a member decrypts only the
+chunks its byte range spans.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+from dataclasses import asdict, dataclass
+from pathlib import PurePosixPath
+from typing import BinaryIO, Iterator
+
+from src.crypto_utils import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_CIPHER,
+    DEFAULT_COMPRESSION_LEVEL,
+    ProgressCallback,
+    _atomic_output,
+    _cancellable,
+    _cipher_for,
+    _iter_range,
+    _open_random_access,
+    encrypt_stream,
+)
+
+ARCHIVE_SUFFIX = ".farc"
+ARCHIVE_VERSION = 1
+
+_ARCHIVE_MAGIC = b"SHFA"
+_ARCHIVE_FOOTER = struct.Struct(">Q4s")
+_MAX_TOC_LENGTH = 256 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class ArchiveMember:
+    name: str
+    size: int
+    offset: int
+    sha256: str
+    mtime: float
+
+
+def create_archive(
+    source_dir: str,
+    archive_path: str,
+    key: bytes,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    progress: ProgressCallback | None = None,
+    cancel: threading.Event | None = None,
+    compression: str | None = None,
+    level: int = DEFAULT_COMPRESSION_LEVEL,
+    cipher: str = DEFAULT_CIPHER,
+) -> list[ArchiveMember]:
+    names = _collect_members(source_dir, archive_path)
+    source = _ArchiveSource(source_dir, names)
+    with _atomic_output(archive_path) as destination:
+        encrypt_stream(
+            source, destination, key, chunk_size, _cancellable(progress, cancel), compression, level, cipher
+        )
+    return source.members
+
+
+def list_archive(archive_path: str, key: bytes) -> list[ArchiveMember]:
+    with ArchiveReader(archive_path, key) as reader:
+        return reader.members
+
+
+def extract_member(archive_path: str, name: str, destination_path: str, key: bytes) -> ArchiveMember:
+    with ArchiveReader(archive_path, key) as reader:
+        return reader.extract(name, destination_path)
+
+
+class ArchiveReader:
+    """Random-access reader over one archive; the table of contents is decrypted once on open."""
+
+    def __init__(self, archive_path: str, key: bytes) -> None:
+        _cipher_for(key)
+        self._file = open(archive_path, "rb")
+        try:
+            self._view = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._header, self._cipher_suite, self._offsets, self._total = _open_random_access(self._view, key)
+            self.members = self._read_table_of_contents()
+        except BaseException:
+            self.close()
+            raise
+        self._by_name = {member.name: member for member in self.members}
+
+    def __enter__(self) -> "ArchiveReader":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        view = getattr(self, "_view", None)
+        if view is not None:
+            view.close()
+        self._file.close()
+
+    def member(self, name: str) -> ArchiveMember:
+        try:
+            return self._by_name[name]
+        except KeyError:
+            raise KeyError(f"No member named {name!r} in the archive.") from None
+
+    def read(self, name: str) -> bytes:
+        member = self.member(name)
+        data = b"".join(self._iter_member(member))
+        _check_digest(member, hashlib.sha256(data).hexdigest())
+        return data
+
+    def extract(
+        self,
+        name: str,
+        destination_path: str,
+        progress: ProgressCallback | None = None,
+        cancel: threading.Event | None = None,
+    ) -> ArchiveMember:
+        member = self.member(name)
+        report = _cancellable(progress, cancel)
+        digest = hashlib.sha256()
+        done = 0
+        with _atomic_output(destination_path) as destination:
+            for piece in self._iter_member(member):
+                destination.write(piece)
+                digest.update(piece)
+                done += len(piece)
+                report(done)
+            # Checked before the temp file is renamed, so a bad member never lands.
+            _check_digest(member, digest.hexdigest())
+        os.utime(destination_path, (member.mtime, member.mtime))
+        return member
+
+    def extract_all(
+        self,
+        destination_dir: str,
+        names: list[str] | None = None,
+        progress: ProgressCallback | None = None,
+        cancel: threading.Event | None = None,
+    ) -> list[ArchiveMember]:
+        members = self.members if names is None else [self.member(name) for name in names]
+        extracted = []
+        done = 0
+        for member in members:
+            destination_path = os.path.join(destination_dir, *_safe_parts(member.name))
+            os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+            report = None if progress is None else (lambda count, base=done: progress(base + count))
+            self.extract(member.name, destination_path, report, cancel)
+            done += member.size
+            extracted.append(member)
+        return extracted
+
+    def _iter_member(self, member: ArchiveMember) -> Iterator[bytes]:
+        return _iter_range(
+            self._view, self._cipher_suite, self._header, self._offsets, self._total, member.offset, member.size
+        )
+
+    def _read_table_of_contents(self) -> list[ArchiveMember]:
+        if self._total < _ARCHIVE_FOOTER.size:
+            raise ValueError("Not an encrypted archive.")
+        # Decrypt from the chunk holding the footer to the end once; a small
+        # table of contents sits in the same chunk and needs no further reads.
+        tail_start = (self._total - _ARCHIVE_FOOTER.size) // self._header.chunk_size * self._header.chunk_size
+        tail = self._read_plain(tail_start, self._total - tail_start)
+        toc_length, magic = _ARCHIVE_FOOTER.unpack(tail[-_ARCHIVE_FOOTER.size :])
+        toc_offset = self._total - _ARCHIVE_FOOTER.size - toc_length
+        if magic != _ARCHIVE_MAGIC or toc_length > _MAX_TOC_LENGTH or toc_offset < 0:
+            raise ValueError("Not an encrypted archive.")
+        head = self._read_plain(toc_offset, tail_start - toc_offset) if toc_offset < tail_start else b""
+        raw_table = head + tail[max(toc_offset - tail_start, 0) : -_ARCHIVE_FOOTER.size]
+        try:
+            table = json.loads(raw_table)
+            if table["version"] != ARCHIVE_VERSION:
+                raise ValueError(f"Unsupported archive version: {table['version']}")
+            members = [ArchiveMember(**entry) for entry in table["members"]]
+        except (KeyError, TypeError) as exc:
+            raise ValueError("Archive table of contents is malformed.") from exc
+        for member in members:
+            if member.offset < 0 or member.size < 0 or member.offset + member.size > toc_offset:
+                raise ValueError(f"Archive member {member.name!r} lies outside the archive data.")
+        return members
+
+    def _read_plain(self, offset: int, length: int) -> bytes:
+        return b"".join(
+            _iter_range(self._view, self._cipher_suite, self._header, self._offsets, self._total, offset, length)
+        )
+
+
+class _ArchiveSource:
+    # Reads like one file: every member in turn, then the table of contents.
+    # Entries describe the bytes actually read, so a file that changes while
+    # it is archived still yields a consistent table.
+
+    def __init__(self, root: str, names: list[str]) -> None:
+        self.members: list[ArchiveMember] = []
+        self._root = root
+        self._pending = list(reversed(names))
+        self._current: BinaryIO | None = None
+        self._current_name = ""
+        self._current_mtime = 0.0
+        self._current_size = 0
+        self._digest = hashlib.sha256()
+        self._offset = 0
+        self._trailer: bytes | None = None
+
+    def read(self, size: int) -> bytes:
+        while True:
+            if self._trailer is not None:
+                data, self._trailer = self._trailer[:size], self._trailer[size:]
+                return data
+            if self._current is None:
+                if not self._pending:
+                    self._trailer = self._table_of_contents()
+                    continue
+                self._open_next()
+            data = self._current.read(size)
+            if data:
+                self._digest.update(data)
+                self._current_size += len(data)
+                return data
+            self._finish_current()
+
+    def _open_next(self) -> None:
+        name = self._pending.pop()
+        path = os.path.join(self._root, *name.split("/"))
+        self._current = open(path, "rb")
+        self._current_name = name
+        self._current_mtime = os.fstat(self._current.fileno()).st_mtime
+        self._current_size = 0
+        self._digest = hashlib.sha256()
+
+    def _finish_current(self) -> None:
+        self._current.close()
+        self._current = None
+        self.members.append(
+            ArchiveMember(
+                self._current_name, self._current_size, self._offset, self._digest.hexdigest(), self._current_mtime
+            )
+        )
+        self._offset += self._current_size
+
+    def _table_of_contents(self) -> bytes:
+        table = json.dumps(
+            {"version": ARCHIVE_VERSION, "members": [asdict(member) for member in self.members]},
+            separators=(",", ":"),
+        ).encode()
+        return table + _ARCHIVE_FOOTER.pack(len(table), _ARCHIVE_MAGIC)
+
+
+def _collect_members(source_dir: str, archive_path: str) -> list[str]:
+    if not os.path.isdir(source_dir):
+        raise ValueError(f"Not a directory: {source_dir}")
+    archive_path = os.path.abspath(archive_path)
+    names = []
+    for root, directories, files in os.walk(source_dir):
+        directories.sort()
+        for file_name in sorted(files):
+            path = os.path.join(root, file_name)
+            if os.path.islink(path) or not os.path.isfile(path) or os.path.abspath(path) == archive_path:
+                continue
+            names.append(PurePosixPath(*os.path.relpath(path, source_dir).split(os.sep)).as_posix())
+    return names
+
+
+def _safe_parts(name: str) -> tuple[str, ...]:
+    # Member names come from the archive, so never let one escape the output directory.
+    parts = PurePosixPath(name).parts
+    if not parts or name.startswith("/") or any(part in ("", ".", "..") or "\\" in part for part in parts):
+        raise ValueError(f"Refusing to extract unsafe member name {name!r}.")
+    return parts
+
+
+def _check_digest(member: ArchiveMember, actual: str) -> None:
+    if actual != member.sha256:
+        raise ValueError(f"Archive member {member.name!r} failed its checksum.")
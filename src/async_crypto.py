@@ -0,0 +1,320 @@
+"""Asyncio front end for the chunked .fernet container.
+
+Sources may be asyncio.StreamReaders (or anything with an async read(n)) or
+async iterators of bytes. Destinations need a write() method; an awaitable
+write() and an async drain(), as on asyncio.StreamWriter, are awaited so a
+slow consumer slows the producer down. All cipher, compression and KDF work
+runs in an executor, so the event loop only moves bytes around.
+"""
+import asyncio
+import inspect
+import io
+import weakref
+from collections import deque
+from concurrent.futures import Executor
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Callable, TypeVar
+
+from src.crypto_utils import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_CIPHER,
+    DEFAULT_COMPRESSION_LEVEL,
+    STREAM_MAGIC,
+    DerivedKeyCache,
+    KeyPackage,
+    MultiKeyPackage,
+    ProgressCallback,
+    _MAX_INDEX_TOKEN_LENGTH,
+    _RECORD_LENGTH,
+    _STREAM_FOOTER,
+    _STREAM_HEADER,
+    _StreamHeader,
+    _check_index_trailer,
+    _cipher_for,
+    _max_token_length,
+    _new_stream_header,
+    _parse_stream_header,
+    _record_length,
+    _stream_cipher,
+    _timed,
+    _write_index_trailer,
+    unwrap_key_with_passphrase,
+)
+from src.parallel import _open_job, _seal_job, default_workers
+
+ASYNC_CHUNK_WINDOW = 2
+
+T = TypeVar("T")
+
+_default_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+@_timed("encrypt", api="async")
+async def async_encrypt_stream(
+    source: Any,
+    destination: Any,
+    key: bytes,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    progress: ProgressCallback | None = None,
+    compression: str | None = None,
+    level: int = DEFAULT_COMPRESSION_LEVEL,
+    executor: Executor | None = None,
+    semaphore: asyncio.Semaphore | None = None,
+    window: int = ASYNC_CHUNK_WINDOW,
+    cipher: str = DEFAULT_CIPHER,
+) -> int:
+    _cipher_for(key)
+    _check_window(window)
+    header = _new_stream_header(chunk_size, compression, level, cipher)
+    offload = _Offloader(executor, semaphore)
+    reader = _AsyncSource(source)
+    await _write(destination, header.raw)
+
+    async def jobs() -> AsyncIterator[tuple[asyncio.Future, int]]:
+        async for index, final, chunk in _aiter_plain_chunks(reader, chunk_size):
+            yield await offload.submit(_seal_job, key, header, index, final, chunk, level), len(chunk)
+
+    total = 0
+    position = len(header.raw)
+    offsets = []
+    async with aclosing(_in_order(jobs(), window)) as results:
+        async for token, chunk_length in results:
+            offsets.append(position)
+            await _write(destination, _RECORD_LENGTH.pack(len(token)), token)
+            position += _RECORD_LENGTH.size + len(token)
+            total += chunk_length
+            if progress is not None:
+                progress(total)
+    trailer = await offload.run(_index_trailer_job, key, header, offsets, total, position)
+    await _write(destination, trailer)
+    return total
+
+
+@_timed("decrypt", api="async")
+async def async_decrypt_stream(
+    source: Any,
+    destination: Any,
+    key: bytes,
+    progress: ProgressCallback | None = None,
+    executor: Executor | None = None,
+    semaphore: asyncio.Semaphore | None = None,
+    window: int = ASYNC_CHUNK_WINDOW,
+) -> int:
+    _cipher_for(key)
+    _check_window(window)
+    offload = _Offloader(executor, semaphore)
+    reader = _AsyncSource(source)
+    magic = await reader.read_exact(len(STREAM_MAGIC))
+    if magic != STREAM_MAGIC:
+        # A legacy single-token file has to be read whole before it can be checked.
+        token = magic + await reader.read_all()
+        payload = await offload.run(_legacy_job, key, token)
+        await _write(destination, payload)
+        if progress is not None:
+            progress(len(token))
+        return len(payload)
+
+    header = _parse_stream_header(magic + await reader.read_exact(_STREAM_HEADER.size - len(magic)))
+
+    async def jobs() -> AsyncIterator[tuple[asyncio.Future, int]]:
+        index = 0
+        async for token in _aiter_tokens(reader, header):
+            yield await offload.submit(_open_job, key, header, index, token), len(token)
+            index += 1
+
+    total = 0
+    position = len(header.raw)
+    offsets = []
+    finished = False
+    async with aclosing(_in_order(jobs(), window)) as results:
+        async for (chunk, final), token_length in results:
+            if finished:
+                raise ValueError("Unexpected data after the final encrypted chunk.")
+            await _write(destination, chunk)
+            total += len(chunk)
+            offsets.append(position)
+            position += _RECORD_LENGTH.size + token_length
+            finished = final
+            if progress is not None:
+                progress(position)
+    if not finished:
+        raise ValueError("Encrypted stream is truncated.")
+    if header.version >= 2:
+        trailer = await _read_index_trailer(reader)
+        await offload.run(_check_trailer_job, key, header, offsets, total, position, trailer)
+    elif await reader.read_exact(1):
+        raise ValueError("Unexpected data after the final encrypted chunk.")
+    return total
+
+
+async def async_unwrap_key_with_passphrase(
+    key_package: KeyPackage | MultiKeyPackage,
+    passphrase: str,
+    cache: DerivedKeyCache | None = None,
+    executor: Executor | None = None,
+    semaphore: asyncio.Semaphore | None = None,
+    recipient: str | None = None,
+) -> bytes:
+    # A cache is shared state, so it only makes sense with a thread executor.
+    return await _Offloader(executor, semaphore).run(
+        unwrap_key_with_passphrase, key_package, passphrase, cache, recipient
+    )
+
+
+class _AsyncSource:
+    def __init__(self, source: Any) -> None:
+        if hasattr(source, "read"):
+            self._read = source.read
+            self._iterator = None
+        elif hasattr(source, "__aiter__"):
+            self._read = None
+            self._iterator = aiter(source)
+        else:
+            raise TypeError("Source must have an async read() method or be an async iterable of bytes.")
+        self._buffer = bytearray()
+        self._eof = False
+
+    async def read_exact(self, size: int) -> bytes:
+        # Returns exactly `size` bytes, or fewer only at end of stream.
+        while len(self._buffer) < size and not self._eof:
+            await self._fill(size - len(self._buffer))
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    async def read_all(self) -> bytes:
+        while not self._eof:
+            await self._fill(DEFAULT_CHUNK_SIZE)
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+    async def _fill(self, wanted: int) -> None:
+        if self._read is not None:
+            data = await self._read(wanted)
+            self._eof = not data
+        else:
+            # Iterators may yield empty pieces; only exhaustion means EOF.
+            data = await anext(self._iterator, None)
+            self._eof = data is None
+        if data:
+            self._buffer += data
+
+
+class _Offloader:
+    def __init__(self, executor: Executor | None, semaphore: asyncio.Semaphore | None) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._executor = executor
+        self._semaphore = semaphore if semaphore is not None else _default_semaphore(self._loop)
+
+    async def submit(self, function: Callable[..., T], *args: Any) -> "asyncio.Future[T]":
+        # The semaphore caps executor jobs across every stream on the loop;
+        # waiting for it is what pauses a stream when the workers are busy.
+        await self._semaphore.acquire()
+        try:
+            future = self._loop.run_in_executor(self._executor, function, *args)
+        except BaseException:
+            self._semaphore.release()
+            raise
+        future.add_done_callback(lambda _: self._semaphore.release())
+        return future
+
+    async def run(self, function: Callable[..., T], *args: Any) -> T:
+        return await (await self.submit(function, *args))
+
+
+async def _in_order(
+    jobs: AsyncIterator[tuple[asyncio.Future, T]], window: int
+) -> AsyncIterator[tuple[Any, T]]:
+    # Like parallel._in_order: at most `window` chunks per stream are in
+    # flight, and the source is not read again until the oldest one is done.
+    pending: deque[tuple[asyncio.Future, T]] = deque()
+    try:
+        async with aclosing(jobs):
+            async for job in jobs:
+                pending.append(job)
+                if len(pending) >= window:
+                    future, tag = pending.popleft()
+                    yield await future, tag
+        while pending:
+            future, tag = pending.popleft()
+            yield await future, tag
+    finally:
+        for future, _ in pending:
+            future.cancel()
+
+
+async def _aiter_plain_chunks(reader: _AsyncSource, chunk_size: int) -> AsyncIterator[tuple[int, bool, bytes]]:
+    index = 0
+    chunk = await reader.read_exact(chunk_size)
+    while True:
+        next_chunk = await reader.read_exact(chunk_size) if len(chunk) == chunk_size else b""
+        final = not next_chunk
+        yield index, final, chunk
+        if final:
+            return
+        chunk = next_chunk
+        index += 1
+
+
+async def _aiter_tokens(reader: _AsyncSource, header: _StreamHeader) -> AsyncIterator[bytes]:
+    max_token_length = _max_token_length(header)
+    while True:
+        token_length = _record_length(await reader.read_exact(_RECORD_LENGTH.size), max_token_length)
+        if not token_length:
+            return
+        token = await reader.read_exact(token_length)
+        if len(token) != token_length:
+            raise ValueError("Encrypted stream is truncated.")
+        yield token
+
+
+async def _read_index_trailer(reader: _AsyncSource) -> bytes:
+    # The trailer is read (bounded) on the loop and checked in the executor.
+    raw_length = await reader.read_exact(_RECORD_LENGTH.size)
+    if len(raw_length) != _RECORD_LENGTH.size:
+        raise ValueError("Encrypted stream index trailer is truncated.")
+    (token_length,) = _RECORD_LENGTH.unpack(raw_length)
+    if token_length > _MAX_INDEX_TOKEN_LENGTH:
+        raise ValueError("Encrypted stream index trailer is malformed.")
+    return raw_length + await reader.read_exact(token_length + _STREAM_FOOTER.size + 1)
+
+
+async def _write(destination: Any, *parts: bytes) -> None:
+    for part in parts:
+        result = destination.write(part)
+        if inspect.isawaitable(result):
+            await result
+    drain = getattr(destination, "drain", None)
+    if drain is not None:
+        await drain()
+
+
+def _check_window(window: int) -> None:
+    if window < 1:
+        raise ValueError("Chunk window must be at least 1.")
+
+
+def _default_semaphore(loop: asyncio.AbstractEventLoop) -> asyncio.Semaphore:
+    semaphore = _default_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _default_semaphores[loop] = asyncio.Semaphore(default_workers())
+    return semaphore
+
+
+def _index_trailer_job(key: bytes, header: _StreamHeader, offsets: list[int], total: int, position: int) -> bytes:
+    buffer = io.BytesIO()
+    _write_index_trailer(buffer, _stream_cipher(key, header), header.digest, offsets, total, position)
+    return buffer.getvalue()
+
+
+def _check_trailer_job(
+    key: bytes, header: _StreamHeader, offsets: list[int], total: int, position: int, trailer: bytes
+) -> None:
+    _check_index_trailer(io.BytesIO(trailer), _stream_cipher(key, header), header.digest, offsets, total, position)
+
+
+def _legacy_job(key: bytes, token: bytes) -> bytes:
+    return _cipher_for(key).decrypt(token)
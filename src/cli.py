@@ -0,0 +1,867 @@
+"""Headless command-line interface: python -m src <command> ..."""
+import argparse
+import functools
+import getpass
+import glob
+import json
+import os
+import signal
+import sys
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import BinaryIO
+
+from cryptography.fernet import InvalidToken
+
+from src.archive import ARCHIVE_SUFFIX, ArchiveReader, create_archive
+from src.crypto_utils import (
+    CIPHERS,
+    COMPRESSION_ALGORITHMS,
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_CIPHER,
+    DEFAULT_COMPRESSION_LEVEL,
+    KDF_PBKDF2,
+    KDF_TARGET_SECONDS,
+    available_kdfs,
+    calibrate_kdf,
+    decrypt_file,
+    decrypt_stream,
+    encrypt_file,
+    encrypt_stream,
+    key_fingerprint,
+    parse_key_package,
+    unwrap_key_with_passphrase,
+    verify_file,
+    verify_stream,
+    wrap_key_for_recipients,
+    wrap_key_with_passphrase,
+)
+from src.incremental import DELTA_SUFFIX, apply_delta, encrypt_delta
+from src.key_agent import (
+    AGENT_SOCKET_ENV,
+    KEY_AGENT_LIFETIME,
+    KeyAgentClient,
+    KeyAgentError,
+    default_agent_socket,
+    serve_agent,
+)
+from src.metrics import METRICS, METRICS_ENV
+from src.resumable import decrypt_file_resumable, encrypt_file_resumable
+from src.rotation import FAILED, SKIPPED, RotationStats, rotate_files
+from src.watcher import DEFAULT_POLL_INTERVAL, DEFAULT_QUEUE_SIZE, DEFAULT_SETTLE_SECONDS, FolderWatcher
+
+ENCRYPTED_SUFFIX = ".fernet"
+DECRYPTED_SUFFIX = ".decrypted"
+
+
+@dataclass
+class FileTask:
+    source: str
+    destination: str
+
+
+@dataclass(frozen=True)
+class AgentKeyRef:
+    """A key held by the running key agent, used in place of the key bytes."""
+
+    fingerprint: str
+    socket: str | None = None
+
+
+@dataclass
+class FileOutcome:
+    task: FileTask
+    input_bytes: int = 0
+    error: str | None = None
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        return args.handler(args)
+    except InvalidToken:
+        print("error: wrong key or passphrase, or the data is corrupted", file=sys.stderr)
+        return 2
+    except (OSError, KeyError, ValueError, KeyAgentError) as exc:
+        print(f"error: {exc}", file=sys.stderr)
+        return 2
+    finally:
+        if args.metrics:
+            METRICS.write(args.metrics)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m src", description="Encrypt and decrypt data without the GUI.")
+    parser.add_argument(
+        "--metrics",
+        default=os.environ.get(METRICS_ENV),
+        help="Write operation timings here on exit: JSON for a .json path, else Prometheus text.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    for name, handler, help_text in (
+        ("encrypt", _cmd_encrypt, "Encrypt files, globs, directory trees or stdin ('-')."),
+        ("decrypt", _cmd_decrypt, "Decrypt .fernet files, globs, directory trees or stdin ('-')."),
+    ):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument("paths", nargs="+", help="Files, glob patterns, directories, or '-' for stdin/stdout.")
+        command.add_argument("-o", "--output-dir", help="Write outputs here, mirroring directory structure.")
+        command.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1, help="Files processed concurrently.")
+        command.add_argument("--threads", action="store_true", help="Use a thread pool instead of processes.")
+        command.add_argument("--force", action="store_true", help="Overwrite existing outputs.")
+        command.add_argument(
+            "--resume",
+            action="store_true",
+            help="Checkpoint each file as it goes; rerun with --resume to continue interrupted files.",
+        )
+        if name == "encrypt":
+            command.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Plaintext bytes per chunk.")
+            command.add_argument("--compress", choices=COMPRESSION_ALGORITHMS, help="Compress each chunk before encrypting.")
+            command.add_argument("--level", type=int, default=DEFAULT_COMPRESSION_LEVEL, help="Compression level (0-9).")
+            command.add_argument("--cipher", choices=CIPHERS, default=DEFAULT_CIPHER, help="Chunk cipher (default: fernet).")
+        _add_key_arguments(command, allow_agent=True)
+        _add_passphrase_arguments(command)
+        _add_socket_argument(command)
+        command.set_defaults(handler=handler)
+
+    verify = commands.add_parser("verify", help="Check .fernet files for corruption without decrypting them.")
+    verify.add_argument("paths", nargs="+", help="Files, glob patterns, directories, or '-' for stdin.")
+    verify.add_argument("-o", "--output", help="Write the JSON report here instead of stdout.")
+    verify.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1, help="Files checked concurrently.")
+    verify.add_argument("--threads", action="store_true", help="Use a thread pool instead of processes.")
+    _add_key_arguments(verify)
+    _add_passphrase_arguments(verify)
+    verify.set_defaults(handler=_cmd_verify)
+
+    wrap = commands.add_parser("wrap-key", help="Protect a key with a passphrase and print the key package JSON.")
+    _add_key_arguments(wrap, allow_package=False)
+    _add_passphrase_arguments(wrap)
+    wrap.add_argument("-o", "--output", help="Write the key package here instead of stdout.")
+    wrap.add_argument(
+        "--recipients",
+        help='JSON file of {"recipient": "passphrase", ...}; wraps the key once per recipient into one package.',
+    )
+    wrap.add_argument("-j", "--workers", type=int, help="Recipients wrapped concurrently (default: one per CPU core).")
+    wrap.add_argument("--kdf", default=KDF_PBKDF2, help="Key derivation function: PBKDF2HMAC-SHA256, scrypt or argon2id.")
+    wrap.add_argument(
+        "--target-time",
+        type=float,
+        nargs="?",
+        const=KDF_TARGET_SECONDS,
+        help=f"Calibrate the KDF cost to take about this many seconds here (default {KDF_TARGET_SECONDS}).",
+    )
+    wrap.set_defaults(handler=_cmd_wrap_key)
+
+    unwrap = commands.add_parser("unwrap-key", help="Recover a key from a key package and passphrase.")
+    unwrap.add_argument("key_package", help="Key package JSON file, or '-' for stdin.")
+    _add_passphrase_arguments(unwrap)
+    _add_recipient_argument(unwrap)
+    unwrap.add_argument("--fingerprint", action="store_true", help="Also print the key fingerprint to stderr.")
+    unwrap.set_defaults(handler=_cmd_unwrap_key)
+
+    rotate = commands.add_parser("rotate-key", help="Re-encrypt .fernet files in place under a new key.")
+    rotate.add_argument("paths", nargs="+", help="Files, glob patterns or directory trees to rotate.")
+    new_key = rotate.add_mutually_exclusive_group(required=True)
+    new_key.add_argument("--new-key-file", help="File containing the new Fernet key.")
+    new_key.add_argument("--new-key-env", help="Environment variable holding the new Fernet key.")
+    rotate.add_argument(
+        "--extra-key-file",
+        action="append",
+        default=[],
+        help="Another retired key some of the files may still be under (repeatable).",
+    )
+    rotate.add_argument(
+        "--journal", help="Record finished files here; rerunning with the same journal resumes an interrupted rotation."
+    )
+    rotate.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1, help="Files rotated concurrently.")
+    rotate.add_argument("--threads", action="store_true", help="Use a thread pool instead of processes.")
+    _add_key_arguments(rotate)
+    _add_passphrase_arguments(rotate)
+    rotate.set_defaults(handler=_cmd_rotate_key)
+
+    watch = commands.add_parser("watch", help="Encrypt every file dropped into a staging directory, until stopped.")
+    watch.add_argument("input_dir", help="Staging directory to watch (recursively).")
+    watch.add_argument(
+        "-o", "--output-dir", required=True, help="Write encrypted files here, mirroring the staging tree."
+    )
+    originals = watch.add_mutually_exclusive_group(required=True)
+    originals.add_argument("--processed-dir", help="Move originals here once their encrypted copy is on disk.")
+    originals.add_argument(
+        "--delete-originals", action="store_true", help="Delete originals once their encrypted copy is on disk."
+    )
+    watch.add_argument("--failed-dir", help="Move files that fail here (default: leave them until they change).")
+    watch.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1, help="Files encrypted concurrently.")
+    watch.add_argument("--threads", action="store_true", help="Use threads instead of worker processes.")
+    watch.add_argument(
+        "--queue-size", type=int, default=DEFAULT_QUEUE_SIZE, help="Finished files queued ahead of the workers."
+    )
+    watch.add_argument(
+        "--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL, help="Seconds between scans of the staging tree."
+    )
+    watch.add_argument(
+        "--settle",
+        type=float,
+        default=DEFAULT_SETTLE_SECONDS,
+        help="Seconds a file must go unchanged before it counts as finished.",
+    )
+    watch.add_argument(
+        "--status-interval",
+        type=float,
+        default=10.0,
+        help="Seconds between status lines; --metrics is rewritten at the same interval.",
+    )
+    watch.add_argument("--force", action="store_true", help="Overwrite existing outputs.")
+    watch.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Plaintext bytes per chunk.")
+    watch.add_argument("--compress", choices=COMPRESSION_ALGORITHMS, help="Compress each chunk before encrypting.")
+    watch.add_argument("--level", type=int, default=DEFAULT_COMPRESSION_LEVEL, help="Compression level (0-9).")
+    watch.add_argument("--cipher", choices=CIPHERS, default=DEFAULT_CIPHER, help="Chunk cipher (default: fernet).")
+    _add_key_arguments(watch)
+    _add_passphrase_arguments(watch)
+    watch.set_defaults(handler=_cmd_watch)
+
+    archive = commands.add_parser("archive", help="Pack a directory into one encrypted archive.")
+    archive.add_argument("directory", help="Directory to archive (walked recursively).")
+    archive.add_argument("-o", "--output", help=f"Archive path (default: <directory>{ARCHIVE_SUFFIX}).")
+    archive.add_argument("--force", action="store_true", help="Overwrite an existing archive.")
+    archive.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Plaintext bytes per chunk.")
+    archive.add_argument("--compress", choices=COMPRESSION_ALGORITHMS, help="Compress each chunk before encrypting.")
+    archive.add_argument("--level", type=int, default=DEFAULT_COMPRESSION_LEVEL, help="Compression level (0-9).")
+    archive.add_argument("--cipher", choices=CIPHERS, default=DEFAULT_CIPHER, help="Chunk cipher (default: fernet).")
+    _add_key_arguments(archive)
+    _add_passphrase_arguments(archive)
+    archive.set_defaults(handler=_cmd_archive)
+
+    archive_list = commands.add_parser("archive-list", help="List the members of an encrypted archive.")
+    archive_list.add_argument("archive", help="Archive file.")
+    _add_key_arguments(archive_list)
+    _add_passphrase_arguments(archive_list)
+    archive_list.set_defaults(handler=_cmd_archive_list)
+
+    archive_extract = commands.add_parser("archive-extract", help="Extract all or selected members of an archive.")
+    archive_extract.add_argument("archive", help="Archive file.")
+    archive_extract.add_argument("members", nargs="*", help="Member names to extract (default: all).")
+    archive_extract.add_argument("-o", "--output-dir", default=".", help="Extract into this directory.")
+    _add_key_arguments(archive_extract)
+    _add_passphrase_arguments(archive_extract)
+    archive_extract.set_defaults(handler=_cmd_archive_extract)
+
+    delta = commands.add_parser("delta", help="Encrypt only what changed since the last delta of a file.")
+    delta.add_argument("file", help="File to encrypt.")
+    delta.add_argument(
+        "--manifest", required=True, help="Encrypted chunk manifest of the previous version (created on first use)."
+    )
+    delta.add_argument("-o", "--output", help=f"Delta path (default: <file>.v<version>{DELTA_SUFFIX}).")
+    delta.add_argument("--compress", choices=COMPRESSION_ALGORITHMS, help="Compress each chunk before encrypting.")
+    delta.add_argument("--level", type=int, default=DEFAULT_COMPRESSION_LEVEL, help="Compression level (0-9).")
+    _add_key_arguments(delta)
+    _add_passphrase_arguments(delta)
+    delta.set_defaults(handler=_cmd_delta)
+
+    apply = commands.add_parser("apply-delta", help="Rebuild a new version of a file from its previous one and a delta.")
+    apply.add_argument("delta", help="Delta file.")
+    apply.add_argument("--base", help="Previous version of the file (omit for the first delta).")
+    apply.add_argument("-o", "--output", required=True, help="Write the new version here (may equal --base).")
+    _add_key_arguments(apply)
+    _add_passphrase_arguments(apply)
+    apply.set_defaults(handler=_cmd_apply_delta)
+
+    agent = commands.add_parser("agent", help="Run the key agent in the foreground.")
+    _add_socket_argument(agent)
+    agent.set_defaults(handler=_cmd_agent)
+
+    agent_add = commands.add_parser("agent-add", help="Load a key into the running key agent.")
+    _add_key_arguments(agent_add)
+    _add_passphrase_arguments(agent_add)
+    agent_add.add_argument(
+        "--lifetime", type=float, default=KEY_AGENT_LIFETIME, help="Seconds the agent keeps the key (0 = until removed)."
+    )
+    _add_socket_argument(agent_add)
+    agent_add.set_defaults(handler=_cmd_agent_add)
+
+    agent_list = commands.add_parser("agent-list", help="List key fingerprints held by the key agent.")
+    _add_socket_argument(agent_list)
+    agent_list.set_defaults(handler=_cmd_agent_list)
+
+    agent_remove = commands.add_parser("agent-remove", help="Remove keys from the key agent.")
+    target = agent_remove.add_mutually_exclusive_group(required=True)
+    target.add_argument("fingerprint", nargs="?", help="Fingerprint of the key to remove.")
+    target.add_argument("--all", action="store_true", help="Remove every key.")
+    _add_socket_argument(agent_remove)
+    agent_remove.set_defaults(handler=_cmd_agent_remove)
+    return parser
+
+
+def collect_tasks(paths: list[str], encrypting: bool, output_dir: str | None) -> list[FileTask]:
+    tasks = []
+    for raw_path in paths:
+        matches = sorted(glob.glob(raw_path, recursive=True)) if glob.has_magic(raw_path) else [raw_path]
+        if not matches:
+            raise ValueError(f"No files match {raw_path!r}.")
+        for path in matches:
+            if os.path.isdir(path):
+                for root, _, names in os.walk(path):
+                    for name in sorted(names):
+                        if name.endswith(ENCRYPTED_SUFFIX) == encrypting:
+                            continue
+                        source = os.path.join(root, name)
+                        tasks.append(FileTask(source, _output_path(source, encrypting, output_dir, path)))
+            elif os.path.isfile(path):
+                tasks.append(FileTask(path, _output_path(path, encrypting, output_dir, None)))
+            else:
+                raise ValueError(f"No such file or directory: {path}")
+    return tasks
+
+
+def run_tasks(
+    tasks: list[FileTask],
+    key: bytes | AgentKeyRef,
+    encrypting: bool,
+    workers: int,
+    use_processes: bool = True,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    force: bool = False,
+    compression: str | None = None,
+    level: int = DEFAULT_COMPRESSION_LEVEL,
+    cipher: str = DEFAULT_CIPHER,
+    resume: bool = False,
+) -> list[FileOutcome]:
+    if workers < 1:
+        raise ValueError("Worker count must be at least 1.")
+    outcomes = []
+    pending = []
+    for task in tasks:
+        if os.path.exists(task.destination) and not force:
+            outcomes.append(FileOutcome(task, error="output exists (use --force to overwrite)"))
+        else:
+            pending.append(task)
+
+    with _make_pool(workers, use_processes) as executor:
+        pooled = isinstance(executor, ProcessPoolExecutor)
+        submit = functools.partial(executor.submit, _with_metrics) if pooled else executor.submit
+        futures = {
+            submit(
+                _process_file,
+                task.source,
+                task.destination,
+                key,
+                encrypting,
+                chunk_size,
+                compression,
+                level,
+                cipher,
+                resume,
+            ): task
+            for task in pending
+        }
+        for future in as_completed(futures):
+            task = futures[future]
+            try:
+                outcomes.append(FileOutcome(task, input_bytes=_pooled_result(future, pooled)))
+            except Exception as exc:
+                outcomes.append(FileOutcome(task, error=str(exc) or type(exc).__name__))
+    return outcomes
+
+
+def verify_paths(paths: list[str], key: bytes, workers: int, use_processes: bool = True) -> list[dict]:
+    if workers < 1:
+        raise ValueError("Worker count must be at least 1.")
+    sources = [task.source for task in collect_tasks(paths, False, None)]
+    with _make_pool(workers, use_processes) as executor:
+        if not isinstance(executor, ProcessPoolExecutor):
+            return list(executor.map(_verify_one, sources, [key] * len(sources)))
+        results = executor.map(_with_metrics, [_verify_one] * len(sources), sources, [key] * len(sources), chunksize=8)
+        entries = []
+        for entry, snapshot in results:
+            METRICS.merge(snapshot)
+            entries.append(entry)
+    return entries
+
+
+def _cmd_encrypt(args: argparse.Namespace) -> int:
+    return _run_files(args, encrypting=True)
+
+
+def _cmd_decrypt(args: argparse.Namespace) -> int:
+    return _run_files(args, encrypting=False)
+
+
+def _run_files(args: argparse.Namespace, encrypting: bool) -> int:
+    if args.agent and args.resume:
+        raise ValueError("--resume needs the key itself; it cannot be combined with --agent.")
+    key = AgentKeyRef(args.agent, args.socket) if args.agent else _load_key(args)
+    chunk_size = getattr(args, "chunk_size", DEFAULT_CHUNK_SIZE)
+    compression = getattr(args, "compress", None)
+    level = getattr(args, "level", DEFAULT_COMPRESSION_LEVEL)
+    cipher = getattr(args, "cipher", DEFAULT_CIPHER)
+    if args.paths == ["-"]:
+        if args.resume:
+            raise ValueError("stdin cannot be resumed; --resume needs file paths.")
+        started = time.perf_counter()
+        processed = _process_stream(
+            sys.stdin.buffer, sys.stdout.buffer, key, encrypting, chunk_size, compression, level, cipher
+        )
+        sys.stdout.buffer.flush()
+        _print_summary(1, 0, processed, time.perf_counter() - started)
+        return 0
+    if "-" in args.paths:
+        raise ValueError("'-' (stdin) cannot be combined with other paths.")
+
+    tasks = collect_tasks(args.paths, encrypting, args.output_dir)
+    started = time.perf_counter()
+    outcomes = run_tasks(
+        tasks,
+        key,
+        encrypting,
+        args.workers,
+        not args.threads,
+        chunk_size,
+        args.force,
+        compression,
+        level,
+        cipher,
+        args.resume,
+    )
+    elapsed = time.perf_counter() - started
+
+    failed = [outcome for outcome in outcomes if outcome.error]
+    for outcome in failed:
+        print(f"failed: {outcome.task.source}: {outcome.error}", file=sys.stderr)
+    processed = sum(outcome.input_bytes for outcome in outcomes)
+    _print_summary(len(outcomes) - len(failed), len(failed), processed, elapsed)
+    return 1 if failed else 0
+
+
+def _cmd_verify(args: argparse.Namespace) -> int:
+    key = _load_key(args)
+    started = time.perf_counter()
+    if args.paths == ["-"]:
+        entries = [_verify_one("-", key)]
+    elif "-" in args.paths:
+        raise ValueError("'-' (stdin) cannot be combined with other paths.")
+    else:
+        entries = verify_paths(args.paths, key, args.workers, not args.threads)
+    elapsed = time.perf_counter() - started
+    failed = sum(not entry["ok"] for entry in entries)
+    checked = sum(entry["size"] for entry in entries)
+    report = {
+        "files": entries,
+        "ok": len(entries) - failed,
+        "failed": failed,
+        "bytes": checked,
+        "seconds": round(elapsed, 3),
+    }
+    _write_text(args.output, json.dumps(report, indent=2))
+    _print_summary(len(entries) - failed, failed, checked, elapsed)
+    return 1 if failed else 0
+
+
+def _cmd_wrap_key(args: argparse.Namespace) -> int:
+    key = _load_key(args)
+    if args.kdf not in available_kdfs():
+        raise ValueError(f"{args.kdf} is not available here; choose from {', '.join(available_kdfs())}.")
+    params = None
+    if args.target_time is not None:
+        params = calibrate_kdf(args.kdf, args.target_time)
+        print(f"{args.kdf} parameters: {params}", file=sys.stderr)
+    if args.recipients:
+        passphrases = json.loads(_read_text(args.recipients))
+        if not isinstance(passphrases, dict) or not all(isinstance(value, str) for value in passphrases.values()):
+            raise ValueError("The recipients file must be a JSON object of recipient names to passphrases.")
+        key_package = wrap_key_for_recipients(key, passphrases, kdf=args.kdf, params=params, workers=args.workers)
+        print(f"Wrapped for {len(passphrases)} recipients.", file=sys.stderr)
+    else:
+        key_package = wrap_key_with_passphrase(key, _read_passphrase(args, confirm=True), kdf=args.kdf, params=params)
+    _write_text(args.output, key_package.to_json())
+    print(f"Key fingerprint: {key_fingerprint(key)}", file=sys.stderr)
+    return 0
+
+
+def _cmd_unwrap_key(args: argparse.Namespace) -> int:
+    key = _unwrap_package_file(args.key_package, args)
+    print(key.decode())
+    if args.fingerprint:
+        print(f"Key fingerprint: {key_fingerprint(key)}", file=sys.stderr)
+    return 0
+
+
+def _cmd_rotate_key(args: argparse.Namespace) -> int:
+    old_keys = [_load_key(args)]
+    for path in args.extra_key_file:
+        with open(path, "rb") as file_handle:
+            old_keys.append(file_handle.read().strip())
+    new_key = _load_new_key(args)
+    if "-" in args.paths:
+        raise ValueError("Keys are rotated in place, so '-' (stdin) is not supported.")
+    paths = [task.source for task in collect_tasks(args.paths, False, None)]
+    stats = RotationStats(len(paths))
+    last_report = 0.0
+
+    def report(result) -> None:
+        nonlocal last_report
+        stats.add(result)
+        if result.status == FAILED:
+            print(f"failed: {result.path}: {result.error}", file=sys.stderr)
+        # At most one progress line a second, plus the last one.
+        now = time.perf_counter()
+        if now - last_report >= 1.0 or stats.done == stats.total:
+            last_report = now
+            print(stats.line(), file=sys.stderr)
+
+    rotate_files(paths, new_key, old_keys, args.journal, args.workers, not args.threads, report)
+    failed = stats.counts[FAILED]
+    _print_summary(stats.done - failed - stats.counts[SKIPPED], failed, stats.bytes, stats.elapsed)
+    return 1 if failed else 0
+
+
+def _cmd_watch(args: argparse.Namespace) -> int:
+    key = _load_key(args)
+    watcher = FolderWatcher(
+        args.input_dir,
+        args.output_dir,
+        key,
+        args.processed_dir,
+        args.failed_dir,
+        args.workers,
+        not args.threads,
+        args.queue_size,
+        args.poll_interval,
+        args.settle,
+        args.chunk_size,
+        args.compress,
+        args.level,
+        args.cipher,
+        ENCRYPTED_SUFFIX,
+        args.force,
+    )
+    signals = 0
+
+    def stop(*_) -> None:
+        # The first Ctrl-C or SIGTERM drains the queue; a second one leaves queued files in staging.
+        nonlocal signals
+        signals += 1
+        watcher.stop(drain=signals == 1)
+        if signals == 1:
+            print("stopping: finishing queued files (signal again to leave them in staging)", file=sys.stderr)
+
+    def report(stats) -> None:
+        print(stats.line(), file=sys.stderr)
+        if args.metrics:
+            METRICS.write(args.metrics)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    print(f"watching {watcher.input_dir} -> {watcher.output_dir}", file=sys.stderr)
+    stats = watcher.run(report, args.status_interval)
+    _print_summary(stats.encrypted, stats.failed, stats.bytes, stats.elapsed)
+    return 1 if stats.failed else 0
+
+
+def _cmd_archive(args: argparse.Namespace) -> int:
+    key = _load_key(args)
+    output = args.output or os.path.normpath(args.directory) + ARCHIVE_SUFFIX
+    if os.path.exists(output) and not args.force:
+        raise ValueError(f"{output} exists (use --force to overwrite).")
+    started = time.perf_counter()
+    members = create_archive(
+        args.directory, output, key, args.chunk_size, compression=args.compress, level=args.level, cipher=args.cipher
+    )
+    _print_summary(len(members), 0, sum(member.size for member in members), time.perf_counter() - started)
+    return 0
+
+
+def _cmd_archive_list(args: argparse.Namespace) -> int:
+    with ArchiveReader(args.archive, _load_key(args)) as reader:
+        for member in reader.members:
+            print(f"{member.size:>14}  {time.strftime('%Y-%m-%d %H:%M', time.localtime(member.mtime))}  {member.name}")
+    return 0
+
+
+def _cmd_archive_extract(args: argparse.Namespace) -> int:
+    started = time.perf_counter()
+    with ArchiveReader(args.archive, _load_key(args)) as reader:
+        members = reader.extract_all(args.output_dir, args.members or None)
+    _print_summary(len(members), 0, sum(member.size for member in members), time.perf_counter() - started)
+    return 0
+
+
+def _cmd_delta(args: argparse.Namespace) -> int:
+    key = _load_key(args)
+    started = time.perf_counter()
+    # Written under a temporary name first, since the version is only known once the manifest is read.
+    output = args.output or f"{args.file}.next{DELTA_SUFFIX}"
+    stats = encrypt_delta(args.file, args.manifest, output, key, compression=args.compress, level=args.level)
+    if args.output is None:
+        final = f"{args.file}.v{stats.version}{DELTA_SUFFIX}"
+        os.replace(output, final)
+        output = final
+    print(
+        f"{output}: version {stats.version}, {stats.changed_chunks}/{stats.chunks} chunks changed "
+        f"({stats.changed_bytes} of {stats.size} bytes), delta {stats.delta_bytes} bytes",
+        file=sys.stderr,
+    )
+    _print_summary(1, 0, stats.size, time.perf_counter() - started)
+    return 0
+
+
+def _cmd_apply_delta(args: argparse.Namespace) -> int:
+    key = _load_key(args)
+    started = time.perf_counter()
+    size = apply_delta(args.delta, args.base, args.output, key)
+    _print_summary(1, 0, size, time.perf_counter() - started)
+    return 0
+
+
+def _cmd_agent(args: argparse.Namespace) -> int:
+    path = args.socket or default_agent_socket()
+    # SIGTERM takes the same exit path as Ctrl-C so keys are wiped and the socket removed.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"{AGENT_SOCKET_ENV}={path}", file=sys.stderr)
+    try:
+        serve_agent(path)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def _cmd_agent_add(args: argparse.Namespace) -> int:
+    key = _load_key(args)
+    with KeyAgentClient(args.socket) as client:
+        fingerprint = client.add_key(key, args.lifetime or None)
+    print(f"Key fingerprint: {fingerprint}", file=sys.stderr)
+    return 0
+
+
+def _cmd_agent_list(args: argparse.Namespace) -> int:
+    with KeyAgentClient(args.socket) as client:
+        for key in client.list_keys():
+            lifetime = "no expiry" if key.expires_in is None else f"expires in {key.expires_in:.0f}s"
+            print(f"{key.fingerprint}  ({lifetime})")
+    return 0
+
+
+def _cmd_agent_remove(args: argparse.Namespace) -> int:
+    with KeyAgentClient(args.socket) as client:
+        if args.all:
+            print(f"Removed {client.remove_all()} key(s).", file=sys.stderr)
+            return 0
+        if not client.remove_key(args.fingerprint):
+            print(f"error: the agent holds no key with fingerprint {args.fingerprint}", file=sys.stderr)
+            return 1
+    return 0
+
+
+def _add_socket_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--socket", help=f"Key agent socket (default: ${AGENT_SOCKET_ENV} or a per-user path).")
+
+
+def _add_key_arguments(parser: argparse.ArgumentParser, allow_package: bool = True, allow_agent: bool = False) -> None:
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--key-file", help="File containing the Fernet key.")
+    source.add_argument("--key-env", help="Environment variable holding the Fernet key.")
+    if allow_package:
+        source.add_argument("--key-package", help="Key package JSON file; the passphrase is requested separately.")
+        _add_recipient_argument(parser)
+    if allow_agent:
+        source.add_argument(
+            "--agent", metavar="FINGERPRINT", help="Use this key from the running key agent (see agent-add)."
+        )
+
+
+def _add_recipient_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--recipient", help="Your name in a multi-recipient key package (skips trying every slot).")
+
+
+def _add_passphrase_arguments(parser: argparse.ArgumentParser) -> None:
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--passphrase-env", help="Environment variable holding the passphrase.")
+    source.add_argument("--passphrase-file", help="File whose first line is the passphrase.")
+
+
+def _load_key(args: argparse.Namespace) -> bytes:
+    if args.key_file:
+        with open(args.key_file, "rb") as file_handle:
+            return file_handle.read().strip()
+    if args.key_env:
+        value = os.environ.get(args.key_env)
+        if not value:
+            raise ValueError(f"Environment variable {args.key_env} is not set.")
+        return value.strip().encode()
+    return _unwrap_package_file(args.key_package, args)
+
+
+def _load_new_key(args: argparse.Namespace) -> bytes:
+    if args.new_key_file:
+        with open(args.new_key_file, "rb") as file_handle:
+            return file_handle.read().strip()
+    value = os.environ.get(args.new_key_env)
+    if not value:
+        raise ValueError(f"Environment variable {args.new_key_env} is not set.")
+    return value.strip().encode()
+
+
+def _unwrap_package_file(path: str, args: argparse.Namespace) -> bytes:
+    raw_package = sys.stdin.read() if path == "-" else _read_text(path)
+    key_package = parse_key_package(raw_package)
+    return unwrap_key_with_passphrase(key_package, _read_passphrase(args), recipient=args.recipient)
+
+
+def _read_passphrase(args: argparse.Namespace, confirm: bool = False) -> str:
+    if args.passphrase_env:
+        passphrase = os.environ.get(args.passphrase_env, "")
+    elif args.passphrase_file:
+        lines = _read_text(args.passphrase_file).splitlines()
+        passphrase = lines[0] if lines else ""
+    else:
+        passphrase = getpass.getpass("Passphrase: ")
+        if confirm and getpass.getpass("Confirm passphrase: ") != passphrase:
+            raise ValueError("Passphrases do not match.")
+    passphrase = passphrase.strip()
+    if not passphrase:
+        raise ValueError("A passphrase is required.")
+    return passphrase
+
+
+def _output_path(source: str, encrypting: bool, output_dir: str | None, root: str | None) -> str:
+    if encrypting:
+        name = source + ENCRYPTED_SUFFIX
+    elif source.endswith(ENCRYPTED_SUFFIX):
+        name = source[: -len(ENCRYPTED_SUFFIX)]
+    else:
+        name = source + DECRYPTED_SUFFIX
+    if output_dir is None:
+        return name
+    relative = os.path.relpath(name, root) if root is not None else os.path.basename(name)
+    return os.path.join(output_dir, relative)
+
+
+def _make_pool(workers: int, use_processes: bool) -> Executor:
+    if use_processes and workers > 1:
+        # Forked workers start with a copy of this process's metrics; clear it
+        # so each worker only ships back what it measured itself.
+        return ProcessPoolExecutor(max_workers=workers, initializer=METRICS.reset)
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def _with_metrics(function, *args):
+    # Runs in a worker process: the task's metrics travel back with its result, or on its exception.
+    try:
+        result = function(*args)
+    except Exception as exc:
+        exc.metrics = METRICS.drain()
+        raise
+    return result, METRICS.drain()
+
+
+def _pooled_result(future: Future, pooled: bool):
+    try:
+        result = future.result()
+    except Exception as exc:
+        if pooled and hasattr(exc, "metrics"):
+            METRICS.merge(exc.metrics)
+        raise
+    if not pooled:
+        return result
+    result, snapshot = result
+    METRICS.merge(snapshot)
+    return result
+
+
+def _process_stream(
+    source: BinaryIO,
+    destination: BinaryIO,
+    key: bytes | AgentKeyRef,
+    encrypting: bool,
+    chunk_size: int,
+    compression: str | None,
+    level: int,
+    cipher: str = DEFAULT_CIPHER,
+) -> int:
+    if isinstance(key, AgentKeyRef):
+        with KeyAgentClient(key.socket) as client:
+            if encrypting:
+                return client.encrypt_stream(
+                    key.fingerprint, source, destination, chunk_size, compression, level, cipher
+                )
+            return client.decrypt_stream(key.fingerprint, source, destination)
+    if encrypting:
+        return encrypt_stream(source, destination, key, chunk_size, compression=compression, level=level, cipher=cipher)
+    return decrypt_stream(source, destination, key)
+
+
+def _process_file(
+    source: str,
+    destination: str,
+    key: bytes | AgentKeyRef,
+    encrypting: bool,
+    chunk_size: int,
+    compression: str | None,
+    level: int,
+    cipher: str = DEFAULT_CIPHER,
+    resume: bool = False,
+) -> int:
+    os.makedirs(os.path.dirname(os.path.abspath(destination)), exist_ok=True)
+    if isinstance(key, AgentKeyRef):
+        # Each worker has its own connection; the agent serves them in parallel.
+        with KeyAgentClient(key.socket) as client:
+            if encrypting:
+                client.encrypt_file(key.fingerprint, source, destination, chunk_size, compression, level, cipher)
+            else:
+                client.decrypt_file(key.fingerprint, source, destination)
+    elif resume and encrypting:
+        encrypt_file_resumable(source, destination, key, chunk_size, compression=compression, level=level, cipher=cipher)
+    elif resume:
+        decrypt_file_resumable(source, destination, key)
+    elif encrypting:
+        encrypt_file(source, destination, key, chunk_size, compression=compression, level=level, cipher=cipher)
+    else:
+        decrypt_file(source, destination, key)
+    return os.path.getsize(source)
+
+
+def _verify_one(path: str, key: bytes) -> dict:
+    # Report entries are plain dicts so they pickle back from worker processes.
+    entry = {"path": path, "ok": False, "format": None, "chunks": 0, "size": 0, "plaintext_size": None, "error": None}
+    try:
+        if path == "-":
+            result = verify_stream(sys.stdin.buffer, key)
+        else:
+            result = verify_file(path, key)
+    except InvalidToken:
+        entry["error"] = "authentication failed: wrong key, or the data is corrupted"
+    except (OSError, ValueError) as exc:
+        entry["error"] = str(exc) or type(exc).__name__
+    else:
+        entry.update(
+            ok=True,
+            format="legacy" if result.version == 0 else f"chunked v{result.version}",
+            chunks=result.chunks,
+            size=result.size,
+            plaintext_size=result.plaintext_size,
+        )
+    if path != "-" and os.path.isfile(path):
+        entry["size"] = os.path.getsize(path)
+    return entry
+
+
+def _print_summary(succeeded: int, failed: int, processed: int, elapsed: float) -> None:
+    elapsed = max(elapsed, 1e-9)
+    print(
+        f"{succeeded} file(s) ok, {failed} failed, {processed / 1_000_000:.1f} MB in {elapsed:.2f}s "
+        f"({succeeded / elapsed:.1f} files/s, {processed / 1_000_000 / elapsed:.1f} MB/s)",
+        file=sys.stderr,
+    )
+
+
+def _read_text(path: str) -> str:
+    with open(path, encoding="utf-8") as file_handle:
+        return file_handle.read()
+
+
+def _write_text(path: str | None, text: str) -> None:
+    if path is None:
+        print(text)
+        return
+    with open(path, "w", encoding="utf-8") as file_handle:
+        file_handle.write(text + "\n")
@@ -1,33 +1,116 @@
 import base64
+import binascii
 import hashlib
+import hmac
+import io
 import json
+import mmap
 import os
-from dataclasses import dataclass
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import BinaryIO, Callable, Iterable, Iterator
 
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.fernet import Fernet, InvalidToken
+
+from src.metrics import METRICS
 
 PBKDF2_ITERATIONS = 200_000
 SALT_BYTES = 16
 
+KDF_PBKDF2 = "PBKDF2HMAC-SHA256"
+KDF_SCRYPT = "scrypt"
+KDF_ARGON2ID = "argon2id"
+KDF_TARGET_SECONDS = 0.5
+KDF_MAX_MEMORY = 1024 * 1024 * 1024
+_KDF_CALIBRATION_ROUNDS = 6
+_RECIPIENT_HINT_LENGTH = 8
+
+CIPHER_CACHE_SIZE = 32
+DERIVED_KEY_CACHE_TTL = 300.0
+DERIVED_KEY_CACHE_SIZE = 16
+
+STREAM_MAGIC = b"SHFC"
+STREAM_VERSION = 4
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+COMPRESSION_ALGORITHMS = ("zlib", "lzma")
+DEFAULT_COMPRESSION_LEVEL = 6
+CIPHERS = ("fernet", "aes-256-gcm", "chacha20-poly1305")
+DEFAULT_CIPHER = "fernet"
+
+# Container layout: header, then one length-prefixed Fernet token per chunk.
+# Every chunk plaintext carries the header digest, its index and an
+# end-of-stream flag, so chunks cannot be reordered, dropped, truncated
+# or spliced in from another file without decryption failing.
+# Version 2 appends an index trailer: an empty record marking the end of
+# the chunks, an encrypted table of chunk offsets, and a fixed-size footer
+# pointing back at that table so readers can seek straight to any chunk.
+# Version 3 gives the header flags meaning: the low bits name the codec
+# each chunk was compressed with before encryption (0 = none).
+# Version 4 uses the next two bits to name the chunk cipher (0 = Fernet).
+# AEAD chunks are a random 12-byte nonce, the ciphertext and a 16-byte tag,
+# with the header as associated data, under a key derived by HKDF from the
+# Fernet key and the header. Fernet streams are still written as version 3
+# so older releases can read them.
+_STREAM_HEADER = struct.Struct(">4sBBI16s")
+_RECORD_LENGTH = struct.Struct(">I")
+_CHUNK_PREFIX = struct.Struct(">16sQ?")
+_INDEX_MAGIC = b"SHFI"
+_INDEX_PREFIX = struct.Struct(">4s16sQQ")
+_STREAM_FOOTER = struct.Struct(">Q4s")
+_MAX_INDEX_TOKEN_LENGTH = 1 << 30
+_COMPRESSION_IDS = {name: codec for codec, name in enumerate(COMPRESSION_ALGORITHMS, start=1)}
+_COMPRESSION_MASK = 0x0F
+_CIPHER_IDS = {name: cipher for cipher, name in enumerate(CIPHERS)}
+_CIPHER_SHIFT = 4
+_CIPHER_MASK = 0x30
+_AEAD_NONCE_BYTES = 12
+_AEAD_TAG_BYTES = 16
+_URLSAFE_TO_STANDARD = bytes.maketrans(b"-_", b"+/")
+
+_cipher_cache: "OrderedDict[bytes, Fernet]" = OrderedDict()
+_cipher_cache_lock = threading.Lock()
+
+
+ProgressCallback = Callable[[int], None]
+
+
+class OperationCancelled(Exception):
+    pass
+
+
+def _timed(operation: str, **labels: str):
+    return METRICS.timed(operation, (OperationCancelled,), **labels)
+
+
+def _measure(operation: str, **labels: str):
+    return METRICS.measure(operation, (OperationCancelled,), **labels)
+
 
 @dataclass
 class KeyPackage:
     wrapped_key: str
     salt: str
     iterations: int = PBKDF2_ITERATIONS
-    kdf: str = "PBKDF2HMAC-SHA256"
+    kdf: str = KDF_PBKDF2
+    # Cost parameters of every KDF other than PBKDF2, whose single
+    # parameter keeps its original top-level "iterations" field.
+    params: dict[str, int] = field(default_factory=dict)
 
     def to_json(self) -> str:
-        return json.dumps(
-            {
-                "wrapped_key": self.wrapped_key,
-                "salt": self.salt,
-                "iterations": self.iterations,
-                "kdf": self.kdf,
-            }
-        )
+        data = {"wrapped_key": self.wrapped_key, "salt": self.salt}
+        if self.kdf == KDF_PBKDF2:
+            data["iterations"] = self.iterations
+        data["kdf"] = self.kdf
+        if self.kdf != KDF_PBKDF2:
+            data["params"] = self.params
+        return json.dumps(data)
 
     @staticmethod
     def from_json(raw: str) -> "KeyPackage":
@@ -36,34 +119,424 @@ class KeyPackage:
             wrapped_key=data["wrapped_key"],
             salt=data["salt"],
             iterations=int(data.get("iterations", PBKDF2_ITERATIONS)),
-            kdf=data.get("kdf", "PBKDF2HMAC-SHA256"),
+            kdf=data.get("kdf", KDF_PBKDF2),
+            params={name: int(value) for name, value in data.get("params", {}).items()},
+        )
+
+    def kdf_params(self) -> dict[str, int]:
+        return {"iterations": self.iterations} if self.kdf == KDF_PBKDF2 else dict(self.params)
+
+
+@dataclass
+class MultiKeyPackage:
+    """One data key wrapped separately for each recipient's passphrase.
+
+    `recipients` maps each recipient's hint (a short keyed hash of their
+    name, see recipient_hint) to their own KeyPackage, so unwrapping runs
+    one KDF instead of trying every slot. The hints hide the recipient list
+    from anyone who cannot guess the names, and say nothing about passphrases.
+    """
+
+    hint_salt: str
+    recipients: dict[str, KeyPackage]
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "hint_salt": self.hint_salt,
+                "recipients": {hint: json.loads(package.to_json()) for hint, package in self.recipients.items()},
+            }
+        )
+
+    @staticmethod
+    def from_json(raw: str) -> "MultiKeyPackage":
+        data = json.loads(raw)
+        return MultiKeyPackage(
+            hint_salt=data["hint_salt"],
+            recipients={
+                hint: KeyPackage.from_json(json.dumps(package)) for hint, package in data["recipients"].items()
+            },
         )
 
+    def recipient_hint(self, recipient: str) -> str:
+        return _recipient_hint(base64.urlsafe_b64decode(self.hint_salt.encode()), recipient)
+
+    def package_for(self, recipient: str) -> KeyPackage:
+        try:
+            return self.recipients[self.recipient_hint(recipient)]
+        except KeyError:
+            raise ValueError(f"This key package has no slot for recipient {recipient!r}.") from None
+
+
+@dataclass(frozen=True)
+class _Kdf:
+    # Calibration starts from `minimum` and `scale` returns parameters costing
+    # about `factor` times as much within `max_memory` bytes; `probe` is the
+    # cheapest valid set, used to check that the backend supports the KDF.
+    name: str
+    minimum: dict[str, int]
+    defaults: dict[str, int]
+    probe: dict[str, int]
+    derive: Callable[[bytes, bytes, dict[str, int]], bytes]
+    memory: Callable[[dict[str, int]], int]
+    scale: Callable[[dict[str, int], float, dict[str, int], int], dict[str, int]]
+
+
+@dataclass(frozen=True)
+class _StreamHeader:
+    raw: bytes
+    version: int
+    compression: int
+    chunk_size: int
+    digest: bytes
+    cipher: int = 0
+
+
+class _AeadSuite:
+    # Seals and opens whole tokens like a Fernet object, so the container
+    # code does not care which cipher a stream uses.
+
+    def __init__(self, aead, associated_data: bytes) -> None:
+        self._aead = aead
+        self._associated_data = associated_data
+
+    def encrypt(self, data: bytes) -> bytes:
+        nonce = os.urandom(_AEAD_NONCE_BYTES)
+        return nonce + self._aead.encrypt(nonce, data, self._associated_data)
+
+    def decrypt(self, token: bytes) -> bytes:
+        from cryptography.exceptions import InvalidTag
+
+        try:
+            return self._aead.decrypt(token[:_AEAD_NONCE_BYTES], token[_AEAD_NONCE_BYTES:], self._associated_data)
+        except (InvalidTag, ValueError):
+            raise InvalidToken from None
+
+
+_ChunkCipher = Fernet | _AeadSuite
+
+
+@dataclass
+class VerifyResult:
+    # version is 0 for legacy single-token files; size counts the header
+    # and chunk records; plaintext_size is only known from an index trailer.
+    version: int
+    chunks: int
+    size: int
+    plaintext_size: int | None = None
+
+
+@dataclass
+class BatchResult:
+    index: int
+    value: bytes | None = None
+    error: Exception | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
 
+
+class DerivedKeyCache:
+    """Opt-in cache of passphrase-derived wrapping keys.
+
+    Entries are keyed by (salt, kdf, kdf parameters, passphrase digest). The
+    passphrase itself is never stored: it is reduced to an HMAC under a
+    per-cache random secret. Derived keys live in bytearrays that are
+    zeroed when they expire, are evicted, or the cache is cleared.
+    """
+
+    def __init__(self, ttl: float = DERIVED_KEY_CACHE_TTL, max_entries: int = DERIVED_KEY_CACHE_SIZE) -> None:
+        if ttl <= 0 or max_entries < 1:
+            raise ValueError("Cache TTL and size must be positive.")
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._secret = os.urandom(32)
+        self._entries: "OrderedDict[tuple, tuple[float, bytearray]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._expire(time.monotonic())
+            return len(self._entries)
+
+    def get(self, salt: bytes, kdf: str, params: dict[str, int], passphrase: str) -> bytes | None:
+        cache_key = self._cache_key(salt, kdf, params, passphrase)
+        with self._lock:
+            self._expire(time.monotonic())
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(cache_key)
+            return bytes(entry[1])
+
+    def put(self, salt: bytes, kdf: str, params: dict[str, int], passphrase: str, derived_key: bytes) -> None:
+        cache_key = self._cache_key(salt, kdf, params, passphrase)
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            previous = self._entries.pop(cache_key, None)
+            if previous is not None:
+                _wipe(previous[1])
+            self._entries[cache_key] = (now + self.ttl, bytearray(derived_key))
+            while len(self._entries) > self.max_entries:
+                _wipe(self._entries.popitem(last=False)[1][1])
+
+    def clear(self) -> None:
+        with self._lock:
+            for _, derived_key in self._entries.values():
+                _wipe(derived_key)
+            self._entries.clear()
+
+    def _cache_key(self, salt: bytes, kdf: str, params: dict[str, int], passphrase: str) -> tuple:
+        digest = hmac.new(self._secret, passphrase.encode(), hashlib.sha256).digest()
+        return salt, kdf, tuple(sorted(params.items())), digest
+
+    def _expire(self, now: float) -> None:
+        expired = [cache_key for cache_key, (expires, _) in self._entries.items() if expires <= now]
+        for cache_key in expired:
+            _wipe(self._entries.pop(cache_key)[1])
+
+
+@_timed("key.generate")
 def generate_key() -> bytes:
     return Fernet.generate_key()
 
 
 def encrypt_text(plain_text: str, key: bytes) -> str:
-    cipher_suite = Fernet(key)
-    token = cipher_suite.encrypt(plain_text.encode())
+    with _measure("encrypt", api="text") as measurement:
+        cipher_suite = _cipher_for(key)
+        payload = plain_text.encode()
+        measurement.size = len(payload)
+        token = cipher_suite.encrypt(payload)
     return token.decode()
 
 
 def decrypt_text(token: str, key: bytes) -> str:
-    cipher_suite = Fernet(key)
-    plain_text = cipher_suite.decrypt(token.encode())
+    with _measure("decrypt", api="text") as measurement:
+        cipher_suite = _cipher_for(key)
+        plain_text = cipher_suite.decrypt(token.encode())
+        measurement.size = len(plain_text)
     return plain_text.decode()
 
 
-def encrypt_bytes(payload: bytes, key: bytes) -> bytes:
-    cipher_suite = Fernet(key)
-    return cipher_suite.encrypt(payload)
+def encrypt_bytes(
+    payload: bytes,
+    key: bytes,
+    compression: str | None = None,
+    level: int = DEFAULT_COMPRESSION_LEVEL,
+    cipher: str = DEFAULT_CIPHER,
+) -> bytes:
+    if compression is not None or cipher != DEFAULT_CIPHER:
+        # A plain Fernet token has nowhere to record the codec or cipher, so
+        # those payloads use the chunked container; decrypt_bytes detects it.
+        destination = io.BytesIO()
+        encrypt_stream(io.BytesIO(payload), destination, key, compression=compression, level=level, cipher=cipher)
+        return destination.getvalue()
+    with _measure("encrypt", api="token") as measurement:
+        measurement.size = len(payload)
+        return _cipher_for(key).encrypt(payload)
 
 
 def decrypt_bytes(token: bytes, key: bytes) -> bytes:
-    cipher_suite = Fernet(key)
-    return cipher_suite.decrypt(token)
+    if token.startswith(STREAM_MAGIC):
+        destination = io.BytesIO()
+        decrypt_stream(io.BytesIO(token), destination, key)
+        return destination.getvalue()
+    with _measure("decrypt", api="token") as measurement:
+        payload = _cipher_for(key).decrypt(token)
+        measurement.size = len(payload)
+    return payload
+
+
+def encrypt_many(payloads: Iterable[bytes | str], key: bytes) -> list[BatchResult]:
+    return _encrypt_all(_cipher_for(key), payloads)
+
+
+def decrypt_many(tokens: Iterable[bytes | str], key: bytes) -> list[BatchResult]:
+    return _decrypt_all(_cipher_for(key), tokens)
+
+
+def clear_cipher_cache() -> None:
+    with _cipher_cache_lock:
+        _cipher_cache.clear()
+
+
+@_timed("encrypt", api="stream")
+def encrypt_stream(
+    source: BinaryIO,
+    destination: BinaryIO,
+    key: bytes,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    progress: ProgressCallback | None = None,
+    compression: str | None = None,
+    level: int = DEFAULT_COMPRESSION_LEVEL,
+    cipher: str = DEFAULT_CIPHER,
+) -> int:
+    header = _new_stream_header(chunk_size, compression, level, cipher)
+    cipher_suite = _stream_cipher(key, header)
+    destination.write(header.raw)
+
+    total = 0
+    position = len(header.raw)
+    offsets = []
+    for index, final, chunk in _iter_plain_chunks(source, chunk_size):
+        offsets.append(position)
+        position += _write_record(destination, _seal_chunk(cipher_suite, header, index, final, chunk, level))
+        total += len(chunk)
+        if progress is not None:
+            progress(total)
+    _write_index_trailer(destination, cipher_suite, header.digest, offsets, total, position)
+    return total
+
+
+@_timed("decrypt", api="stream")
+def decrypt_stream(
+    source: BinaryIO,
+    destination: BinaryIO,
+    key: bytes,
+    progress: ProgressCallback | None = None,
+) -> int:
+    cipher_suite = _cipher_for(key)
+    magic = _read_exact(source, len(STREAM_MAGIC))
+    if magic != STREAM_MAGIC:
+        return _decrypt_legacy_stream(cipher_suite, magic, source, destination, progress)
+
+    header = _read_stream_header(source, magic)
+    cipher_suite = _stream_cipher(key, header)
+    tokens = _iter_tokens(source, header)
+
+    total = 0
+    position = len(header.raw)
+    offsets = []
+    for index, token in enumerate(tokens):
+        chunk, final = _open_chunk(cipher_suite, header, index, token)
+        destination.write(chunk)
+        total += len(chunk)
+        offsets.append(position)
+        position += _RECORD_LENGTH.size + len(token)
+        if progress is not None:
+            progress(position)
+        if final:
+            if next(tokens, None) is not None:
+                raise ValueError("Unexpected data after the final encrypted chunk.")
+            if header.version >= 2:
+                _check_index_trailer(source, cipher_suite, header.digest, offsets, total, position)
+            elif source.read(1):
+                raise ValueError("Unexpected data after the final encrypted chunk.")
+            return total
+    raise ValueError("Encrypted stream is truncated.")
+
+
+def verify_stream(source: BinaryIO, key: bytes, progress: ProgressCallback | None = None) -> VerifyResult:
+    """Check every chunk's HMAC and the container structure without decrypting chunk contents.
+
+    Catches corruption, truncation and dropped or inserted chunks. Chunk
+    order is only bound inside the encrypted chunks, so swapping two
+    same-sized chunks of one file still takes a full decrypt to detect.
+    AEAD chunks have no separate MAC, so they are decrypted and discarded.
+    """
+    with _measure("verify") as measurement:
+        result = _verify_stream(source, key, progress)
+        measurement.size = result.size
+    return result
+
+
+def _verify_stream(source: BinaryIO, key: bytes, progress: ProgressCallback | None) -> VerifyResult:
+    cipher_suite = _cipher_for(key)
+    magic = _read_exact(source, len(STREAM_MAGIC))
+    if magic != STREAM_MAGIC:
+        return _verify_legacy_stream(key, magic, source, progress)
+
+    header = _read_stream_header(source, magic)
+    cipher_suite = _stream_cipher(key, header)
+    check = cipher_suite.extract_timestamp if header.cipher == 0 else cipher_suite.decrypt
+    position = len(header.raw)
+    offsets = []
+    for token in _iter_tokens(source, header):
+        check(token)
+        offsets.append(position)
+        position += _RECORD_LENGTH.size + len(token)
+        if progress is not None:
+            progress(position)
+    if not offsets:
+        raise ValueError("Encrypted stream is truncated.")
+    result = VerifyResult(header.version, len(offsets), position)
+    if header.version >= 2:
+        # The index is one small token; decrypting it proves no chunk was dropped or added.
+        index_offsets, total = _read_index_trailer(source, cipher_suite, header.digest, position)
+        chunk_size = header.chunk_size
+        if index_offsets != tuple(offsets) or not (len(offsets) - 1) * chunk_size <= total <= len(offsets) * chunk_size:
+            raise ValueError("Encrypted stream index does not match its chunks.")
+        result.plaintext_size = total
+    return result
+
+
+def verify_file(
+    path: str,
+    key: bytes,
+    progress: ProgressCallback | None = None,
+    cancel: threading.Event | None = None,
+) -> VerifyResult:
+    with open(path, "rb") as raw_source, METRICS.timed_io(raw_source) as source:
+        return verify_stream(source, key, _cancellable(progress, cancel))
+
+
+def encrypt_file(
+    source_path: str | BinaryIO,
+    destination_path: str,
+    key: bytes,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    progress: ProgressCallback | None = None,
+    cancel: threading.Event | None = None,
+    compression: str | None = None,
+    level: int = DEFAULT_COMPRESSION_LEVEL,
+    cipher: str = DEFAULT_CIPHER,
+) -> int:
+    # A binary stream can stand in for the source path; it is read from its current position and left open.
+    with (
+        open(source_path, "rb") if isinstance(source_path, str) else nullcontext(source_path) as raw_source,
+        _atomic_output(destination_path) as raw_destination,
+        METRICS.timed_io(raw_source) as source,
+        METRICS.timed_io(raw_destination) as destination,
+    ):
+        return encrypt_stream(
+            source, destination, key, chunk_size, _cancellable(progress, cancel), compression, level, cipher
+        )
+
+
+def decrypt_file(
+    source_path: str,
+    destination_path: str,
+    key: bytes,
+    progress: ProgressCallback | None = None,
+    cancel: threading.Event | None = None,
+) -> int:
+    with (
+        open(source_path, "rb") as raw_source,
+        _atomic_output(destination_path) as raw_destination,
+        METRICS.timed_io(raw_source) as source,
+        METRICS.timed_io(raw_destination) as destination,
+    ):
+        return decrypt_stream(source, destination, key, _cancellable(progress, cancel))
+
+
+def decrypt_range(path: str, offset: int, length: int, key: bytes) -> bytes:
+    if offset < 0 or length < 0:
+        raise ValueError("Offset and length must not be negative.")
+    with (
+        _measure("decrypt", api="range") as measurement,
+        open(path, "rb") as file_handle,
+        mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as view,
+    ):
+        header, cipher_suite, offsets, total = _open_random_access(view, key)
+        payload = b"".join(_iter_range(view, cipher_suite, header, offsets, total, offset, length))
+        measurement.size = len(payload)
+    return payload
 
 
 def key_fingerprint(key: bytes) -> str:
@@ -71,29 +544,745 @@ def key_fingerprint(key: bytes) -> str:
     return " ".join(digest[i : i + 4] for i in range(0, len(digest), 4))
 
 
-def wrap_key_with_passphrase(key: bytes, passphrase: str) -> KeyPackage:
+def wrap_key_with_passphrase(
+    key: bytes,
+    passphrase: str,
+    iterations: int = PBKDF2_ITERATIONS,
+    kdf: str = KDF_PBKDF2,
+    params: dict[str, int] | None = None,
+) -> KeyPackage:
+    params = _wrap_params(kdf, iterations, params)
     salt = os.urandom(SALT_BYTES)
-    derived_key = _derive_key(passphrase, salt)
+    derived_key = _derive_key(passphrase, salt, kdf, params)
     wrapper = Fernet(derived_key)
     wrapped_key = wrapper.encrypt(key).decode()
     return KeyPackage(
         wrapped_key=wrapped_key,
         salt=base64.urlsafe_b64encode(salt).decode(),
+        iterations=params["iterations"] if kdf == KDF_PBKDF2 else PBKDF2_ITERATIONS,
+        kdf=kdf,
+        params={} if kdf == KDF_PBKDF2 else dict(params),
+    )
+
+
+def wrap_key_for_recipients(
+    key: bytes,
+    passphrases: dict[str, str],
+    iterations: int = PBKDF2_ITERATIONS,
+    kdf: str = KDF_PBKDF2,
+    params: dict[str, int] | None = None,
+    workers: int | None = None,
+    use_processes: bool = False,
+) -> MultiKeyPackage:
+    """Wrap `key` once per recipient ({name: passphrase}), deriving the wrapping keys in parallel.
+
+    Every slot gets its own salt. The KDFs release the GIL, so a thread
+    pool already uses every core. Memory-hard KDFs run only as many
+    derivations at once as fit in KDF_MAX_MEMORY.
+    """
+    if not passphrases:
+        raise ValueError("At least one recipient is required.")
+    if workers is not None and workers < 1:
+        raise ValueError("Worker count must be at least 1.")
+    if any(not passphrase for passphrase in passphrases.values()):
+        raise ValueError("Every recipient needs a passphrase.")
+    names = [_normalize_recipient(name) for name in passphrases]
+    if len(set(names)) != len(names):
+        raise ValueError("Recipient names must be unique (ignoring case and surrounding spaces).")
+    params = _wrap_params(kdf, iterations, params)
+    hint_salt = os.urandom(SALT_BYTES)
+    hints = [_recipient_hint(hint_salt, name) for name in names]
+    while len(set(hints)) != len(hints):
+        # Two names share a truncated hint; pick a new salt rather than keep ambiguous slots.
+        hint_salt = os.urandom(SALT_BYTES)
+        hints = [_recipient_hint(hint_salt, name) for name in names]
+
+    memory_limit = max(KDF_MAX_MEMORY // max(_kdf_spec(kdf).memory(params), 1), 1)
+    workers = min(workers or os.cpu_count() or 1, len(passphrases), memory_limit)
+    count = len(passphrases)
+    arguments = ([key] * count, list(passphrases.values()), [iterations] * count, [kdf] * count, [params] * count)
+    if workers == 1:
+        packages = list(map(wrap_key_with_passphrase, *arguments))
+    else:
+        executor: Executor = ProcessPoolExecutor(workers) if use_processes else ThreadPoolExecutor(workers)
+        with executor:
+            packages = list(executor.map(wrap_key_with_passphrase, *arguments))
+    return MultiKeyPackage(
+        hint_salt=base64.urlsafe_b64encode(hint_salt).decode(), recipients=dict(zip(hints, packages))
     )
 
 
-def unwrap_key_with_passphrase(key_package: KeyPackage, passphrase: str) -> bytes:
+def unwrap_key_with_passphrase(
+    key_package: KeyPackage | MultiKeyPackage,
+    passphrase: str,
+    cache: DerivedKeyCache | None = None,
+    recipient: str | None = None,
+) -> bytes:
+    if isinstance(key_package, MultiKeyPackage):
+        if recipient is not None:
+            key_package = key_package.package_for(recipient)
+        elif len(key_package.recipients) == 1:
+            (key_package,) = key_package.recipients.values()
+        else:
+            # Without a name every slot's KDF has to be tried in turn.
+            for package in key_package.recipients.values():
+                try:
+                    return unwrap_key_with_passphrase(package, passphrase, cache)
+                except InvalidToken:
+                    continue
+            raise InvalidToken
+    params = key_package.kdf_params()
+    # Checked before deriving: the parameters come from the package and
+    # could otherwise ask for more memory than the machine has.
+    _check_kdf_params(_kdf_spec(key_package.kdf), params)
     salt = base64.urlsafe_b64decode(key_package.salt.encode())
-    derived_key = _derive_key(passphrase, salt, key_package.iterations)
+    derived_key = None
+    if cache is not None:
+        derived_key = cache.get(salt, key_package.kdf, params, passphrase)
+    cached = derived_key is not None
+    if not cached:
+        derived_key = _derive_key(passphrase, salt, key_package.kdf, params)
     wrapper = Fernet(derived_key)
-    return wrapper.decrypt(key_package.wrapped_key.encode())
+    key = wrapper.decrypt(key_package.wrapped_key.encode())
+    # Only keys that actually unwrapped the package are cached.
+    if cache is not None and not cached:
+        cache.put(salt, key_package.kdf, params, passphrase, derived_key)
+    return key
+
+
+def parse_key_package(raw: str) -> KeyPackage | MultiKeyPackage:
+    """Read either key package format from its JSON."""
+    try:
+        is_multi = "recipients" in json.loads(raw)
+    except (TypeError, ValueError):
+        raise ValueError("Key package is not valid JSON.") from None
+    return MultiKeyPackage.from_json(raw) if is_multi else KeyPackage.from_json(raw)
+
+
+def available_kdfs() -> list[str]:
+    """Names of the KDFs the installed `cryptography` and OpenSSL can run, strongest first."""
+    names = []
+    for name in (KDF_ARGON2ID, KDF_SCRYPT, KDF_PBKDF2):
+        try:
+            _KDFS[name].derive(b"", bytes(SALT_BYTES), _KDFS[name].probe)
+        except (ImportError, _unsupported_algorithm()):
+            continue
+        names.append(name)
+    return names
+
+
+def calibrate_kdf(
+    kdf: str,
+    target_seconds: float = KDF_TARGET_SECONDS,
+    max_memory: int = KDF_MAX_MEMORY,
+) -> dict[str, int]:
+    """Return parameters for `kdf` that take about `target_seconds` to derive here.
 
+    Starts from the KDF's minimum parameters, which are returned unchanged
+    when even they take longer than the target, and scales up from timed
+    derivations. Memory-hard KDFs spend the budget on memory (up to
+    `max_memory` bytes) before adding passes.
+    """
+    spec = _kdf_spec(kdf)
+    if target_seconds <= 0:
+        raise ValueError("Target time must be positive.")
+    params = dict(spec.minimum)
+    elapsed = _time_derivation(spec, params)
+    # Cost is not quite linear in the parameters (memory-hard KDFs slow down
+    # as they outgrow the CPU caches), so rescale from each new measurement.
+    for _ in range(_KDF_CALIBRATION_ROUNDS):
+        factor = target_seconds / elapsed
+        if abs(factor - 1) < 0.1 or (factor < 1 and params == spec.minimum):
+            break
+        scaled = spec.scale(params, factor, spec.minimum, max_memory)
+        if scaled == params:
+            break
+        params = scaled
+        elapsed = _time_derivation(spec, params)
+    return params
+
+
+def _derive_key(passphrase: str, salt: bytes, kdf: str = KDF_PBKDF2, params: dict[str, int] | None = None) -> bytes:
+    spec = _kdf_spec(kdf)
+    with _measure("kdf.derive", kdf=kdf):
+        derived = spec.derive(passphrase.encode(), salt, spec.defaults if params is None else params)
+    return base64.urlsafe_b64encode(derived)
+
+
+def _wrap_params(kdf: str, iterations: int, params: dict[str, int] | None) -> dict[str, int]:
+    spec = _kdf_spec(kdf)
+    if kdf == KDF_PBKDF2:
+        params = {"iterations": iterations if params is None else params["iterations"]}
+    elif params is None:
+        params = dict(spec.defaults)
+    _check_kdf_params(spec, params)
+    return params
+
+
+def _normalize_recipient(recipient: str) -> str:
+    name = recipient.strip().casefold()
+    if not name:
+        raise ValueError("Recipient names must not be empty.")
+    return name
+
+
+def _recipient_hint(hint_salt: bytes, recipient: str) -> str:
+    digest = hmac.new(hint_salt, _normalize_recipient(recipient).encode(), hashlib.sha256).hexdigest()
+    return digest[:_RECIPIENT_HINT_LENGTH]
+
+
+def _kdf_spec(kdf: str) -> _Kdf:
+    try:
+        return _KDFS[kdf]
+    except KeyError:
+        raise ValueError(f"Unsupported key derivation function: {kdf}") from None
+
+
+def _check_kdf_params(spec: _Kdf, params: dict[str, int]) -> None:
+    if set(params) != set(spec.defaults):
+        raise ValueError(f"{spec.name} needs the parameters {', '.join(sorted(spec.defaults))}.")
+    if any(not isinstance(value, int) or value < 1 for value in params.values()):
+        raise ValueError(f"{spec.name} parameters must be positive integers.")
+    if spec.memory(params) > KDF_MAX_MEMORY:
+        raise ValueError(f"{spec.name} parameters need more than {KDF_MAX_MEMORY // (1024 * 1024)} MiB of memory.")
+
+
+def _time_derivation(spec: _Kdf, params: dict[str, int]) -> float:
+    started = time.perf_counter()
+    spec.derive(b"calibration passphrase", bytes(SALT_BYTES), params)
+    return max(time.perf_counter() - started, 1e-6)
+
+
+def _unsupported_algorithm() -> type[Exception]:
+    from cryptography.exceptions import UnsupportedAlgorithm
+
+    return UnsupportedAlgorithm
+
+
+# KDF modules are imported on first use to keep GUI start-up fast.
+
+
+def _derive_pbkdf2(passphrase: bytes, salt: bytes, params: dict[str, int]) -> bytes:
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
-def _derive_key(passphrase: str, salt: bytes, iterations: int = PBKDF2_ITERATIONS) -> bytes:
     kdf = PBKDF2HMAC(
         algorithm=hashes.SHA256(),
         length=32,
         salt=salt,
-        iterations=iterations,
+        iterations=params["iterations"],
+    )
+    return kdf.derive(passphrase)
+
+
+def _derive_scrypt(passphrase: bytes, salt: bytes, params: dict[str, int]) -> bytes:
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+    return Scrypt(salt=salt, length=32, n=params["n"], r=params["r"], p=params["p"]).derive(passphrase)
+
+
+def _derive_argon2id(passphrase: bytes, salt: bytes, params: dict[str, int]) -> bytes:
+    # Argon2id arrived in cryptography 44; older installs raise ImportError here.
+    from cryptography.hazmat.primitives.kdf.argon2 import Argon2id
+
+    kdf = Argon2id(
+        salt=salt,
+        length=32,
+        iterations=params["iterations"],
+        lanes=params["lanes"],
+        memory_cost=params["memory_cost"],
     )
-    return base64.urlsafe_b64encode(kdf.derive(passphrase.encode()))
+    return kdf.derive(passphrase)
+
+
+def _scale_pbkdf2(params: dict[str, int], factor: float, minimum: dict[str, int], max_memory: int) -> dict[str, int]:
+    return {"iterations": max(int(params["iterations"] * factor), minimum["iterations"])}
+
+
+def _scale_scrypt(params: dict[str, int], factor: float, minimum: dict[str, int], max_memory: int) -> dict[str, int]:
+    # Cost is proportional to n * p and memory to n; n stays a power of two.
+    work = params["n"] * params["p"] * factor
+    n = minimum["n"]
+    while n * 2 <= work and 128 * params["r"] * n * 2 <= max_memory:
+        n *= 2
+    return {"n": n, "r": params["r"], "p": max(1, int(work / n))}
+
+
+def _scale_argon2id(params: dict[str, int], factor: float, minimum: dict[str, int], max_memory: int) -> dict[str, int]:
+    # Cost is proportional to memory_cost (KiB) * iterations; memory grows first.
+    work = params["memory_cost"] * params["iterations"] * factor
+    block = 8 * params["lanes"]
+    memory_cost = int(min(work / minimum["iterations"], max_memory / 1024)) // block * block
+    memory_cost = max(memory_cost, minimum["memory_cost"])
+    iterations = max(round(work / memory_cost), minimum["iterations"])
+    return {"iterations": iterations, "lanes": params["lanes"], "memory_cost": memory_cost}
+
+
+_KDFS = {
+    KDF_PBKDF2: _Kdf(
+        name=KDF_PBKDF2,
+        minimum={"iterations": 100_000},
+        defaults={"iterations": PBKDF2_ITERATIONS},
+        probe={"iterations": 1},
+        derive=_derive_pbkdf2,
+        memory=lambda params: 0,
+        scale=_scale_pbkdf2,
+    ),
+    KDF_SCRYPT: _Kdf(
+        name=KDF_SCRYPT,
+        minimum={"n": 2**14, "r": 8, "p": 1},
+        defaults={"n": 2**15, "r": 8, "p": 1},
+        probe={"n": 2, "r": 1, "p": 1},
+        derive=_derive_scrypt,
+        memory=lambda params: 128 * params["r"] * (params["n"] + params["p"]),
+        scale=_scale_scrypt,
+    ),
+    KDF_ARGON2ID: _Kdf(
+        name=KDF_ARGON2ID,
+        minimum={"iterations": 2, "lanes": 4, "memory_cost": 19 * 1024},
+        defaults={"iterations": 3, "lanes": 4, "memory_cost": 64 * 1024},
+        probe={"iterations": 1, "lanes": 1, "memory_cost": 8},
+        derive=_derive_argon2id,
+        memory=lambda params: params["memory_cost"] * 1024,
+        scale=_scale_argon2id,
+    ),
+}
+
+
+def _wipe(buffer: bytearray) -> None:
+    buffer[:] = bytes(len(buffer))
+
+
+def _cipher_for(key: bytes | str) -> Fernet:
+    if isinstance(key, str):
+        key = key.encode()
+    cache_key = hashlib.sha256(key).digest()
+    with _cipher_cache_lock:
+        cipher_suite = _cipher_cache.get(cache_key)
+        if cipher_suite is not None:
+            _cipher_cache.move_to_end(cache_key)
+            return cipher_suite
+    cipher_suite = Fernet(key)
+    with _cipher_cache_lock:
+        _cipher_cache[cache_key] = cipher_suite
+        if len(_cipher_cache) > CIPHER_CACHE_SIZE:
+            _cipher_cache.popitem(last=False)
+    return cipher_suite
+
+
+def _encrypt_all(cipher_suite: Fernet, payloads: Iterable[bytes | str]) -> list[BatchResult]:
+    results = []
+    for index, payload in enumerate(payloads):
+        try:
+            if isinstance(payload, str):
+                payload = payload.encode()
+            results.append(BatchResult(index, value=cipher_suite.encrypt(payload)))
+        except Exception as exc:
+            results.append(BatchResult(index, error=exc))
+    return results
+
+
+def _decrypt_all(cipher_suite: Fernet, tokens: Iterable[bytes | str]) -> list[BatchResult]:
+    results = []
+    for index, token in enumerate(tokens):
+        try:
+            results.append(BatchResult(index, value=cipher_suite.decrypt(token)))
+        except Exception as exc:
+            results.append(BatchResult(index, error=exc))
+    return results
+
+
+def _check_chunk_size(chunk_size: int) -> None:
+    if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise ValueError(f"Chunk size must be between 1 and {MAX_CHUNK_SIZE} bytes.")
+
+
+def _new_stream_header(
+    chunk_size: int,
+    compression: str | None = None,
+    level: int = DEFAULT_COMPRESSION_LEVEL,
+    cipher: str = DEFAULT_CIPHER,
+) -> _StreamHeader:
+    _check_chunk_size(chunk_size)
+    if cipher not in _CIPHER_IDS:
+        raise ValueError(f"Unsupported cipher: {cipher} (choose from {', '.join(CIPHERS)})")
+    cipher_id = _CIPHER_IDS[cipher]
+    codec = 0
+    if compression is not None:
+        if compression not in _COMPRESSION_IDS:
+            raise ValueError(f"Unsupported compression: {compression} (choose from {', '.join(COMPRESSION_ALGORITHMS)})")
+        if not 0 <= level <= 9:
+            raise ValueError("Compression level must be between 0 and 9.")
+        codec = _COMPRESSION_IDS[compression]
+    version = STREAM_VERSION if cipher_id else 3
+    flags = codec | cipher_id << _CIPHER_SHIFT
+    raw = _STREAM_HEADER.pack(STREAM_MAGIC, version, flags, chunk_size, os.urandom(16))
+    return _StreamHeader(raw, version, codec, chunk_size, _header_digest(raw), cipher_id)
+
+
+def _read_stream_header(source: BinaryIO, magic: bytes) -> _StreamHeader:
+    return _parse_stream_header(magic + _read_exact(source, _STREAM_HEADER.size - len(magic)))
+
+
+def _parse_stream_header(raw: bytes) -> _StreamHeader:
+    if len(raw) != _STREAM_HEADER.size:
+        raise ValueError("Encrypted stream header is truncated.")
+    _, version, flags, chunk_size, _ = _STREAM_HEADER.unpack(raw)
+    if not 1 <= version <= STREAM_VERSION:
+        raise ValueError(f"Unsupported encrypted stream version: {version}")
+    if version < 3:
+        flags = 0
+    known = _COMPRESSION_MASK | (_CIPHER_MASK if version >= 4 else 0)
+    codec = flags & _COMPRESSION_MASK
+    cipher = (flags & _CIPHER_MASK) >> _CIPHER_SHIFT
+    if flags & ~known or codec > len(COMPRESSION_ALGORITHMS) or cipher >= len(CIPHERS):
+        raise ValueError(f"Unsupported encrypted stream flags: {flags:#04x}")
+    _check_chunk_size(chunk_size)
+    return _StreamHeader(raw, version, codec, chunk_size, _header_digest(raw), cipher)
+
+
+def _stream_cipher(key: bytes | str, header: _StreamHeader) -> _ChunkCipher:
+    cipher_suite = _cipher_for(key)
+    if not header.cipher:
+        return cipher_suite
+    # Each stream gets its own AEAD key, bound to the cipher and the header's
+    # random bytes, so random nonces are never shared across files.
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+    name = CIPHERS[header.cipher]
+    raw_key = base64.urlsafe_b64decode(key if isinstance(key, bytes) else key.encode())
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=header.raw, info=b"shareinfo-chunk-cipher:" + name.encode())
+    aead_class = AESGCM if name == "aes-256-gcm" else ChaCha20Poly1305
+    return _AeadSuite(aead_class(hkdf.derive(raw_key)), header.raw)
+
+
+def _header_digest(header: bytes) -> bytes:
+    return hashlib.sha256(header).digest()[:16]
+
+
+def _max_token_length(header: _StreamHeader) -> int:
+    body = _CHUNK_PREFIX.size + header.chunk_size
+    if header.compression:
+        # Incompressible chunks grow slightly under zlib/xz framing.
+        body += header.chunk_size // 64 + 1024
+    if header.cipher:
+        return _AEAD_NONCE_BYTES + body + _AEAD_TAG_BYTES
+    # Fernet: version + timestamp + IV + padded AES-CBC body + HMAC, base64-encoded.
+    padded = body // 16 * 16 + 16
+    return (1 + 8 + 16 + padded + 32 + 2) // 3 * 4
+
+
+def _iter_plain_chunks(source: BinaryIO, chunk_size: int) -> Iterator[tuple[int, bool, bytes]]:
+    # One chunk of lookahead tells us which chunk carries the end-of-stream flag.
+    index = 0
+    chunk = _read_exact(source, chunk_size)
+    while True:
+        next_chunk = _read_exact(source, chunk_size) if len(chunk) == chunk_size else b""
+        final = not next_chunk
+        yield index, final, chunk
+        if final:
+            return
+        chunk = next_chunk
+        index += 1
+
+
+def _iter_tokens(source: BinaryIO, header: _StreamHeader) -> Iterator[bytes]:
+    max_token_length = _max_token_length(header)
+    while True:
+        token_length = _record_length(_read_exact(source, _RECORD_LENGTH.size), max_token_length)
+        if not token_length:
+            return
+        token = _read_exact(source, token_length)
+        if len(token) != token_length:
+            raise ValueError("Encrypted stream is truncated.")
+        yield token
+
+
+def _record_length(raw_length: bytes, max_token_length: int) -> int:
+    # Zero means the chunk records are over: either EOF or the end-of-chunks marker.
+    if not raw_length:
+        return 0
+    if len(raw_length) != _RECORD_LENGTH.size:
+        raise ValueError("Encrypted stream is truncated.")
+    (token_length,) = _RECORD_LENGTH.unpack(raw_length)
+    if token_length > max_token_length:
+        raise ValueError("Encrypted stream chunk is larger than its declared chunk size.")
+    return token_length
+
+
+def _seal_chunk(
+    cipher_suite: _ChunkCipher,
+    header: _StreamHeader,
+    index: int,
+    final: bool,
+    chunk: bytes,
+    level: int = DEFAULT_COMPRESSION_LEVEL,
+) -> bytes:
+    if header.compression:
+        chunk = _compress(header.compression, chunk, level)
+    return cipher_suite.encrypt(_CHUNK_PREFIX.pack(header.digest, index, final) + chunk)
+
+
+def _open_chunk(cipher_suite: _ChunkCipher, header: _StreamHeader, index: int, token: bytes) -> tuple[bytes, bool]:
+    plain = cipher_suite.decrypt(token)
+    final = _check_chunk_prefix(plain, header, index)
+    chunk = plain[_CHUNK_PREFIX.size :]
+    if header.compression:
+        chunk = _decompress(header.compression, chunk, header.chunk_size, index)
+    if not final and len(chunk) != header.chunk_size:
+        raise ValueError(f"Encrypted stream chunk {index} has an invalid length.")
+    return chunk, final
+
+
+def _check_chunk_prefix(plain: bytes, header: _StreamHeader, index: int) -> bool:
+    # Returns the chunk's end-of-stream flag.
+    if len(plain) < _CHUNK_PREFIX.size:
+        raise ValueError(f"Encrypted stream chunk {index} is malformed.")
+    chunk_digest, chunk_index, final = _CHUNK_PREFIX.unpack_from(plain)
+    if chunk_digest != header.digest or chunk_index != index:
+        raise ValueError(f"Encrypted stream chunk {index} is out of place.")
+    return final
+
+
+def _compress(codec: int, data: bytes, level: int) -> bytes:
+    if codec == _COMPRESSION_IDS["zlib"]:
+        return zlib.compress(data, level)
+    import lzma
+
+    return lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_NONE, preset=level)
+
+
+def _decompress(codec: int, data: bytes, limit: int, index: int) -> bytes:
+    # Output is capped at the chunk size so a chunk cannot expand without bound.
+    if codec == _COMPRESSION_IDS["zlib"]:
+        decompressor = zlib.decompressobj()
+        chunk = decompressor.decompress(data, limit + 1)
+        complete = decompressor.eof and not decompressor.unconsumed_tail and not decompressor.unused_data
+    else:
+        import lzma
+
+        decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+        chunk = decompressor.decompress(data, max_length=limit + 1)
+        complete = decompressor.eof and not decompressor.unused_data
+    if not complete or len(chunk) > limit:
+        raise ValueError(f"Encrypted stream chunk {index} does not decompress to a valid chunk.")
+    return chunk
+
+
+def _decrypt_legacy_stream(
+    cipher_suite: Fernet,
+    head: bytes,
+    source: BinaryIO,
+    destination: BinaryIO,
+    progress: ProgressCallback | None = None,
+) -> int:
+    # Files written before the chunked container are a single Fernet token.
+    token = head + source.read()
+    payload = cipher_suite.decrypt(token)
+    destination.write(payload)
+    if progress is not None:
+        progress(len(token))
+    return len(payload)
+
+
+def _verify_legacy_stream(
+    key: bytes | str,
+    head: bytes,
+    source: BinaryIO,
+    progress: ProgressCallback | None = None,
+) -> VerifyResult:
+    # A legacy file is one Fernet token, so its HMAC is checked incrementally
+    # (base64 decoded in blocks, last 32 bytes held back as the tag) rather
+    # than by reading the whole file into memory.
+    signing_key = base64.urlsafe_b64decode(key.encode() if isinstance(key, str) else key)[:16]
+    mac = hmac.new(signing_key, digestmod=hashlib.sha256)
+    pending = b""
+    held = b""
+    first = b""
+    raw_size = 0
+    size = 0
+    data = head
+    try:
+        while data:
+            size += len(data)
+            pending += data.translate(_URLSAFE_TO_STANDARD, b" \t\r\n")
+            usable = len(pending) // 4 * 4
+            raw = held + binascii.a2b_base64(pending[:usable])
+            pending = pending[usable:]
+            first = first or raw[:1]
+            raw_size += len(raw) - len(held)
+            mac.update(raw[:-32])
+            held = raw[-32:]
+            if progress is not None:
+                progress(size)
+            data = source.read(DEFAULT_CHUNK_SIZE)
+    except binascii.Error:
+        raise InvalidToken from None
+    # Version byte, timestamp, IV, at least one AES block, then the HMAC.
+    if pending or first != b"\x80" or raw_size < 73 or not hmac.compare_digest(mac.digest(), held):
+        raise InvalidToken
+    return VerifyResult(0, 1, size)
+
+
+def _write_record(destination: BinaryIO, token: bytes) -> int:
+    destination.write(_RECORD_LENGTH.pack(len(token)))
+    destination.write(token)
+    return _RECORD_LENGTH.size + len(token)
+
+
+def _write_index_trailer(
+    destination: BinaryIO,
+    cipher_suite: _ChunkCipher,
+    header_digest: bytes,
+    offsets: list[int],
+    total: int,
+    position: int,
+) -> None:
+    destination.write(_RECORD_LENGTH.pack(0))
+    index_offset = position + _RECORD_LENGTH.size
+    index = _INDEX_PREFIX.pack(_INDEX_MAGIC, header_digest, len(offsets), total)
+    _write_record(destination, cipher_suite.encrypt(index + struct.pack(f">{len(offsets)}Q", *offsets)))
+    destination.write(_STREAM_FOOTER.pack(index_offset, _INDEX_MAGIC))
+
+
+def _check_index_trailer(
+    source: BinaryIO,
+    cipher_suite: _ChunkCipher,
+    header_digest: bytes,
+    offsets: list[int],
+    total: int,
+    position: int,
+) -> None:
+    if _read_index_trailer(source, cipher_suite, header_digest, position) != (tuple(offsets), total):
+        raise ValueError("Encrypted stream index does not match its chunks.")
+
+
+def _read_index_trailer(
+    source: BinaryIO,
+    cipher_suite: _ChunkCipher,
+    header_digest: bytes,
+    position: int,
+) -> tuple[tuple[int, ...], int]:
+    raw_length = _read_exact(source, _RECORD_LENGTH.size)
+    if len(raw_length) != _RECORD_LENGTH.size:
+        raise ValueError("Encrypted stream index trailer is truncated.")
+    (token_length,) = _RECORD_LENGTH.unpack(raw_length)
+    if token_length > _MAX_INDEX_TOKEN_LENGTH:
+        raise ValueError("Encrypted stream index trailer is malformed.")
+    token = _read_exact(source, token_length)
+    if len(token) != token_length:
+        raise ValueError("Encrypted stream index trailer is truncated.")
+    index = _open_index(cipher_suite, header_digest, token)
+    footer = _read_exact(source, _STREAM_FOOTER.size)
+    if footer != _STREAM_FOOTER.pack(position + _RECORD_LENGTH.size, _INDEX_MAGIC) or source.read(1):
+        raise ValueError("Encrypted stream footer is malformed.")
+    return index
+
+
+def _open_index(cipher_suite: _ChunkCipher, header_digest: bytes, token: bytes) -> tuple[tuple[int, ...], int]:
+    plain = cipher_suite.decrypt(token)
+    if len(plain) < _INDEX_PREFIX.size:
+        raise ValueError("Encrypted stream index is malformed.")
+    magic, index_digest, count, total = _INDEX_PREFIX.unpack_from(plain)
+    if magic != _INDEX_MAGIC or index_digest != header_digest or len(plain) != _INDEX_PREFIX.size + 8 * count:
+        raise ValueError("Encrypted stream index is malformed.")
+    return struct.unpack_from(f">{count}Q", plain, _INDEX_PREFIX.size), total
+
+
+def _open_random_access(
+    view: mmap.mmap, key: bytes
+) -> tuple[_StreamHeader, _ChunkCipher, tuple[int, ...], int]:
+    if view[: len(STREAM_MAGIC)] != STREAM_MAGIC:
+        raise ValueError("Random access needs a chunked .fernet file; re-encrypt legacy files first.")
+    header = _parse_stream_header(view[: _STREAM_HEADER.size])
+    if header.version < 2:
+        raise ValueError("Random access needs a .fernet file with an index trailer; re-encrypt it first.")
+    if len(view) < _STREAM_HEADER.size + _STREAM_FOOTER.size:
+        raise ValueError("Encrypted stream is truncated.")
+    index_offset, footer_magic = _STREAM_FOOTER.unpack(view[-_STREAM_FOOTER.size :])
+    if footer_magic != _INDEX_MAGIC:
+        raise ValueError("Encrypted stream index trailer is missing.")
+    cipher_suite = _stream_cipher(key, header)
+    offsets, total = _open_index(cipher_suite, header.digest, _token_at(view, index_offset, _MAX_INDEX_TOKEN_LENGTH))
+    return header, cipher_suite, offsets, total
+
+
+def _iter_range(
+    view: mmap.mmap,
+    cipher_suite: _ChunkCipher,
+    header: _StreamHeader,
+    offsets: tuple[int, ...],
+    total: int,
+    offset: int,
+    length: int,
+) -> Iterator[bytes]:
+    # Decrypts only the chunks covering [offset, offset + length), one at a time.
+    chunk_size = header.chunk_size
+    end = min(offset + length, total)
+    if offset >= end:
+        return
+    max_token_length = _max_token_length(header)
+    for index in range(offset // chunk_size, (end - 1) // chunk_size + 1):
+        token = _token_at(view, offsets[index], max_token_length)
+        chunk, final = _open_chunk(cipher_suite, header, index, token)
+        if final != (index == len(offsets) - 1):
+            raise ValueError(f"Encrypted stream chunk {index} is out of place.")
+        start = index * chunk_size
+        yield chunk[max(offset - start, 0) : end - start]
+
+
+def _token_at(view: mmap.mmap, position: int, max_token_length: int) -> bytes:
+    if position + _RECORD_LENGTH.size > len(view):
+        raise ValueError("Encrypted stream is truncated.")
+    (token_length,) = _RECORD_LENGTH.unpack_from(view, position)
+    start = position + _RECORD_LENGTH.size
+    if not 0 < token_length <= max_token_length or start + token_length > len(view):
+        raise ValueError("Encrypted stream record is malformed.")
+    return view[start : start + token_length]
+
+
+def _cancellable(progress: ProgressCallback | None, cancel: threading.Event | None) -> ProgressCallback:
+    def report(done: int) -> None:
+        if cancel is not None and cancel.is_set():
+            raise OperationCancelled("Operation canceled.")
+        if progress is not None:
+            progress(done)
+
+    return report
+
+
+@contextmanager
+def _atomic_output(destination_path: str) -> Iterator[BinaryIO]:
+    # Output goes to a temp file next to the destination and only replaces
+    # it once complete, so failures and cancellations never leave partial files.
+    import tempfile
+
+    directory, name = os.path.split(os.path.abspath(destination_path))
+    handle = tempfile.NamedTemporaryFile(dir=directory, prefix=f".{name}.", suffix=".part", delete=False)
+    try:
+        with handle:
+            yield handle
+        os.replace(handle.name, destination_path)
+    except BaseException:
+        try:
+            os.unlink(handle.name)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _read_exact(source: BinaryIO, size: int) -> bytes:
+    data = source.read(size)
+    if len(data) == size or not data:
+        return data
+    parts = [data]
+    remaining = size - len(data)
+    while remaining:
+        data = source.read(remaining)
+        if not data:
+            break
+        parts.append(data)
+        remaining -= len(data)
+    return b"".join(parts)
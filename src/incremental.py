@@ -0,0 +1,430 @@
+"""Incremental re-encryption with content-defined chunking.
+
+The sender splits each version of a file into content-defined chunks and
+keeps an encrypted manifest of their SHA-256 digests. The next run chunks
+the new version the same way and writes a delta: copy instructions for
+chunks the receiver already has in its previous version, and literal bytes
+only for chunks that changed. The delta is an ordinary chunked .fernet
+container, so only changed data is encrypted and shipped, and the
+receiver rebuilds the new version from its previous one plus the delta.
+
+Chunk boundaries come from a Gear rolling hash of the 32 bytes before each
+position. An insertion or deletion therefore only moves the boundaries near
+it, and the chunks after it line up with the previous version again. Where
+the new version still lines up with the previous one, each chunk is
+confirmed by its digest instead of being rescanned, so the rolling hash
+only runs around changes and on the first version. The rolling hash is
+several times slower than encrypting, so once a run has rescanned
+1/_CDC_RESCAN_SHARE of the file, the rest of that run is cut at the maximum
+chunk size: a heavily changed file costs little more than re-encrypting it.
+"""
+import hashlib
+import hmac
+import os
+import random
+import struct
+import threading
+from dataclasses import dataclass
+from typing import BinaryIO, Iterable, Iterator
+
+from src.crypto_utils import (
+    DEFAULT_COMPRESSION_LEVEL,
+    ProgressCallback,
+    _atomic_output,
+    _cancellable,
+    _cipher_for,
+    _read_exact,
+    decrypt_stream,
+    encrypt_stream,
+)
+
+CDC_MIN_CHUNK = 16 * 1024
+CDC_MAX_CHUNK = 256 * 1024
+DELTA_SUFFIX = ".delta"
+
+_CDC_HASH_BYTES = 4  # 32-bit Gear state.
+_CDC_WINDOW_LEVELS = 5  # A 32-bit Gear hash depends on the last 2**5 = 32 bytes.
+_CDC_LANE = 9  # Bytes per position while hashing: an unreduced 32-byte Gear sum needs 68 bits.
+_CDC_CUT_BYTES = (2, 3)  # Cut where hash & 0xFFFF0000 == 0; the top bits depend on the most bytes.
+_CDC_BLOCK = 256 * 1024
+_CDC_SCAN = 64 * 1024
+_CDC_RESCAN_SHARE = 32  # The rolling hash runs at ~1/8 of Fernet's speed, so rescans add at most ~1/4.
+_COPY_BLOCK = 1024 * 1024
+
+_MANIFEST_MAGIC = b"SHFM"
+_MANIFEST_PREFIX = struct.Struct(">4sBIQ32sII")
+_MANIFEST_ENTRY = struct.Struct(">32sI")
+_DELTA_MAGIC = b"SHFD"
+_DELTA_HEADER = struct.Struct(">4sBIIQ")
+_DELTA_OP = struct.Struct(">cQQ")
+_FORMAT_VERSION = 1
+
+
+@dataclass
+class DeltaStats:
+    version: int
+    size: int
+    chunks: int
+    changed_chunks: int
+    changed_bytes: int
+    delta_bytes: int
+
+
+@dataclass
+class _Manifest:
+    version: int
+    size: int
+    sha256: bytes
+    chunks: list[tuple[bytes, int]]
+
+
+def encrypt_delta(
+    source_path: str,
+    manifest_path: str,
+    delta_path: str,
+    key: bytes,
+    progress: ProgressCallback | None = None,
+    cancel: threading.Event | None = None,
+    compression: str | None = None,
+    level: int = DEFAULT_COMPRESSION_LEVEL,
+) -> DeltaStats:
+    previous = _load_manifest(manifest_path, key) if os.path.exists(manifest_path) else None
+    base_offsets = {}
+    if previous is not None:
+        offset = 0
+        for digest, length in previous.chunks:
+            base_offsets.setdefault(digest, (offset, length))
+            offset += length
+
+    version = 1 if previous is None else previous.version + 1
+    stats = DeltaStats(version, size=0, chunks=0, changed_chunks=0, changed_bytes=0, delta_bytes=0)
+    chunks: list[tuple[bytes, int]] = []
+    file_digest = hashlib.sha256()
+    report = _cancellable(progress, cancel)
+
+    def ops() -> Iterator[bytes]:
+        yield _DELTA_HEADER.pack(
+            _DELTA_MAGIC,
+            _FORMAT_VERSION,
+            0 if previous is None else previous.version,
+            stats.version,
+            0 if previous is None else previous.size,
+        )
+        pending_copy = None
+        with open(source_path, "rb") as source:
+            if previous is None:
+                chunk_source = _cdc_chunks(source, _cdc_table(key))
+            else:
+                rescan_limit = max(os.fstat(source.fileno()).st_size // _CDC_RESCAN_SHARE, CDC_MAX_CHUNK)
+                chunk_source = _cdc_chunks(source, _cdc_table(key), previous.chunks, rescan_limit)
+            for chunk, digest in chunk_source:
+                file_digest.update(chunk)
+                chunks.append((digest, len(chunk)))
+                stats.size += len(chunk)
+                stats.chunks += 1
+                match = base_offsets.get(digest)
+                if match is not None:
+                    # Copies of consecutive base chunks collapse into one instruction.
+                    if pending_copy is not None and pending_copy[0] + pending_copy[1] == match[0]:
+                        pending_copy = (pending_copy[0], pending_copy[1] + match[1])
+                    else:
+                        if pending_copy is not None:
+                            yield _DELTA_OP.pack(b"C", *pending_copy)
+                        pending_copy = match
+                else:
+                    if pending_copy is not None:
+                        yield _DELTA_OP.pack(b"C", *pending_copy)
+                        pending_copy = None
+                    stats.changed_chunks += 1
+                    stats.changed_bytes += len(chunk)
+                    yield _DELTA_OP.pack(b"L", len(chunk), 0)
+                    yield chunk
+                report(stats.size)
+        if pending_copy is not None:
+            yield _DELTA_OP.pack(b"C", *pending_copy)
+        yield _DELTA_OP.pack(b"E", stats.size, 0) + file_digest.digest()
+
+    with _atomic_output(delta_path) as destination:
+        encrypt_stream(_IterReader(ops()), destination, key, compression=compression, level=level)
+    stats.delta_bytes = os.path.getsize(delta_path)
+    # The manifest only advances once the delta for this version exists.
+    _save_manifest(manifest_path, key, _Manifest(stats.version, stats.size, file_digest.digest(), chunks))
+    return stats
+
+
+def apply_delta(
+    delta_path: str,
+    base_path: str | None,
+    destination_path: str,
+    key: bytes,
+    progress: ProgressCallback | None = None,
+    cancel: threading.Event | None = None,
+) -> int:
+    # The plan is applied as decrypt_stream releases each authenticated
+    # chunk, so literal plaintext only ever reaches the destination's temp file.
+    with _atomic_output(destination_path) as destination:
+        plan = _DeltaWriter(base_path, destination, _cancellable(progress, cancel))
+        try:
+            with open(delta_path, "rb") as source:
+                decrypt_stream(source, plan, key)
+        finally:
+            plan.close()
+        if not plan.finished:
+            raise ValueError("Incremental delta is malformed.")
+    return plan.written
+
+
+def _cdc_table(key: bytes) -> tuple[bytes, ...]:
+    # The Gear table: a random 32-bit value per byte value, split into one
+    # bytes.translate() table per byte of the value. Keyed, so chunk
+    # boundaries reveal nothing about the content to anyone without the key.
+    seed = hmac.new(key if isinstance(key, bytes) else key.encode(), b"shareinfo-cdc", hashlib.sha256).digest()
+    rng = random.Random(seed)
+    gear = [rng.getrandbits(8 * _CDC_HASH_BYTES) for _ in range(256)]
+    return tuple(bytes((value >> (8 * lane)) & 0xFF for value in gear) for lane in range(_CDC_HASH_BYTES))
+
+
+def _cdc_chunks(
+    source: BinaryIO,
+    table: tuple[bytes, ...],
+    previous: list[tuple[bytes, int]] = (),
+    rescan_limit: int | None = None,
+    min_size: int = CDC_MIN_CHUNK,
+    max_size: int = CDC_MAX_CHUNK,
+) -> Iterator[tuple[bytes, bytes]]:
+    # Yields (chunk, SHA-256 digest). A chunk is fixed by its own bytes: it
+    # ends at the first cut point from min_size on, or at max_size. So where
+    # the data at a chunk boundary still matches the next chunk of the
+    # previous version (`previous`, as (digest, length) pairs), the digest
+    # alone confirms the chunk and the boundary after it. Only the final
+    # chunk, which may have been cut by the end of the file, needs the file
+    # to end there too. Anywhere else the cut points are searched for, and a
+    # chunk found in the previous version puts the guess back on track. Past
+    # `rescan_limit` searched bytes, chunks are simply cut at max_size.
+    following = {}
+    for index, (digest, _) in enumerate(previous):
+        following.setdefault(digest, index + 1)
+    guess = 0
+    rescanned = 0
+    buffer = b""
+    position = 0
+    eof = False
+    while True:
+        if len(buffer) - position < max_size and not eof:
+            parts = [buffer[position:]]
+            size = len(parts[0])
+            while size < max_size and not eof:
+                block = _read_exact(source, _CDC_BLOCK)
+                eof = len(block) < _CDC_BLOCK
+                parts.append(block)
+                size += len(block)
+            buffer = b"".join(parts)
+            position = 0
+        remaining = len(buffer) - position
+        if not remaining:
+            return
+        if guess < len(previous):
+            expected, length = previous[guess]
+            last = guess == len(previous) - 1
+            if length <= remaining and (not last or (eof and length == remaining)):
+                chunk = buffer[position : position + length]
+                digest = hashlib.sha256(chunk).digest()
+                if digest == expected:
+                    yield chunk, digest
+                    position += length
+                    guess += 1
+                    continue
+        if rescan_limit is None or rescanned < rescan_limit:
+            end = _next_cut(buffer, position, table, min_size, max_size)
+            rescanned += end - position
+        else:
+            end = position + min(max_size, remaining)
+        chunk = buffer[position:end]
+        digest = hashlib.sha256(chunk).digest()
+        yield chunk, digest
+        position = end
+        guess = following.get(digest, len(previous))
+
+
+def _next_cut(buffer: bytes, position: int, table: tuple[bytes, ...], min_size: int, max_size: int) -> int:
+    # cuts[i] is zero where the Gear hash of the 32 bytes ending at buffer[i]
+    # has its top 16 bits clear, and a chunk may end after that byte. The
+    # hash mixes byte positions with carries, so that happens at about 1 in
+    # 65536 positions for text and structured data as well as random bytes.
+    # Positions before min_size can never end the chunk, so hashing starts
+    # there, and goes on a block at a time until the first cut point.
+    window = 1 << _CDC_WINDOW_LEVELS
+    limit = min(position + max_size, len(buffer))
+    scan = position + min_size - 1
+    while scan < limit:
+        stop = min(scan + _CDC_SCAN, limit)
+        hit = _window_cuts(buffer[scan - window + 1 : stop], table).find(b"\x00", window - 1)
+        if hit >= 0:
+            return scan - window + 1 + hit + 1
+        scan = stop
+    return limit
+
+
+def _window_cuts(data: bytes, table: tuple[bytes, ...]) -> bytes:
+    # Gear hash h[i] = sum(gear[data[i - j]] << j for j < 32) mod 2**32, for
+    # every i at once: each position gets a _CDC_LANE-byte lane of one big
+    # integer, wide enough that the sum never carries into the next lane, and
+    # shift-and-add doubling builds the 32-term sums in five passes.
+    count = len(data)
+    lanes = bytearray(count * _CDC_LANE)
+    for lane, translation in enumerate(table):
+        lanes[lane::_CDC_LANE] = data.translate(translation)
+    value = int.from_bytes(lanes, "little")
+    step = 8 * _CDC_LANE + 1  # One lane over and one bit up.
+    for level in range(_CDC_WINDOW_LEVELS):
+        value += value << (step << level)
+    end = count * _CDC_LANE
+    raw = value.to_bytes(end + ((_CDC_LANE + 1) << _CDC_WINDOW_LEVELS), "little")
+    low, high = (int.from_bytes(raw[lane:end:_CDC_LANE], "little") for lane in _CDC_CUT_BYTES)
+    return (low | high).to_bytes(count, "little")
+
+
+def _copy_pieces(source: BinaryIO, length: int) -> Iterator[bytes]:
+    while length:
+        piece = _read_exact(source, min(length, _COPY_BLOCK))
+        if not piece:
+            raise ValueError("Incremental delta is truncated or the base file is too short.")
+        length -= len(piece)
+        yield piece
+
+
+def _load_manifest(path: str, key: bytes) -> _Manifest:
+    with open(path, "rb") as file_handle:
+        plain = _cipher_for(key).decrypt(file_handle.read())
+    if len(plain) < _MANIFEST_PREFIX.size:
+        raise ValueError("Incremental manifest is malformed.")
+    magic, format_version, version, size, file_digest, min_size, max_size = _MANIFEST_PREFIX.unpack_from(plain)
+    if magic != _MANIFEST_MAGIC or format_version != _FORMAT_VERSION:
+        raise ValueError("Incremental manifest is malformed.")
+    if (min_size, max_size) != (CDC_MIN_CHUNK, CDC_MAX_CHUNK):
+        raise ValueError("Incremental manifest was written with different chunk sizes; start a new one.")
+    body = memoryview(plain)[_MANIFEST_PREFIX.size :]
+    if len(body) % _MANIFEST_ENTRY.size:
+        raise ValueError("Incremental manifest is malformed.")
+    chunks = [(bytes(digest), length) for digest, length in _MANIFEST_ENTRY.iter_unpack(body)]
+    return _Manifest(version, size, file_digest, chunks)
+
+
+def _save_manifest(path: str, key: bytes, manifest: _Manifest) -> None:
+    plain = bytearray(
+        _MANIFEST_PREFIX.pack(
+            _MANIFEST_MAGIC,
+            _FORMAT_VERSION,
+            manifest.version,
+            manifest.size,
+            manifest.sha256,
+            CDC_MIN_CHUNK,
+            CDC_MAX_CHUNK,
+        )
+    )
+    for digest, length in manifest.chunks:
+        plain += _MANIFEST_ENTRY.pack(digest, length)
+    with _atomic_output(path) as destination:
+        destination.write(_cipher_for(key).encrypt(bytes(plain)))
+
+
+class _IterReader:
+    # Minimal read(size) over an iterator of byte strings, for encrypt_stream.
+
+    def __init__(self, pieces: Iterable[bytes]) -> None:
+        self._pieces = iter(pieces)
+        self._current = b""
+        self._position = 0
+
+    def read(self, size: int) -> bytes:
+        while self._position >= len(self._current):
+            self._current = next(self._pieces, None)
+            self._position = 0
+            if self._current is None:
+                self._current = b""
+                return b""
+        data = self._current[self._position : self._position + size]
+        self._position += len(data)
+        return data
+
+
+class _DeltaWriter:
+    # write(data) sink for decrypt_stream that parses the delta plan as it
+    # arrives and rebuilds the new version into `destination`.
+
+    def __init__(self, base_path: str | None, destination: BinaryIO, report: ProgressCallback) -> None:
+        self._base_path = base_path
+        self._base: BinaryIO | None = None
+        self._destination = destination
+        self._report = report
+        self._digest = hashlib.sha256()
+        self._pending = b""
+        self._literal = 0
+        self._started = False
+        self.finished = False
+        self.written = 0
+
+    def write(self, data: bytes) -> int:
+        buffer = self._pending + data if self._pending else bytes(data)
+        view = memoryview(buffer)
+        position = 0
+        while position < len(buffer):
+            if self._literal:
+                piece = view[position : position + self._literal]
+                self._literal -= len(piece)
+                position += len(piece)
+                self._emit(piece)
+            elif self.finished:
+                raise ValueError("Incremental delta is malformed.")
+            elif not self._started:
+                if len(buffer) - position < _DELTA_HEADER.size:
+                    break
+                self._open_base(_DELTA_HEADER.unpack_from(buffer, position))
+                position += _DELTA_HEADER.size
+                self._started = True
+            else:
+                if len(buffer) - position < _DELTA_OP.size:
+                    break
+                kind, first, second = _DELTA_OP.unpack_from(buffer, position)
+                if kind == b"E":
+                    if len(buffer) - position < _DELTA_OP.size + 32:
+                        break
+                    expected = buffer[position + _DELTA_OP.size : position + _DELTA_OP.size + 32]
+                    if self.written != first or self._digest.digest() != expected:
+                        raise ValueError("The rebuilt file does not match; the base is not the expected version.")
+                    self.finished = True
+                    position += _DELTA_OP.size + 32
+                elif kind == b"C" and self._base is not None:
+                    self._base.seek(first)
+                    for piece in _copy_pieces(self._base, second):
+                        self._emit(piece)
+                    position += _DELTA_OP.size
+                elif kind == b"L":
+                    self._literal = first
+                    position += _DELTA_OP.size
+                else:
+                    raise ValueError("Incremental delta is malformed.")
+        self._pending = buffer[position:]
+        return len(data)
+
+    def close(self) -> None:
+        if self._base is not None:
+            self._base.close()
+            self._base = None
+
+    def _open_base(self, header: tuple) -> None:
+        magic, format_version, base_version, _, base_size = header
+        if magic != _DELTA_MAGIC or format_version != _FORMAT_VERSION:
+            raise ValueError("Not an incremental delta.")
+        if base_version:
+            if self._base_path is None:
+                raise ValueError(f"This delta updates version {base_version}; pass the previous version as the base.")
+            if os.path.getsize(self._base_path) != base_size:
+                raise ValueError("The base file is not the version this delta was made against.")
+            self._base = open(self._base_path, "rb")
+
+    def _emit(self, piece: bytes | memoryview) -> None:
+        self._destination.write(piece)
+        self._digest.update(piece)
+        self.written += len(piece)
+        self._report(self.written)
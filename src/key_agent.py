@@ -0,0 +1,529 @@
+"""Local key agent: holds unwrapped keys in one process and serves encrypt/decrypt over a Unix socket.
+
+Like ssh-agent, keys never leave the agent. Clients name a key by its
+fingerprint and send batches of payloads; a connection stays open for any
+number of requests, so short-lived scripts skip both key derivation and per-request
+connection setup.
+
+Every message is one frame: a struct header with the JSON header length
+and body length, the JSON header, then the body. Batched items travel as
+one concatenated body plus a list of item sizes. Stream requests carry the
+client's source and destination file descriptors with the frame
+(SCM_RIGHTS), so the agent reads and writes them directly.
+"""
+import json
+import os
+import socket
+import socketserver
+import stat
+import struct
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import BinaryIO, Iterable
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from src.crypto_utils import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_CIPHER,
+    DEFAULT_COMPRESSION_LEVEL,
+    BatchResult,
+    _atomic_output,
+    _decrypt_all,
+    _encrypt_all,
+    _wipe,
+    clear_cipher_cache,
+    decrypt_stream,
+    encrypt_stream,
+    key_fingerprint,
+)
+
+AGENT_SOCKET_ENV = "SHAREINFO_AGENT_SOCK"
+KEY_AGENT_LIFETIME = 3600.0
+MAX_AGENT_FRAME = 64 * 1024 * 1024
+
+_FRAME = struct.Struct(">II")
+_MAX_FRAME_HEADER = 1024 * 1024
+_MAX_FRAME_FDS = 2
+
+
+class KeyAgentError(Exception):
+    pass
+
+
+@dataclass
+class AgentKey:
+    fingerprint: str
+    expires_in: float | None
+
+
+class KeyAgent:
+    """Unwrapped keys indexed by fingerprint, each with its own lifetime.
+
+    Expired and removed keys are dropped together with their Fernet object,
+    and the agent's copy of the key bytes is zeroed. Stream requests also
+    leave ciphers in crypto_utils' cache, so that cache is cleared too.
+    """
+
+    def __init__(self) -> None:
+        self._keys: dict[str, tuple[float | None, bytearray, Fernet]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, key: bytes, lifetime: float | None = KEY_AGENT_LIFETIME) -> str:
+        if lifetime is not None and lifetime <= 0:
+            raise ValueError("Key lifetime must be positive.")
+        cipher_suite = Fernet(key)
+        fingerprint = key_fingerprint(key)
+        expires = None if lifetime is None else time.monotonic() + lifetime
+        with self._lock:
+            previous = self._keys.pop(fingerprint, None)
+            self._keys[fingerprint] = (expires, bytearray(key), cipher_suite)
+        _discard([previous] if previous is not None else [])
+        return fingerprint
+
+    def remove(self, fingerprint: str) -> bool:
+        with self._lock:
+            entry = self._keys.pop(_normalize(fingerprint), None)
+        if entry is None:
+            return False
+        _discard([entry])
+        return True
+
+    def remove_all(self) -> int:
+        with self._lock:
+            entries = list(self._keys.values())
+            self._keys.clear()
+        _discard(entries)
+        return len(entries)
+
+    def list_keys(self) -> list[AgentKey]:
+        self.expire()
+        now = time.monotonic()
+        with self._lock:
+            return [
+                AgentKey(fingerprint, None if expires is None else expires - now)
+                for fingerprint, (expires, _, _) in self._keys.items()
+            ]
+
+    def expire(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            expired = [fp for fp, (expires, _, _) in self._keys.items() if expires is not None and expires <= now]
+            entries = [self._keys.pop(fingerprint) for fingerprint in expired]
+        _discard(entries)
+
+    def encrypt_many(self, fingerprint: str, payloads: Iterable[bytes]) -> list[BatchResult]:
+        return _encrypt_all(self._cipher(fingerprint), payloads)
+
+    def decrypt_many(self, fingerprint: str, tokens: Iterable[bytes]) -> list[BatchResult]:
+        return _decrypt_all(self._cipher(fingerprint), tokens)
+
+    def encrypt_stream(
+        self,
+        fingerprint: str,
+        source: BinaryIO,
+        destination: BinaryIO,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        compression: str | None = None,
+        level: int = DEFAULT_COMPRESSION_LEVEL,
+        cipher: str = DEFAULT_CIPHER,
+    ) -> int:
+        key = bytes(self._entry(fingerprint)[1])
+        return encrypt_stream(source, destination, key, chunk_size, None, compression, level, cipher)
+
+    def decrypt_stream(self, fingerprint: str, source: BinaryIO, destination: BinaryIO) -> int:
+        return decrypt_stream(source, destination, bytes(self._entry(fingerprint)[1]))
+
+    def _cipher(self, fingerprint: str) -> Fernet:
+        return self._entry(fingerprint)[2]
+
+    def _entry(self, fingerprint: str) -> tuple[float | None, bytearray, Fernet]:
+        self.expire()
+        with self._lock:
+            entry = self._keys.get(_normalize(fingerprint))
+        if entry is None:
+            raise KeyAgentError(f"The agent holds no key with fingerprint {fingerprint}.")
+        return entry
+
+
+class KeyAgentClient:
+    """Persistent connection to a running key agent."""
+
+    def __init__(self, path: str | None = None, timeout: float | None = 30.0) -> None:
+        self.path = path or default_agent_socket()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        try:
+            self._socket.connect(self.path)
+        except OSError as exc:
+            self._socket.close()
+            raise KeyAgentError(f"No key agent is listening on {self.path}: {exc}") from exc
+        # Keys are sent over this socket, so make sure the listener is ours and not another user's.
+        if not _peer_is_owner(self._socket):
+            self._socket.close()
+            raise KeyAgentError(f"The process listening on {self.path} belongs to another user.")
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "KeyAgentClient":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._socket.close()
+
+    def add_key(self, key: bytes, lifetime: float | None = KEY_AGENT_LIFETIME) -> str:
+        header, _ = self._request({"op": "add", "lifetime": lifetime}, [key])
+        return header["fingerprint"]
+
+    def list_keys(self) -> list[AgentKey]:
+        header, _ = self._request({"op": "list"})
+        return [AgentKey(item["fingerprint"], item["expires_in"]) for item in header["keys"]]
+
+    def remove_key(self, fingerprint: str) -> bool:
+        header, _ = self._request({"op": "remove", "fingerprint": fingerprint})
+        return header["removed"] > 0
+
+    def remove_all(self) -> int:
+        header, _ = self._request({"op": "remove-all"})
+        return header["removed"]
+
+    def encrypt_many(self, fingerprint: str, payloads: Iterable[bytes | str]) -> list[BatchResult]:
+        return self._batch("encrypt", fingerprint, payloads)
+
+    def decrypt_many(self, fingerprint: str, tokens: Iterable[bytes | str]) -> list[BatchResult]:
+        return self._batch("decrypt", fingerprint, tokens)
+
+    def encrypt(self, fingerprint: str, payload: bytes | str) -> bytes:
+        return _unwrap_result(self.encrypt_many(fingerprint, [payload])[0])
+
+    def decrypt(self, fingerprint: str, token: bytes | str) -> bytes:
+        return _unwrap_result(self.decrypt_many(fingerprint, [token])[0])
+
+    def encrypt_stream(
+        self,
+        fingerprint: str,
+        source: BinaryIO,
+        destination: BinaryIO,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        compression: str | None = None,
+        level: int = DEFAULT_COMPRESSION_LEVEL,
+        cipher: str = DEFAULT_CIPHER,
+    ) -> int:
+        """Have the agent encrypt `source` into `destination` as a chunked container.
+
+        Both must be real files or pipes: the agent works on their file
+        descriptors, from their current positions, so nothing may be left in
+        Python-side buffers.
+        """
+        options = {"chunk_size": chunk_size, "compression": compression, "level": level, "cipher": cipher}
+        return self._stream("encrypt-stream", fingerprint, source, destination, options)
+
+    def decrypt_stream(self, fingerprint: str, source: BinaryIO, destination: BinaryIO) -> int:
+        return self._stream("decrypt-stream", fingerprint, source, destination)
+
+    def encrypt_file(
+        self,
+        fingerprint: str,
+        source_path: str,
+        destination_path: str,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        compression: str | None = None,
+        level: int = DEFAULT_COMPRESSION_LEVEL,
+        cipher: str = DEFAULT_CIPHER,
+    ) -> int:
+        with open(source_path, "rb") as source, _atomic_output(destination_path) as destination:
+            return self.encrypt_stream(fingerprint, source, destination, chunk_size, compression, level, cipher)
+
+    def decrypt_file(self, fingerprint: str, source_path: str, destination_path: str) -> int:
+        with open(source_path, "rb") as source, _atomic_output(destination_path) as destination:
+            return self.decrypt_stream(fingerprint, source, destination)
+
+    def _stream(
+        self, op: str, fingerprint: str, source: BinaryIO, destination: BinaryIO, options: dict | None = None
+    ) -> int:
+        destination.flush()
+        fds = [source.fileno(), destination.fileno()]
+        header, _ = self._request({"op": op, "fingerprint": fingerprint, **(options or {})}, fds=fds, stream=True)
+        return header["size"]
+
+    def _batch(self, op: str, fingerprint: str, items: Iterable[bytes | str]) -> list[BatchResult]:
+        items = [item.encode() if isinstance(item, str) else item for item in items]
+        header, values = self._request({"op": op, "fingerprint": fingerprint}, items)
+        return [
+            BatchResult(index, error=_error_from_wire(error)) if error else BatchResult(index, value=value)
+            for index, (value, error) in enumerate(zip(values, header["errors"]))
+        ]
+
+    def _request(
+        self, header: dict, items: Iterable[bytes] = (), fds: list[int] = (), stream: bool = False
+    ) -> tuple[dict, list[bytes]]:
+        with self._lock:
+            previous_timeout = self._socket.gettimeout()
+            if stream:
+                # A stream takes as long as its data does, so the connection timeout does not apply.
+                self._socket.settimeout(None)
+            try:
+                _send_frame(self._socket, header, items, fds)
+                response = _recv_frame(self._socket)
+            finally:
+                self._socket.settimeout(previous_timeout)
+        if response is None:
+            raise KeyAgentError("The key agent closed the connection.")
+        header, values = response
+        if not header.get("ok"):
+            if header.get("kind") == "InvalidToken":
+                raise InvalidToken
+            raise KeyAgentError(header.get("error") or "The key agent rejected the request.")
+        return header, values
+
+
+def default_agent_socket() -> str:
+    path = os.environ.get(AGENT_SOCKET_ENV)
+    if path:
+        return path
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "shareinfo-agent.sock")
+    return os.path.join(_shared_socket_directory(), "agent.sock")
+
+
+def serve_agent(path: str | None = None, agent: KeyAgent | None = None, ready: threading.Event | None = None) -> None:
+    path = path or default_agent_socket()
+    _claim_socket_path(path)
+    # The socket is created owner-only; peers are also checked by uid on Linux.
+    previous_umask = os.umask(0o177)
+    try:
+        server = _AgentServer(path, agent or KeyAgent())
+    finally:
+        os.umask(previous_umask)
+    try:
+        _check_socket(path)
+        if ready is not None:
+            ready.set()
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.agent.remove_all()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+class _AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, agent: KeyAgent) -> None:
+        self.agent = agent
+        super().__init__(path, _AgentHandler)
+
+    def service_actions(self) -> None:
+        # Runs between polls of serve_forever, so keys expire on time even when idle.
+        self.agent.expire()
+
+
+class _AgentHandler(socketserver.BaseRequestHandler):
+    server: _AgentServer
+
+    def handle(self) -> None:
+        if not _peer_is_owner(self.request):
+            return
+        while True:
+            fds: list[int] = []
+            try:
+                request = _recv_frame(self.request, fds)
+                if request is None:
+                    return
+                try:
+                    header, items = _dispatch(self.server.agent, *request, fds)
+                except (KeyAgentError, InvalidToken, OSError, ValueError, KeyError, TypeError) as exc:
+                    header, items = {"ok": False, "error": str(exc), "kind": type(exc).__name__}, []
+            except (OSError, ValueError):
+                return
+            finally:
+                for fd in fds:
+                    os.close(fd)
+            try:
+                _send_frame(self.request, header, items)
+            except OSError:
+                return
+
+
+def _dispatch(agent: KeyAgent, header: dict, items: list[bytes], fds: list[int]) -> tuple[dict, list[bytes]]:
+    op = header.get("op")
+    if op == "add":
+        if len(items) != 1:
+            raise ValueError("add expects exactly one key.")
+        return {"ok": True, "fingerprint": agent.add(items[0], header.get("lifetime"))}, []
+    if op == "list":
+        keys = [{"fingerprint": key.fingerprint, "expires_in": key.expires_in} for key in agent.list_keys()]
+        return {"ok": True, "keys": keys}, []
+    if op == "remove":
+        return {"ok": True, "removed": int(agent.remove(header["fingerprint"]))}, []
+    if op == "remove-all":
+        return {"ok": True, "removed": agent.remove_all()}, []
+    if op in ("encrypt", "decrypt"):
+        run = agent.encrypt_many if op == "encrypt" else agent.decrypt_many
+        results = run(header["fingerprint"], items)
+        errors = [None if result.ok else [type(result.error).__name__, str(result.error)] for result in results]
+        return {"ok": True, "errors": errors}, [result.value or b"" for result in results]
+    if op in ("encrypt-stream", "decrypt-stream"):
+        if len(fds) != 2:
+            raise ValueError(f"{op} expects a source and a destination file descriptor.")
+        # The descriptors are the handler's to close, whatever happens here.
+        with open(fds[0], "rb", closefd=False) as source, open(fds[1], "wb", closefd=False) as destination:
+            if op == "decrypt-stream":
+                return {"ok": True, "size": agent.decrypt_stream(header["fingerprint"], source, destination)}, []
+            size = agent.encrypt_stream(
+                header["fingerprint"],
+                source,
+                destination,
+                int(header.get("chunk_size", DEFAULT_CHUNK_SIZE)),
+                header.get("compression"),
+                int(header.get("level", DEFAULT_COMPRESSION_LEVEL)),
+                header.get("cipher", DEFAULT_CIPHER),
+            )
+            return {"ok": True, "size": size}, []
+    raise ValueError(f"Unknown key agent operation: {op!r}")
+
+
+def _send_frame(sock: socket.socket, header: dict, items: Iterable[bytes], fds: list[int] = ()) -> None:
+    items = list(items)
+    raw_header = json.dumps({**header, "sizes": [len(item) for item in items]}).encode()
+    body_length = sum(len(item) for item in items)
+    if len(raw_header) > _MAX_FRAME_HEADER or body_length > MAX_AGENT_FRAME:
+        raise ValueError(f"Key agent requests are limited to {MAX_AGENT_FRAME} bytes; split the batch.")
+    # One buffer, one send: batches of small items would otherwise cost a syscall each.
+    frame = memoryview(b"".join([_FRAME.pack(len(raw_header), body_length), raw_header, *items]))
+    if fds:
+        # The descriptors ride on the frame's first bytes, where the agent looks for them.
+        frame = frame[socket.send_fds(sock, [frame], fds) :]
+    sock.sendall(frame)
+
+
+def _recv_frame(sock: socket.socket, fds: list[int] | None = None) -> tuple[dict, list[bytes]] | None:
+    # File descriptors sent with the frame are appended to `fds`; without it they are discarded.
+    prefix = _recv_exact(sock, _FRAME.size, fds=fds)
+    if prefix is None:
+        return None
+    header_length, body_length = _FRAME.unpack(prefix)
+    if header_length > _MAX_FRAME_HEADER or body_length > MAX_AGENT_FRAME:
+        raise ValueError("Key agent frame is too large.")
+    header = json.loads(_recv_exact(sock, header_length, required=True))
+    body = _recv_exact(sock, body_length, required=True)
+    sizes = header.pop("sizes", []) if isinstance(header, dict) else None
+    if (
+        not isinstance(sizes, list)
+        or not all(type(size) is int and size >= 0 for size in sizes)
+        or sum(sizes) != body_length
+    ):
+        raise ValueError("Key agent frame is malformed.")
+    items = []
+    position = 0
+    for size in sizes:
+        items.append(body[position : position + size])
+        position += size
+    return header, items
+
+
+def _recv_exact(
+    sock: socket.socket, size: int, required: bool = False, fds: list[int] | None = None
+) -> bytes | None:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        if fds is not None and not received:
+            data, passed, _, _ = socket.recv_fds(sock, size, _MAX_FRAME_FDS)
+            fds.extend(passed)
+            count = len(data)
+            view[:count] = data
+        else:
+            count = sock.recv_into(view[received:])
+        if not count:
+            if received or required:
+                raise ValueError("Key agent connection closed mid-frame.")
+            return None
+        received += count
+    return bytes(buffer)
+
+
+def _claim_socket_path(path: str) -> None:
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        os.makedirs(directory, mode=0o700)
+    except FileExistsError:
+        pass
+    else:
+        os.chmod(directory, 0o700)  # makedirs' mode is filtered through the umask.
+    if directory == _shared_socket_directory():
+        # Another local user may have created the default directory first (its name is
+        # predictable under /tmp), so only use it if it is a real directory that only we can enter.
+        info = os.lstat(directory)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or stat.S_IMODE(info.st_mode) != 0o700:
+            raise KeyAgentError(f"{directory} must be a directory owned by you with mode 0700; refusing to use it.")
+    try:
+        info = os.lstat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(info.st_mode):
+        raise KeyAgentError(f"{path} exists and is not a socket; refusing to replace it.")
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.unlink(path)  # Left behind by an agent that did not shut down cleanly.
+    else:
+        raise KeyAgentError(f"A key agent is already listening on {path}.")
+    finally:
+        probe.close()
+
+
+def _check_socket(path: str) -> None:
+    # A socket in a directory the user chose is only as private as its own mode.
+    info = os.lstat(path)
+    if not stat.S_ISSOCK(info.st_mode) or info.st_uid != os.getuid() or stat.S_IMODE(info.st_mode) & 0o077:
+        raise KeyAgentError(f"{path} must be a socket owned by you that only you can open; refusing to use it.")
+
+
+def _shared_socket_directory() -> str:
+    return os.path.join(tempfile.gettempdir(), f"shareinfo-agent-{os.getuid()}")
+
+
+def _peer_is_owner(sock: socket.socket) -> bool:
+    if not hasattr(socket, "SO_PEERCRED"):
+        return True
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    _, uid, _ = struct.unpack("3i", credentials)
+    return uid == os.getuid()
+
+
+def _discard(entries: list[tuple[float | None, bytearray, Fernet]]) -> None:
+    for _, key, _ in entries:
+        _wipe(key)
+    if entries:
+        clear_cipher_cache()
+
+
+def _normalize(fingerprint: str) -> str:
+    digits = "".join(fingerprint.split()).lower()
+    return " ".join(digits[i : i + 4] for i in range(0, len(digits), 4))
+
+
+def _error_from_wire(error: list[str]) -> Exception:
+    kind, message = error
+    if kind == "InvalidToken":
+        return InvalidToken()
+    if kind == "ValueError":
+        return ValueError(message)
+    return KeyAgentError(message or kind)
+
+
+def _unwrap_result(result: BatchResult) -> bytes:
+    if result.error is not None:
+        raise result.error
+    return result.value
@@ -0,0 +1,376 @@
+"""Operation timings for the crypto hot paths, plus non-blocking logging.
+
+Key generation, key derivation, encryption, decryption, verification and
+file reads/writes report into the process-wide METRICS registry. Each
+operation (with its labels and outcome) gets a histogram of durations, a
+histogram of sizes and a byte counter. Recording costs a perf_counter()
+pair and one short lock per operation, not per chunk, so it is always on.
+Long-running components can also set gauges (current values such as a
+queue depth). Snapshots export as JSON or as the Prometheus text format.
+"""
+import atexit
+import bisect
+import functools
+import inspect
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, BinaryIO, Callable, Iterator, TypeVar
+
+DURATION_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(float(1 << shift) for shift in range(10, 41, 2))  # 1 KiB to 1 TiB, powers of 4.
+METRICS_ENV = "SHAREINFO_METRICS"
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+_PROMETHEUS_PREFIX = "shareinfo_operation"
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+logger = logging.getLogger("shareinfo.metrics")
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style (each bucket counts values <= its bound)."""
+
+    def __init__(self, bounds: tuple[float, ...]) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other: dict) -> None:
+        if tuple(other["bounds"]) != self.bounds:
+            raise ValueError("Cannot merge histograms with different buckets.")
+        for position, count in enumerate(other["counts"]):
+            self.counts[position] += count
+        self.count += other["count"]
+        self.sum += other["sum"]
+
+    def to_dict(self) -> dict:
+        return {"bounds": list(self.bounds), "counts": list(self.counts), "count": self.count, "sum": self.sum}
+
+
+class Measurement:
+    """Context manager returned by MetricsRegistry.measure(); set `size` to the bytes the operation processed."""
+
+    __slots__ = ("size", "_registry", "_operation", "_cancelled", "_labels", "_started")
+
+    def __init__(
+        self,
+        registry: "MetricsRegistry",
+        operation: str,
+        cancelled: tuple[type[BaseException], ...],
+        labels: tuple[tuple[str, str], ...],
+    ) -> None:
+        self.size = 0
+        self._registry = registry
+        self._operation = operation
+        self._cancelled = cancelled
+        self._labels = labels
+        self._started = 0.0
+
+    def __enter__(self) -> "Measurement":
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        elapsed = time.perf_counter() - self._started
+        if exc_type is None:
+            outcome = "ok"
+        elif issubclass(exc_type, self._cancelled):
+            outcome = "cancelled"
+        else:
+            outcome = "error"
+        self._registry._record(self._operation, outcome, self._labels, elapsed, self.size)
+
+
+class _Series:
+    __slots__ = ("seconds", "sizes", "bytes")
+
+    def __init__(self) -> None:
+        self.seconds = Histogram(DURATION_BUCKETS)
+        self.sizes = Histogram(SIZE_BUCKETS)
+        self.bytes = 0
+
+    def add(self, seconds: float, size: int) -> None:
+        # Histogram.observe() inlined: this runs under the registry lock on every operation.
+        durations, sizes = self.seconds, self.sizes
+        durations.counts[bisect.bisect_left(DURATION_BUCKETS, seconds)] += 1
+        durations.count += 1
+        durations.sum += seconds
+        sizes.counts[bisect.bisect_left(SIZE_BUCKETS, size)] += 1
+        sizes.count += 1
+        sizes.sum += size
+        self.bytes += size
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._series: dict[tuple[str, str, tuple[tuple[str, str], ...]], _Series] = {}
+        self._gauges: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, operation: str, seconds: float, size: int = 0, outcome: str = "ok", **labels: str) -> None:
+        self._record(operation, outcome, _label_key(labels), seconds, size)
+
+    def set_gauge(self, name: str, value: float, **labels: str) -> None:
+        """Record the current value of `name`, replacing the previous one."""
+        with self._lock:
+            self._gauges[(name, _label_key(labels))] = value
+
+    def measure(self, operation: str, cancelled: tuple[type[BaseException], ...] = (), **labels: str) -> Measurement:
+        """Time a with-block; the outcome is "ok", "cancelled" (for `cancelled` exceptions) or "error"."""
+        return Measurement(self, operation, cancelled, _label_key(labels))
+
+    def timed(self, operation: str, cancelled: tuple[type[BaseException], ...] = (), **labels: str) -> Callable[[F], F]:
+        """Decorator form of measure(); an int return value is recorded as the bytes processed."""
+        label_key = _label_key(labels)
+
+        def decorate(function: F) -> F:
+            if inspect.iscoroutinefunction(function):
+
+                @functools.wraps(function)
+                async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                    with Measurement(self, operation, cancelled, label_key) as measurement:
+                        result = await function(*args, **kwargs)
+                        measurement.size = result if isinstance(result, int) else 0
+                        return result
+
+                return async_wrapper  # type: ignore[return-value]
+
+            @functools.wraps(function)
+            def wrapper(*args: Any, **kwargs: Any) -> Any:
+                with self.measure(operation, cancelled, **labels) as measurement:
+                    result = function(*args, **kwargs)
+                    measurement.size = result if isinstance(result, int) else 0
+                    return result
+
+            return wrapper  # type: ignore[return-value]
+
+        return decorate
+
+    @contextmanager
+    def timed_io(self, file: BinaryIO) -> Iterator["TimedFile"]:
+        """Wrap `file` so time spent in its read()/write() calls is recorded as file.read/file.write."""
+        timed_file = TimedFile(file)
+        try:
+            yield timed_file
+        finally:
+            if timed_file.reads:
+                self.observe("file.read", timed_file.read_seconds, timed_file.read_bytes)
+            if timed_file.writes:
+                self.observe("file.write", timed_file.write_seconds, timed_file.write_bytes)
+
+    def _record(
+        self, operation: str, outcome: str, labels: tuple[tuple[str, str], ...], seconds: float, size: int
+    ) -> None:
+        series_key = (operation, outcome, labels)
+        with self._lock:
+            series = self._series.get(series_key)
+            if series is None:
+                series = self._series[series_key] = _Series()
+            series.add(seconds, size)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s %s %.6fs %d bytes %s", operation, outcome, seconds, size, dict(labels) or "")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return self._snapshot()
+
+    def drain(self) -> dict:
+        """Return a snapshot and reset, so worker processes can ship only what is new."""
+        with self._lock:
+            snapshot = self._snapshot()
+            self._series.clear()
+            self._gauges.clear()
+        return snapshot
+
+    def merge(self, snapshot: dict) -> None:
+        """Add a snapshot taken in another process (see drain())."""
+        with self._lock:
+            for entry in snapshot["operations"]:
+                series_key = (entry["operation"], entry["outcome"], _label_key(entry["labels"]))
+                series = self._series.get(series_key)
+                if series is None:
+                    series = self._series[series_key] = _Series()
+                series.seconds.merge(entry["seconds"])
+                series.sizes.merge(entry["sizes"])
+                series.bytes += entry["bytes"]
+            # A gauge is a current value, so the newest report wins.
+            for entry in snapshot.get("gauges", ()):
+                self._gauges[(entry["name"], _label_key(entry["labels"]))] = entry["value"]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._series.clear()
+            self._gauges.clear()
+
+    def _snapshot(self) -> dict:
+        return {
+            "operations": [
+                {
+                    "operation": operation,
+                    "outcome": outcome,
+                    "labels": dict(labels),
+                    "bytes": series.bytes,
+                    "seconds": series.seconds.to_dict(),
+                    "sizes": series.sizes.to_dict(),
+                }
+                for (operation, outcome, labels), series in sorted(self._series.items(), key=lambda item: item[0])
+            ],
+            "gauges": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._gauges.items(), key=lambda item: item[0])
+            ],
+        }
+
+    def to_prometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines = [
+            f"# HELP {_PROMETHEUS_PREFIX}_seconds Duration of crypto and file operations.",
+            f"# TYPE {_PROMETHEUS_PREFIX}_seconds histogram",
+        ]
+        for entry in snapshot["operations"]:
+            lines.extend(_prometheus_histogram(f"{_PROMETHEUS_PREFIX}_seconds", entry, entry["seconds"]))
+        lines += [
+            f"# HELP {_PROMETHEUS_PREFIX}_size_bytes Bytes processed per crypto or file operation.",
+            f"# TYPE {_PROMETHEUS_PREFIX}_size_bytes histogram",
+        ]
+        for entry in snapshot["operations"]:
+            lines.extend(_prometheus_histogram(f"{_PROMETHEUS_PREFIX}_size_bytes", entry, entry["sizes"]))
+        lines += [
+            f"# HELP {_PROMETHEUS_PREFIX}_bytes_total Bytes processed by crypto and file operations.",
+            f"# TYPE {_PROMETHEUS_PREFIX}_bytes_total counter",
+        ]
+        for entry in snapshot["operations"]:
+            lines.append(f"{_PROMETHEUS_PREFIX}_bytes_total{_prometheus_labels(entry)} {entry['bytes']}")
+        previous = None
+        for entry in snapshot["gauges"]:
+            metric = _prometheus_gauge_name(entry["name"])
+            if entry["name"] != previous:
+                previous = entry["name"]
+                lines += [f"# HELP {metric} Current value of {previous}.", f"# TYPE {metric} gauge"]
+            labels = ",".join(f'{name}="{_prometheus_escape(str(value))}"' for name, value in entry["labels"].items())
+            lines.append(f"{metric}{{{labels}}} {entry['value']!r}" if labels else f"{metric} {entry['value']!r}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def write(self, path: str) -> None:
+        """Write a JSON snapshot (for a .json path) or Prometheus text, atomically.
+
+        The rename means a Prometheus textfile collector never reads a half-written file.
+        """
+        text = self.to_json() if path.endswith(".json") else self.to_prometheus()
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file_handle:
+            file_handle.write(text)
+        os.replace(temp_path, path)
+
+
+class TimedFile:
+    """Passes read()/write() through to a file and adds up the time and bytes they take."""
+
+    def __init__(self, file: BinaryIO) -> None:
+        self._file = file
+        self.reads = 0
+        self.read_bytes = 0
+        self.read_seconds = 0.0
+        self.writes = 0
+        self.write_bytes = 0
+        self.write_seconds = 0.0
+
+    def read(self, size: int = -1) -> bytes:
+        started = time.perf_counter()
+        data = self._file.read(size)
+        self.read_seconds += time.perf_counter() - started
+        self.reads += 1
+        self.read_bytes += len(data)
+        return data
+
+    def write(self, data: bytes) -> int:
+        started = time.perf_counter()
+        written = self._file.write(data)
+        self.write_seconds += time.perf_counter() - started
+        self.writes += 1
+        self.write_bytes += len(data)
+        return written
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._file, name)
+
+
+METRICS = MetricsRegistry()
+
+
+def configure_logging(
+    filename: str, level: int = logging.INFO, log_format: str = LOG_FORMAT
+) -> logging.handlers.QueueListener | None:
+    """Like logging.basicConfig(filename=...), but the file is written by a background thread.
+
+    Log calls only put the record on a queue, so logging from a hot path
+    never waits on disk. Does nothing if the root logger already has
+    handlers, as basicConfig does.
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(logging.Formatter(log_format))
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, file_handler, respect_handler_level=True)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+    listener.start()
+    # Stopping the listener flushes whatever is still queued at exit.
+    atexit.register(listener.stop)
+    return listener
+
+
+def export_metrics_at_exit(path: str | None = None) -> None:
+    """Write METRICS to `path` (default: $SHAREINFO_METRICS) when the process exits."""
+    path = path or os.environ.get(METRICS_ENV)
+    if path:
+        atexit.register(METRICS.write, path)
+
+
+def _label_key(labels: dict[str, str]) -> tuple[tuple[str, str], ...]:
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _prometheus_histogram(name: str, entry: dict, histogram: dict) -> list[str]:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram["bounds"], histogram["counts"]):
+        cumulative += count
+        lines.append(f"{name}_bucket{_prometheus_labels(entry, le=repr(float(bound)))} {cumulative}")
+    lines.append(f"{name}_bucket{_prometheus_labels(entry, le='+Inf')} {histogram['count']}")
+    lines.append(f"{name}_sum{_prometheus_labels(entry)} {histogram['sum']!r}")
+    lines.append(f"{name}_count{_prometheus_labels(entry)} {histogram['count']}")
+    return lines
+
+
+def _prometheus_labels(entry: dict, **extra: str) -> str:
+    labels = {"operation": entry["operation"], "outcome": entry["outcome"], **entry["labels"], **extra}
+    return "{" + ",".join(f'{name}="{_prometheus_escape(str(value))}"' for name, value in labels.items()) + "}"
+
+
+def _prometheus_gauge_name(name: str) -> str:
+    # "watch.queue_depth" becomes shareinfo_watch_queue_depth.
+    return "shareinfo_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _prometheus_escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
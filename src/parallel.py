@@ -0,0 +1,153 @@
+"""Multi-core chunk encryption and decryption for the chunked .fernet container."""
+import os
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import BinaryIO, Iterable, Iterator, TypeVar
+
+from src.crypto_utils import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_CIPHER,
+    DEFAULT_COMPRESSION_LEVEL,
+    STREAM_MAGIC,
+    ProgressCallback,
+    _RECORD_LENGTH,
+    _StreamHeader,
+    _check_index_trailer,
+    _cipher_for,
+    _decrypt_legacy_stream,
+    _iter_plain_chunks,
+    _iter_tokens,
+    _new_stream_header,
+    _open_chunk,
+    _read_exact,
+    _read_stream_header,
+    _seal_chunk,
+    _stream_cipher,
+    _timed,
+    _write_index_trailer,
+    _write_record,
+)
+
+T = TypeVar("T")
+
+
+def default_workers() -> int:
+    return os.cpu_count() or 1
+
+
+@_timed("encrypt", api="parallel")
+def parallel_encrypt_stream(
+    source: BinaryIO,
+    destination: BinaryIO,
+    key: bytes,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    workers: int | None = None,
+    use_processes: bool = True,
+    progress: ProgressCallback | None = None,
+    compression: str | None = None,
+    level: int = DEFAULT_COMPRESSION_LEVEL,
+    cipher: str = DEFAULT_CIPHER,
+) -> int:
+    workers = _check_workers(workers)
+    header = _new_stream_header(chunk_size, compression, level, cipher)
+    cipher_suite = _stream_cipher(key, header)
+    destination.write(header.raw)
+
+    total = 0
+    position = len(header.raw)
+    offsets = []
+    with _make_executor(workers, use_processes) as executor:
+        jobs = (
+            (executor.submit(_seal_job, key, header, index, final, chunk, level), len(chunk))
+            for index, final, chunk in _iter_plain_chunks(source, chunk_size)
+        )
+        for token, chunk_length in _in_order(jobs, 2 * workers):
+            offsets.append(position)
+            position += _write_record(destination, token)
+            total += chunk_length
+            if progress is not None:
+                progress(total)
+    _write_index_trailer(destination, cipher_suite, header.digest, offsets, total, position)
+    return total
+
+
+@_timed("decrypt", api="parallel")
+def parallel_decrypt_stream(
+    source: BinaryIO,
+    destination: BinaryIO,
+    key: bytes,
+    workers: int | None = None,
+    use_processes: bool = True,
+    progress: ProgressCallback | None = None,
+) -> int:
+    cipher_suite = _cipher_for(key)
+    workers = _check_workers(workers)
+    magic = _read_exact(source, len(STREAM_MAGIC))
+    if magic != STREAM_MAGIC:
+        # A legacy single-token file has nothing to split across workers.
+        return _decrypt_legacy_stream(cipher_suite, magic, source, destination, progress)
+
+    header = _read_stream_header(source, magic)
+    cipher_suite = _stream_cipher(key, header)
+
+    total = 0
+    position = len(header.raw)
+    offsets = []
+    finished = False
+    with _make_executor(workers, use_processes) as executor:
+        jobs = (
+            (executor.submit(_open_job, key, header, index, token), len(token))
+            for index, token in enumerate(_iter_tokens(source, header))
+        )
+        for (chunk, final), token_length in _in_order(jobs, 2 * workers):
+            if finished:
+                raise ValueError("Unexpected data after the final encrypted chunk.")
+            destination.write(chunk)
+            total += len(chunk)
+            offsets.append(position)
+            position += _RECORD_LENGTH.size + token_length
+            finished = final
+            if progress is not None:
+                progress(position)
+    if not finished:
+        raise ValueError("Encrypted stream is truncated.")
+    if header.version >= 2:
+        _check_index_trailer(source, cipher_suite, header.digest, offsets, total, position)
+    elif source.read(1):
+        raise ValueError("Unexpected data after the final encrypted chunk.")
+    return total
+
+
+def _check_workers(workers: int | None) -> int:
+    workers = default_workers() if workers is None else workers
+    if workers < 1:
+        raise ValueError("Worker count must be at least 1.")
+    return workers
+
+
+def _make_executor(workers: int, use_processes: bool) -> Executor:
+    if use_processes:
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def _in_order(jobs: Iterable[tuple[Future, T]], window: int) -> Iterator[tuple[object, T]]:
+    # Results are yielded in submission order with at most `window` chunks in
+    # flight, so output stays sequential and memory stays bounded.
+    pending: deque[tuple[Future, T]] = deque()
+    for job in jobs:
+        pending.append(job)
+        if len(pending) >= window:
+            future, tag = pending.popleft()
+            yield future.result(), tag
+    while pending:
+        future, tag = pending.popleft()
+        yield future.result(), tag
+
+
+def _seal_job(key: bytes, header: _StreamHeader, index: int, final: bool, chunk: bytes, level: int) -> bytes:
+    return _seal_chunk(_stream_cipher(key, header), header, index, final, chunk, level)
+
+
+def _open_job(key: bytes, header: _StreamHeader, index: int, token: bytes) -> tuple[bytes, bool]:
+    return _open_chunk(_stream_cipher(key, header), header, index, token)
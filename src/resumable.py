@@ -0,0 +1,404 @@
+"""Resumable, crash-safe file encryption and decryption.
+
+encrypt_file_resumable() / decrypt_file_resumable() write the same output
+as encrypt_file() / decrypt_file(), but into a fixed partial file next to
+the destination (.<name>.partial) alongside a journal (.<name>.journal).
+About once a second the partial file is fsync'd and a checkpoint (chunks
+done, input and output offsets) is appended to the journal and fsync'd.
+Journal entries are HMAC-chained under a key derived from the data key, so
+a journal cannot be edited, reordered or reused with another key or
+another source file. When a job finishes, the output is fsync'd and renamed
+into place and the journal is removed.
+
+Calling the same function again after a crash, a reboot or a cancellation
+resumes from the last checkpoint. When encrypting, every complete record
+written after that checkpoint is authenticated and kept as well, so only
+the chunk that was being written is redone. Resumed chunks are sealed
+afresh, with new Fernet IVs or AEAD nonces; the stream header, and so the
+stream key, is kept from the journal.
+"""
+import hashlib
+import hmac
+import os
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from typing import BinaryIO, Callable
+
+from cryptography.fernet import InvalidToken
+
+from src.crypto_utils import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_CIPHER,
+    DEFAULT_COMPRESSION_LEVEL,
+    STREAM_MAGIC,
+    ProgressCallback,
+    _RECORD_LENGTH,
+    _STREAM_HEADER,
+    _ChunkCipher,
+    _StreamHeader,
+    _cancellable,
+    _check_index_trailer,
+    _cipher_for,
+    _iter_plain_chunks,
+    _iter_tokens,
+    _max_token_length,
+    _new_stream_header,
+    _open_chunk,
+    _parse_stream_header,
+    _read_exact,
+    _read_stream_header,
+    _record_length,
+    _seal_chunk,
+    _stream_cipher,
+    _timed,
+    _write_index_trailer,
+    _write_record,
+    decrypt_file,
+)
+
+CHECKPOINT_SECONDS = 1.0
+PARTIAL_SUFFIX = ".partial"
+JOURNAL_SUFFIX = ".journal"
+
+_JOURNAL_MAGIC = b"SHFJ"
+_JOURNAL_VERSION = 1
+_ENCRYPT = 1
+_DECRYPT = 2
+_JOURNAL_HEADER = struct.Struct(f">4sBBQQ32s{_STREAM_HEADER.size}s")
+_CHECKPOINT = struct.Struct(">QQQ")
+_MAC_SIZE = hashlib.sha256().digest_size
+
+
+@dataclass
+class _Checkpoint:
+    chunks: int
+    input_offset: int
+    output_offset: int
+
+
+@_timed("encrypt", api="resumable")
+def encrypt_file_resumable(
+    source_path: str,
+    destination_path: str,
+    key: bytes,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    progress: ProgressCallback | None = None,
+    cancel: threading.Event | None = None,
+    compression: str | None = None,
+    level: int = DEFAULT_COMPRESSION_LEVEL,
+    cipher: str = DEFAULT_CIPHER,
+    checkpoint_seconds: float = CHECKPOINT_SECONDS,
+) -> int:
+    """Encrypt like encrypt_file(), resuming an interrupted run for the same source and destination.
+
+    Returns the plaintext bytes encrypted by this call. chunk_size,
+    compression and cipher only apply to a new job; a resumed job keeps the
+    header it was started with.
+    """
+    _cipher_for(key)
+    report = _cancellable(progress, cancel)
+    with open(source_path, "rb") as source:
+        job = _Job(source_path, destination_path, key, _ENCRYPT, checkpoint_seconds)
+        header, offsets = job.resume(lambda: _new_stream_header(chunk_size, compression, level, cipher))
+        with job:
+            cipher_suite = _stream_cipher(key, header)
+            final = job.recover_records(header, cipher_suite, offsets)
+            position = job.state.output_offset
+            total = job.state.input_offset
+            if not final:
+                done = job.state.chunks
+                source.seek(total)
+                for index, final, chunk in _iter_plain_chunks(source, header.chunk_size):
+                    index += done
+                    offsets.append(position)
+                    position += _write_record(job.output, _seal_chunk(cipher_suite, header, index, final, chunk, level))
+                    total += len(chunk)
+                    job.advance(index + 1, total, position)
+                    report(total)
+            _write_index_trailer(job.output, cipher_suite, header.digest, offsets, total, position)
+    return total - job.resumed_from
+
+
+@_timed("decrypt", api="resumable")
+def decrypt_file_resumable(
+    source_path: str,
+    destination_path: str,
+    key: bytes,
+    progress: ProgressCallback | None = None,
+    cancel: threading.Event | None = None,
+    checkpoint_seconds: float = CHECKPOINT_SECONDS,
+) -> int:
+    """Decrypt like decrypt_file(), resuming an interrupted run for the same source and destination.
+
+    Returns the plaintext bytes written by this call. Chunks decrypted since
+    the last checkpoint are decrypted again. Legacy single-token files
+    cannot be resumed and are decrypted with decrypt_file().
+    """
+    _cipher_for(key)
+    report = _cancellable(progress, cancel)
+    with open(source_path, "rb") as source:
+        magic = _read_exact(source, len(STREAM_MAGIC))
+        if magic == STREAM_MAGIC:
+            source_header = _read_stream_header(source, magic)
+            job = _Job(source_path, destination_path, key, _DECRYPT, checkpoint_seconds)
+            header, offsets = job.resume(lambda: source_header, source)
+            with job:
+                cipher_suite = _stream_cipher(key, header)
+                position = job.state.input_offset
+                source.seek(position)
+                total = job.state.output_offset
+                final = False
+                tokens = _iter_tokens(source, header)
+                for index, token in enumerate(tokens, start=job.state.chunks):
+                    chunk, final = _open_chunk(cipher_suite, header, index, token)
+                    job.output.write(chunk)
+                    total += len(chunk)
+                    offsets.append(position)
+                    position += _RECORD_LENGTH.size + len(token)
+                    job.advance(index + 1, position, total)
+                    report(position)
+                    if final:
+                        break
+                if not final:
+                    raise ValueError("Encrypted stream is truncated.")
+                if next(tokens, None) is not None:
+                    raise ValueError("Unexpected data after the final encrypted chunk.")
+                if header.version >= 2:
+                    _check_index_trailer(source, cipher_suite, header.digest, offsets, total, position)
+                elif source.read(1):
+                    raise ValueError("Unexpected data after the final encrypted chunk.")
+            return total - job.resumed_from
+    return decrypt_file(source_path, destination_path, key, progress, cancel)
+
+
+def discard_resumable(destination_path: str) -> bool:
+    """Delete the partial output and journal of an interrupted job; returns whether there were any."""
+    found = False
+    for path in _job_paths(destination_path):
+        try:
+            os.unlink(path)
+            found = True
+        except FileNotFoundError:
+            pass
+    return found
+
+
+def has_resumable(destination_path: str) -> bool:
+    return all(os.path.exists(path) for path in _job_paths(destination_path))
+
+
+class _Job:
+    # The partial output, its journal and the last checkpoint. Used as a
+    # context manager around the work: success renames the output into place;
+    # corrupt or undecryptable input discards the job; anything else
+    # (cancellation, Ctrl-C, a full disk) checkpoints it for a later resume.
+
+    def __init__(self, source_path: str, destination_path: str, key: bytes, operation: int, interval: float) -> None:
+        self.destination_path = destination_path
+        self.partial_path, self.journal_path = _job_paths(destination_path)
+        self.operation = operation
+        self.interval = interval
+        self.resumed_from = 0
+        self.state = _Checkpoint(0, 0, 0)
+        self.output: BinaryIO | None = None
+        raw_key = key if isinstance(key, bytes) else key.encode()
+        self._mac_key = hmac.new(raw_key, b"shareinfo-resume", hashlib.sha256).digest()
+        stat = os.stat(source_path)
+        path_digest = hashlib.sha256(os.path.abspath(source_path).encode()).digest()
+        self._source_id = (stat.st_size, stat.st_mtime_ns, path_digest)
+        self._saved = self.state
+        self._saved_at = time.monotonic()
+        self._mac = b""
+        self._journal: BinaryIO | None = None
+
+    def __enter__(self) -> "_Job":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self._finish()
+        elif issubclass(exc_type, (InvalidToken, ValueError)):
+            self._close()
+            discard_resumable(self.destination_path)
+        else:
+            self._suspend()
+
+    def resume(
+        self, new_header: Callable[[], _StreamHeader], records: BinaryIO | None = None
+    ) -> tuple[_StreamHeader, list[int]]:
+        """Reopen a matching interrupted job, or start a new one with new_header().
+
+        Returns the stream header and the offsets of the records already
+        done; `records` is where those records are (default: the output).
+        """
+        loaded = self._load()
+        if loaded is not None:
+            header, checkpoint, mac, journal_length = loaded
+            if self.operation == _DECRYPT and header.raw != new_header().raw:
+                loaded = None
+        if loaded is None:
+            header = new_header()
+            self._start(header)
+            return header, []
+        self.output = open(self.partial_path, "r+b")
+        try:
+            # Records are rescanned from their length prefixes; if they do not
+            # add up to the checkpoint, the job starts over.
+            end = checkpoint.input_offset if self.operation == _DECRYPT else checkpoint.output_offset
+            offsets = _scan_records(records or self.output, header, checkpoint.chunks, end)
+        except ValueError:
+            self._close()
+            self._start(header := new_header())
+            return header, []
+        self.output.seek(checkpoint.output_offset)
+        if self.operation == _DECRYPT:
+            self.output.truncate()
+        self._journal = open(self.journal_path, "r+b")
+        # A torn last entry is cut off so new entries chain onto the last good one.
+        self._journal.truncate(journal_length)
+        self._journal.seek(journal_length)
+        self.state = self._saved = checkpoint
+        self._mac = mac
+        self.resumed_from = checkpoint.input_offset if self.operation == _ENCRYPT else checkpoint.output_offset
+        return header, offsets
+
+    def recover_records(self, header: _StreamHeader, cipher_suite: _ChunkCipher, offsets: list[int]) -> bool:
+        # Encrypting only: keeps every complete, authentic record written after
+        # the checkpoint, appending to `offsets`, and cuts off the rest.
+        # Returns whether the final chunk is among them.
+        final = False
+        position = self.state.output_offset
+        max_token_length = _max_token_length(header)
+        while not final:
+            index = self.state.chunks
+            try:
+                token_length = _record_length(_read_exact(self.output, _RECORD_LENGTH.size), max_token_length)
+                token = _read_exact(self.output, token_length)
+                if not token_length or len(token) != token_length:
+                    break
+                chunk, final = _open_chunk(cipher_suite, header, index, token)
+            except (InvalidToken, ValueError):
+                break
+            offsets.append(position)
+            position += _RECORD_LENGTH.size + token_length
+            self.state = _Checkpoint(index + 1, self.state.input_offset + len(chunk), position)
+        self.output.seek(position)
+        self.output.truncate()
+        self.resumed_from = self.state.input_offset
+        return final
+
+    def advance(self, chunks: int, input_offset: int, output_offset: int) -> None:
+        self.state = _Checkpoint(chunks, input_offset, output_offset)
+        if time.monotonic() - self._saved_at >= self.interval:
+            self._checkpoint()
+
+    def _start(self, header: _StreamHeader) -> None:
+        discard_resumable(self.destination_path)
+        descriptor = os.open(self.partial_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        self.output = os.fdopen(descriptor, "r+b")
+        if self.operation == _ENCRYPT:
+            self.output.write(header.raw)
+            self.state = _Checkpoint(0, 0, len(header.raw))
+        else:
+            self.state = _Checkpoint(0, len(header.raw), 0)
+        raw = _JOURNAL_HEADER.pack(_JOURNAL_MAGIC, _JOURNAL_VERSION, self.operation, *self._source_id, header.raw)
+        self._mac = self._sign(b"", raw)
+        self._journal = open(self.journal_path, "wb")
+        self._journal.write(raw + self._mac)
+        self._checkpoint(force=True)
+
+    def _load(self) -> tuple[_StreamHeader, _Checkpoint, bytes, int] | None:
+        # Anything that does not check out (another key, another source, a
+        # damaged journal) means starting over rather than failing.
+        if not has_resumable(self.destination_path):
+            return None
+        entry_size = _CHECKPOINT.size + _MAC_SIZE
+        with open(self.journal_path, "rb") as journal:
+            raw = journal.read(_JOURNAL_HEADER.size)
+            mac = journal.read(_MAC_SIZE)
+            if len(raw) != _JOURNAL_HEADER.size or not hmac.compare_digest(mac, self._sign(b"", raw)):
+                return None
+            magic, version, operation, size, mtime_ns, path_digest, raw_header = _JOURNAL_HEADER.unpack(raw)
+            if (magic, version, operation) != (_JOURNAL_MAGIC, _JOURNAL_VERSION, self.operation):
+                return None
+            if (size, mtime_ns, path_digest) != self._source_id:
+                return None
+            checkpoint = None
+            length = journal.tell()
+            while len(entry := journal.read(entry_size)) == entry_size:
+                record, entry_mac = entry[: _CHECKPOINT.size], entry[_CHECKPOINT.size :]
+                if not hmac.compare_digest(entry_mac, self._sign(mac, record)):
+                    break
+                checkpoint, mac = _Checkpoint(*_CHECKPOINT.unpack(record)), entry_mac
+                length += entry_size
+        if checkpoint is None or os.path.getsize(self.partial_path) < checkpoint.output_offset:
+            return None
+        try:
+            header = _parse_stream_header(raw_header)
+        except ValueError:
+            return None
+        return header, checkpoint, mac, length
+
+    def _checkpoint(self, force: bool = False) -> None:
+        # The output is made durable before the journal claims it.
+        if self.state == self._saved and not force:
+            return
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        record = _CHECKPOINT.pack(self.state.chunks, self.state.input_offset, self.state.output_offset)
+        self._mac = self._sign(self._mac, record)
+        self._journal.write(record + self._mac)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._saved = self.state
+        self._saved_at = time.monotonic()
+
+    def _suspend(self) -> None:
+        # Records past the checkpoint may be torn; a resumed job cuts them off.
+        try:
+            if self.output is not None:
+                self._checkpoint()
+        finally:
+            self._close()
+
+    def _finish(self) -> None:
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        self._close()
+        os.replace(self.partial_path, self.destination_path)
+        os.unlink(self.journal_path)
+
+    def _sign(self, previous: bytes, data: bytes) -> bytes:
+        return hmac.new(self._mac_key, previous + data, hashlib.sha256).digest()
+
+    def _close(self) -> None:
+        for handle in (self.output, self._journal):
+            if handle is not None:
+                handle.close()
+        self.output = self._journal = None
+
+
+def _job_paths(destination_path: str) -> tuple[str, str]:
+    directory, name = os.path.split(os.path.abspath(destination_path))
+    return os.path.join(directory, f".{name}{PARTIAL_SUFFIX}"), os.path.join(directory, f".{name}{JOURNAL_SUFFIX}")
+
+
+def _scan_records(source: BinaryIO, header: _StreamHeader, chunks: int, end: int) -> list[int]:
+    # Rebuilds the offsets of the first `chunks` records from their length
+    # prefixes alone, leaving `source` positioned at `end`.
+    max_token_length = _max_token_length(header)
+    position = len(header.raw)
+    offsets = []
+    source.seek(position)
+    for _ in range(chunks):
+        token_length = _record_length(_read_exact(source, _RECORD_LENGTH.size), max_token_length)
+        if not token_length:
+            raise ValueError("Resume journal does not match the encrypted data.")
+        offsets.append(position)
+        position += _RECORD_LENGTH.size + token_length
+        source.seek(position)
+    if position != end:
+        raise ValueError("Resume journal does not match the encrypted data.")
+    return offsets
@@ -0,0 +1,322 @@
+"""Bulk key rotation for existing .fernet files.
+
+Each file is re-encrypted under the new key in place: read as a stream,
+written to a temp file next to it, fsync'd and renamed over the original,
+so a crash never leaves a half-rotated file. Chunked containers keep their
+header, chunk boundaries and compressed chunk bodies; only each record is
+re-sealed, so the layout and every offset stay the same. Legacy
+single-token files are rotated with MultiFernet.rotate.
+
+rotate_files() spreads files over a worker pool and appends every finished
+file to a journal. Running it again with the same journal skips what is
+already done, and files that already open under the new key are skipped
+too, so an interrupted rotation can simply be restarted.
+"""
+import itertools
+import json
+import os
+import stat
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass
+from typing import BinaryIO, Callable, Iterable, Iterator
+
+from cryptography.fernet import InvalidToken, MultiFernet
+
+from src.crypto_utils import (
+    STREAM_MAGIC,
+    _RECORD_LENGTH,
+    _ChunkCipher,
+    _StreamHeader,
+    _atomic_output,
+    _check_chunk_prefix,
+    _cipher_for,
+    _iter_tokens,
+    _measure,
+    _read_exact,
+    _read_index_trailer,
+    _read_stream_header,
+    _stream_cipher,
+    _write_index_trailer,
+    _write_record,
+    key_fingerprint,
+)
+from src.metrics import METRICS
+
+ROTATED = "rotated"
+CURRENT = "current"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+_JOURNAL_VERSION = 1
+
+
+@dataclass
+class RotationResult:
+    # status is ROTATED, CURRENT (already under the new key), SKIPPED (done
+    # according to the journal) or FAILED.
+    path: str
+    status: str
+    size: int = 0
+    error: str | None = None
+
+
+RotationProgress = Callable[[RotationResult], None]
+
+
+def rotate_file(path: str, new_key: bytes, old_keys: Iterable[bytes]) -> str:
+    """Re-encrypt one file in place under `new_key`; returns ROTATED or CURRENT."""
+    old_keys = list(old_keys)
+    with open(path, "rb") as source:
+        magic = _read_exact(source, len(STREAM_MAGIC))
+        if magic != STREAM_MAGIC:
+            return _rotate_legacy(path, magic + source.read(), new_key, old_keys)
+
+        header = _read_stream_header(source, magic)
+        tokens = _iter_tokens(source, header)
+        first = next(tokens, None)
+        if first is None:
+            raise ValueError("Encrypted stream is truncated.")
+        old_suite = None
+        for candidate in [new_key, *old_keys]:
+            cipher_suite = _stream_cipher(candidate, header)
+            if _authenticates(cipher_suite, header, first):
+                old_suite = cipher_suite
+                break
+        if old_suite is None:
+            raise InvalidToken
+        if candidate is new_key:
+            return CURRENT
+        with _atomic_output(path) as destination:
+            _rotate_records(source, destination, header, itertools.chain([first], tokens), old_suite, new_key)
+            _finish_in_place(path, destination)
+    return ROTATED
+
+
+def rotate_files(
+    paths: Iterable[str],
+    new_key: bytes,
+    old_keys: Iterable[bytes],
+    journal_path: str | None = None,
+    workers: int | None = None,
+    use_processes: bool = True,
+    progress: RotationProgress | None = None,
+) -> list[RotationResult]:
+    """Rotate many files on a worker pool, resuming from and appending to `journal_path`.
+
+    Files the journal records as rotated (or already current) are reported as
+    SKIPPED without being opened. Failures are reported in the results and
+    retried by the next run.
+    """
+    old_keys = list(old_keys)
+    _cipher_for(new_key)
+    for old_key in old_keys:
+        _cipher_for(old_key)
+    if workers is not None and workers < 1:
+        raise ValueError("Worker count must be at least 1.")
+    workers = workers if workers is not None else os.cpu_count() or 1
+    journal = _Journal(journal_path, key_fingerprint(new_key)) if journal_path else None
+    results = []
+    pending = []
+    for path in dict.fromkeys(os.path.abspath(path) for path in paths):
+        if journal is None or path not in journal.done:
+            pending.append(path)
+            continue
+        result = RotationResult(path, SKIPPED)
+        results.append(result)
+        if progress is not None:
+            progress(result)
+
+    pooled = use_processes and workers > 1
+    executor: Executor = (
+        ProcessPoolExecutor(workers, initializer=METRICS.reset) if pooled else ThreadPoolExecutor(workers)
+    )
+    try:
+        with executor:
+            # Submitting lazily keeps the pending-future set (and memory) bounded on huge corpora.
+            queue = iter(pending)
+            futures = set()
+            for path in itertools.islice(queue, 4 * workers):
+                futures.add(executor.submit(_rotate_one, path, new_key, old_keys, pooled))
+            while futures:
+                future = next(as_completed(futures))
+                futures.remove(future)
+                result, snapshot = future.result()
+                if snapshot is not None:
+                    METRICS.merge(snapshot)
+                if journal is not None and result.status != FAILED:
+                    journal.record(result)
+                results.append(result)
+                if progress is not None:
+                    progress(result)
+                for path in itertools.islice(queue, 1):
+                    futures.add(executor.submit(_rotate_one, path, new_key, old_keys, pooled))
+    finally:
+        if journal is not None:
+            journal.close()
+    return results
+
+
+class RotationStats:
+    """Running totals for progress lines and the final throughput summary."""
+
+    def __init__(self, total: int) -> None:
+        self.total = total
+        self.counts = {ROTATED: 0, CURRENT: 0, SKIPPED: 0, FAILED: 0}
+        self.bytes = 0
+        self.started = time.perf_counter()
+
+    def add(self, result: RotationResult) -> None:
+        self.counts[result.status] += 1
+        self.bytes += result.size
+
+    @property
+    def done(self) -> int:
+        return sum(self.counts.values())
+
+    @property
+    def elapsed(self) -> float:
+        return max(time.perf_counter() - self.started, 1e-9)
+
+    def line(self) -> str:
+        megabytes = self.bytes / 1_000_000
+        return (
+            f"{self.done}/{self.total} files: {self.counts[ROTATED]} rotated, {self.counts[CURRENT]} already current, "
+            f"{self.counts[SKIPPED]} done earlier, {self.counts[FAILED]} failed; "
+            f"{megabytes:.1f} MB at {megabytes / self.elapsed:.1f} MB/s"
+        )
+
+
+def _rotate_one(
+    path: str, new_key: bytes, old_keys: list[bytes], in_process: bool
+) -> tuple[RotationResult, dict | None]:
+    # Runs in the worker; results are plain dataclasses so they pickle back,
+    # and a worker process ships its metrics back alongside.
+    try:
+        with _measure("key.rotate") as measurement:
+            measurement.size = os.path.getsize(path)
+            result = RotationResult(path, rotate_file(path, new_key, old_keys), measurement.size)
+    except InvalidToken:
+        result = RotationResult(path, FAILED, error="no given key opens this file, or it is corrupted")
+    except (OSError, ValueError) as exc:
+        result = RotationResult(path, FAILED, error=str(exc) or type(exc).__name__)
+    return result, METRICS.drain() if in_process else None
+
+
+def _rotate_legacy(path: str, token: bytes, new_key: bytes, old_keys: list[bytes]) -> str:
+    new_fernet = _cipher_for(new_key)
+    try:
+        new_fernet.extract_timestamp(token)
+        return CURRENT
+    except InvalidToken:
+        pass
+    rotated = MultiFernet([new_fernet, *(_cipher_for(old_key) for old_key in old_keys)]).rotate(token)
+    with _atomic_output(path) as destination:
+        destination.write(rotated)
+        _finish_in_place(path, destination)
+    return ROTATED
+
+
+def _authenticates(cipher_suite: _ChunkCipher, header: _StreamHeader, token: bytes) -> bool:
+    # A Fernet token's HMAC can be checked without decrypting it.
+    try:
+        if header.cipher == 0:
+            cipher_suite.extract_timestamp(token)
+        else:
+            cipher_suite.decrypt(token)
+    except InvalidToken:
+        return False
+    return True
+
+
+def _rotate_records(
+    source: BinaryIO,
+    destination: BinaryIO,
+    header: _StreamHeader,
+    tokens: Iterator[bytes],
+    old_suite: _ChunkCipher,
+    new_key: bytes,
+) -> None:
+    # Chunk plaintexts (binding prefix and compressed body) are re-sealed
+    # untouched. Token length only depends on plaintext length, so every
+    # offset, and therefore the index, comes out the same.
+    new_suite = _stream_cipher(new_key, header)
+    destination.write(header.raw)
+    position = len(header.raw)
+    offsets = []
+    final = False
+    for index, token in enumerate(tokens):
+        if final:
+            raise ValueError("Unexpected data after the final encrypted chunk.")
+        plain = old_suite.decrypt(token)
+        final = _check_chunk_prefix(plain, header, index)
+        offsets.append(position)
+        written = _write_record(destination, new_suite.encrypt(plain))
+        if written != _RECORD_LENGTH.size + len(token):
+            raise ValueError(f"Encrypted stream chunk {index} changed size while rotating.")
+        position += written
+    if not final:
+        raise ValueError("Encrypted stream is truncated.")
+    if header.version >= 2:
+        index_offsets, total = _read_index_trailer(source, old_suite, header.digest, position)
+        if index_offsets != tuple(offsets):
+            raise ValueError("Encrypted stream index does not match its chunks.")
+        _write_index_trailer(destination, new_suite, header.digest, offsets, total, position)
+    elif source.read(1):
+        raise ValueError("Unexpected data after the final encrypted chunk.")
+
+
+def _finish_in_place(path: str, destination: BinaryIO) -> None:
+    # The original is about to be replaced, so keep its permissions and make
+    # sure the new bytes are on disk before the rename makes them the only copy.
+    os.chmod(destination.name, stat.S_IMODE(os.stat(path).st_mode))
+    destination.flush()
+    os.fsync(destination.fileno())
+
+
+class _Journal:
+    # JSON lines: a header naming the new key's fingerprint, then one entry
+    # per finished file. Each entry is fsync'd before the next file counts.
+
+    def __init__(self, path: str, fingerprint: str) -> None:
+        self.done: set[str] = set()
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        if exists:
+            self._load(path, fingerprint)
+        self._file = open(path, "a", encoding="utf-8")
+        if not exists:
+            self._append({"journal": "shareinfo-rotation", "version": _JOURNAL_VERSION, "new_key": fingerprint})
+
+    def record(self, result: RotationResult) -> None:
+        entry = asdict(result)
+        del entry["error"]
+        self._append(entry)
+        self.done.add(result.path)
+
+    def close(self) -> None:
+        self._file.close()
+
+    def _load(self, path: str, fingerprint: str) -> None:
+        with open(path, encoding="utf-8") as file_handle:
+            lines = file_handle.read().splitlines()
+        try:
+            head = json.loads(lines[0])
+            if head.get("journal") != "shareinfo-rotation" or head.get("version") != _JOURNAL_VERSION:
+                raise ValueError(f"{path} is not a key rotation journal.")
+        except (IndexError, json.JSONDecodeError):
+            raise ValueError(f"{path} is not a key rotation journal.") from None
+        if head.get("new_key") != fingerprint:
+            raise ValueError(f"{path} belongs to a rotation to a different key; use a new journal.")
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Only the last line can be torn, by a crash mid-append; that file is simply redone.
+                continue
+            if entry.get("status") in (ROTATED, CURRENT):
+                self.done.add(entry["path"])
+
+    def _append(self, entry: dict) -> None:
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
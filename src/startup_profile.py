@@ -0,0 +1,73 @@
+"""Start-up profiling for the GUIs (enabled with --profile-startup)."""
+import builtins
+import sys
+import time
+from typing import TextIO
+
+PROFILE_FLAG = "--profile-startup"
+
+
+class StartupProfiler:
+    def __init__(self, enabled: bool) -> None:
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self.imports: list[tuple[str, float, float]] = []
+        self.phases: list[tuple[str, float]] = []
+        self._last_checkpoint = self.started
+        self._stack: list[float] = []
+        self._original_import = builtins.__import__
+        if enabled:
+            builtins.__import__ = self._timed_import
+
+    @classmethod
+    def from_argv(cls, argv: list[str]) -> "StartupProfiler":
+        return cls(PROFILE_FLAG in argv)
+
+    def checkpoint(self, name: str) -> None:
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.phases.append((name, now - self._last_checkpoint))
+        self._last_checkpoint = now
+
+    def report(self, stream: TextIO = sys.stderr, limit: int = 25) -> None:
+        if not self.enabled:
+            return
+        builtins.__import__ = self._original_import
+        total = time.perf_counter() - self.started
+        print(f"Startup profile: {total * 1e3:.1f} ms to first window", file=stream)
+        print("\nPhases:", file=stream)
+        for name, elapsed in self.phases:
+            print(f"  {elapsed * 1e3:9.1f} ms  {name}", file=stream)
+        print(f"\nSlowest imports (self / cumulative, top {limit}):", file=stream)
+        for name, cumulative, own in sorted(self.imports, key=lambda item: item[2], reverse=True)[:limit]:
+            print(f"  {own * 1e3:9.1f} ms  {cumulative * 1e3:9.1f} ms  {name}", file=stream)
+
+    def finish_after_first_frame(self, app) -> None:
+        """Report and quit once the Qt event loop has shown the first window."""
+        if not self.enabled:
+            return
+        from PyQt5.QtCore import QTimer
+
+        def finish() -> None:
+            self.checkpoint("show + first event loop pass")
+            self.report()
+            app.quit()
+
+        QTimer.singleShot(0, finish)
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self._original_import(name, globals, locals, fromlist, level)
+        # Nested imports add their time to the parent's child total so each
+        # module's self time excludes the modules it pulled in.
+        self._stack.append(0.0)
+        begin = time.perf_counter()
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - begin
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            self.imports.append((name, elapsed, elapsed - children))
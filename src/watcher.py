@@ -0,0 +1,402 @@
+"""Watch-folder daemon: encrypt every file dropped into a staging directory.
+
+The scanner polls the input tree with os.scandir. A file counts as finished
+once its size and mtime have not changed for `settle` seconds; files whose
+names start with "." (the usual temp names of rsync, curl and our own
+writers) are ignored until they are renamed. Finished files go onto a
+bounded queue that a fixed set of worker threads drains, either encrypting
+in-thread or handing each file to a process pool. When the queue is full
+the scanner stops queueing and leaves the rest in staging, so a burst
+costs disk space rather than memory, and is picked up as workers free up.
+
+Each output is written to a temp file, fsync'd and renamed into the output
+directory before the original is moved to the processed directory or
+deleted, so a crash at any point leaves either the original or a complete
+encrypted copy. Stopping drains the queue: scanning ends, and everything
+already queued or in flight is finished first.
+"""
+import logging
+import os
+import queue
+import shutil
+import signal
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable
+
+from src.crypto_utils import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_CIPHER,
+    DEFAULT_COMPRESSION_LEVEL,
+    OperationCancelled,
+    _atomic_output,
+    _cancellable,
+    _cipher_for,
+    encrypt_stream,
+)
+from src.metrics import METRICS
+
+DEFAULT_POLL_INTERVAL = 0.5
+DEFAULT_SETTLE_SECONDS = 2.0
+DEFAULT_QUEUE_SIZE = 1024
+
+_STOP = None
+_CANCELLED = "cancelled"
+
+logger = logging.getLogger("shareinfo.watch")
+
+
+@dataclass
+class WatchJob:
+    source: str
+    relative: str
+    signature: tuple[int, int]
+    detected: float
+    queued: float = 0.0
+
+
+class WatchStats:
+    """Running totals, shared by the workers and read for status lines."""
+
+    def __init__(self) -> None:
+        self.encrypted = 0
+        self.failed = 0
+        self.bytes = 0
+        self.queued = 0
+        self.in_flight = 0
+        self.backlog = 0
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def begin(self) -> None:
+        with self._lock:
+            self.in_flight += 1
+
+    def end(self, size: int, failed: bool | None) -> None:
+        # failed is None for a cancelled file, which is neither.
+        with self._lock:
+            self.in_flight -= 1
+            if failed is None:
+                return
+            if failed:
+                self.failed += 1
+            else:
+                self.encrypted += 1
+                self.bytes += size
+
+    @property
+    def elapsed(self) -> float:
+        return max(time.perf_counter() - self.started, 1e-9)
+
+    def line(self) -> str:
+        megabytes = self.bytes / 1_000_000
+        return (
+            f"{self.encrypted} encrypted, {self.failed} failed, {megabytes:.1f} MB "
+            f"({self.encrypted / self.elapsed:.1f} files/s); "
+            f"{self.queued} queued, {self.in_flight} in flight, {self.backlog} waiting in staging"
+        )
+
+
+WatchReport = Callable[[WatchStats], None]
+
+
+class FolderWatcher:
+    """Encrypt files appearing under `input_dir` into `output_dir` until stop() is called.
+
+    Originals are moved under `processed_dir` after a successful encryption,
+    or deleted when it is None. Files that fail are moved under `failed_dir`
+    if given, otherwise left in place and retried only once they change.
+    """
+
+    def __init__(
+        self,
+        input_dir: str,
+        output_dir: str,
+        key: bytes,
+        processed_dir: str | None = None,
+        failed_dir: str | None = None,
+        workers: int | None = None,
+        use_processes: bool = True,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        poll_interval: float = DEFAULT_POLL_INTERVAL,
+        settle: float = DEFAULT_SETTLE_SECONDS,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        compression: str | None = None,
+        level: int = DEFAULT_COMPRESSION_LEVEL,
+        cipher: str = DEFAULT_CIPHER,
+        suffix: str = ".fernet",
+        force: bool = False,
+    ) -> None:
+        _cipher_for(key)
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        if self.workers < 1:
+            raise ValueError("Worker count must be at least 1.")
+        if queue_size < 1:
+            raise ValueError("Queue size must be at least 1.")
+        if poll_interval <= 0 or settle < 0:
+            raise ValueError("The poll interval must be positive and the settle time not negative.")
+        self.input_dir = os.path.abspath(input_dir)
+        if not os.path.isdir(self.input_dir):
+            raise ValueError(f"No such directory: {input_dir}")
+        self.output_dir = os.path.abspath(output_dir)
+        self.processed_dir = os.path.abspath(processed_dir) if processed_dir else None
+        self.failed_dir = os.path.abspath(failed_dir) if failed_dir else None
+        for directory in (self.output_dir, self.processed_dir, self.failed_dir):
+            if directory is not None and _is_within(directory, self.input_dir):
+                raise ValueError(f"{directory} is inside the watched directory; its files would be encrypted again.")
+        self.key = key
+        self.use_processes = use_processes
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.encrypt_options = (chunk_size, compression, level, cipher)
+        self.suffix = suffix
+        self.force = force
+        self.stats = WatchStats()
+
+        self._queue: queue.Queue[WatchJob | None] = queue.Queue(queue_size)
+        # _seen and _failed belong to the scanner. Workers hand files back
+        # through _claimed and _new_failures, under _claimed_lock.
+        self._seen: dict[str, tuple[tuple[int, int], float]] = {}
+        self._failed: dict[str, tuple[int, int]] = {}
+        self._claimed: set[str] = set()
+        self._new_failures: dict[str, tuple[int, int]] = {}
+        self._claimed_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._abort = threading.Event()
+
+    def stop(self, drain: bool = True) -> None:
+        """Stop scanning. With drain=False, queued files are also left in staging and in-thread work is cancelled."""
+        if not drain:
+            self._abort.set()
+        self._stopping.set()
+
+    def run(self, report: WatchReport | None = None, report_interval: float = 10.0) -> WatchStats:
+        """Scan and encrypt until stop(); returns once every queued and in-flight file is finished."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        pooled = self.use_processes and self.workers > 1
+        executor = ProcessPoolExecutor(self.workers, initializer=_init_worker) if pooled else None
+        threads = [
+            threading.Thread(target=self._work, args=(executor,), name=f"watch-worker-{number}", daemon=True)
+            for number in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        last_report = time.monotonic()
+        try:
+            while not self._stopping.is_set():
+                self._scan()
+                self._publish()
+                now = time.monotonic()
+                if report is not None and now - last_report >= report_interval:
+                    last_report = now
+                    report(self.stats)
+                self._stopping.wait(self.poll_interval)
+        finally:
+            # Workers finish whatever is queued ahead of the stop markers.
+            for _ in threads:
+                self._queue.put(_STOP)
+            for thread in threads:
+                thread.join()
+            if executor is not None:
+                executor.shutdown()
+            self.stats.backlog = 0
+            self._publish()
+        if report is not None:
+            report(self.stats)
+        return self.stats
+
+    def _scan(self) -> None:
+        started = time.perf_counter()
+        now = time.monotonic()
+        wall_now = time.time()
+        seen = {}
+        failed = {}
+        stable = []
+        with self._claimed_lock:
+            claimed = set(self._claimed)
+            self._failed.update(self._new_failures)
+            self._new_failures.clear()
+        for path, relative, stat_result in _walk(self.input_dir):
+            if path in claimed:
+                continue
+            signature = (stat_result.st_size, stat_result.st_mtime_ns)
+            if self._failed.get(path) == signature:
+                failed[path] = signature
+                continue
+            previous = self._seen.get(path)
+            since = previous[1] if previous is not None and previous[0] == signature else now
+            seen[path] = (signature, since)
+            # Finished when nothing has changed it for `settle` seconds, judged by
+            # its mtime (so files renamed in whole go straight away) or by what
+            # this watcher has seen itself (in case the clocks disagree).
+            if wall_now - stat_result.st_mtime_ns / 1e9 >= self.settle or now - since >= self.settle:
+                stable.append(WatchJob(path, relative, signature, previous[1] if previous else now))
+        self._seen = seen
+        self._failed = failed
+
+        backlog = 0
+        for job in sorted(stable, key=lambda job: job.detected):
+            if self._abort.is_set() or self._queue.full():
+                backlog += 1
+                continue
+            job.queued = time.monotonic()
+            with self._claimed_lock:
+                self._claimed.add(job.source)
+            del self._seen[job.source]
+            self._queue.put_nowait(job)
+        self.stats.backlog = backlog
+        METRICS.observe("watch.scan", time.perf_counter() - started, outcome="backpressure" if backlog else "ok")
+
+    def _publish(self) -> None:
+        stats = self.stats
+        stats.queued = self._queue.qsize()
+        METRICS.set_gauge("watch.queue_depth", stats.queued)
+        METRICS.set_gauge("watch.in_flight", stats.in_flight)
+        METRICS.set_gauge("watch.backlog", stats.backlog)
+
+    def _work(self, executor: Executor | None) -> None:
+        while True:
+            job = self._queue.get()
+            if job is _STOP:
+                return
+            failed = False
+            try:
+                if not self._abort.is_set():
+                    failed = self._handle(job, executor)
+            finally:
+                with self._claimed_lock:
+                    self._claimed.discard(job.source)
+                    if failed:
+                        self._new_failures[job.source] = job.signature
+
+    def _handle(self, job: WatchJob, executor: Executor | None) -> bool:
+        # Returns True if the file failed and stays in staging until it changes.
+        METRICS.observe("watch.wait", time.monotonic() - job.queued)
+        destination = os.path.join(self.output_dir, job.relative + self.suffix)
+        self.stats.begin()
+        if executor is None:
+            size, error, _ = _encrypt_one(
+                job.source, destination, self.key, self.encrypt_options, self.force, self._abort, False
+            )
+        else:
+            try:
+                size, error, snapshot = executor.submit(
+                    _encrypt_one, job.source, destination, self.key, self.encrypt_options, self.force, None, True
+                ).result()
+                METRICS.merge(snapshot)
+            except Exception as exc:  # A broken pool must not take the worker thread down with it.
+                size, error = 0, str(exc) or type(exc).__name__
+        stays = False
+        if error is None:
+            error = self._move_original(job, self.processed_dir, delete=True)
+            # Retrying would only find its output already there.
+            stays = error is not None
+        elif error != _CANCELLED:
+            stays = self.failed_dir is None or self._move_original(job, self.failed_dir, delete=False) is not None
+        outcome = "ok" if error is None else error if error == _CANCELLED else "error"
+        self.stats.end(size, None if outcome == _CANCELLED else outcome == "error")
+        METRICS.observe("watch.latency", time.monotonic() - job.detected, size, outcome)
+        if outcome == "error":
+            logger.warning("failed: %s: %s", job.source, error)
+        return stays
+
+    def _move_original(self, job: WatchJob, directory: str | None, delete: bool) -> str | None:
+        # Moves the original under `directory` (mirroring its place in staging)
+        # or, with no directory, deletes it if `delete`; returns an error message.
+        try:
+            if directory is not None:
+                target = os.path.join(directory, job.relative)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.move(job.source, target)
+            elif delete:
+                os.unlink(job.source)
+        except OSError as exc:
+            return f"encrypted, but the original could not be moved away: {exc}" if delete else str(exc)
+        return None
+
+
+def _encrypt_one(
+    source: str,
+    destination: str,
+    key: bytes,
+    options: tuple[int, str | None, int, str],
+    force: bool,
+    cancel: threading.Event | None,
+    in_process: bool,
+) -> tuple[int, str | None, dict | None]:
+    # Runs in a worker thread or process; returns (bytes, error, metrics).
+    chunk_size, compression, level, cipher = options
+    try:
+        if os.path.exists(destination) and not force:
+            raise ValueError("output exists (use --force to overwrite)")
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with (
+            open(source, "rb") as raw_source,
+            _atomic_output(destination) as raw_destination,
+            METRICS.timed_io(raw_source) as plain,
+            METRICS.timed_io(raw_destination) as sealed,
+        ):
+            size = encrypt_stream(
+                plain, sealed, key, chunk_size, _cancellable(None, cancel), compression, level, cipher
+            )
+            # The original is deleted or moved once this returns, so the copy must be on disk first.
+            raw_destination.flush()
+            os.fsync(raw_destination.fileno())
+        _fsync_directory(os.path.dirname(destination))
+        result = (size, None)
+    except OperationCancelled:
+        result = (0, _CANCELLED)
+    except (OSError, ValueError) as exc:
+        result = (0, str(exc) or type(exc).__name__)
+    return (*result, METRICS.drain() if in_process else None)
+
+
+def _init_worker() -> None:
+    # Ctrl-C and service managers signal the whole process group; only the
+    # parent decides when to stop, after the workers have drained.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    METRICS.reset()
+
+
+def _walk(root: str):
+    # Yields (path, path relative to root, stat) for regular files, skipping dot names.
+    directories = [root]
+    while directories:
+        directory = directories.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry.path, os.path.relpath(entry.path, root), entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+
+
+def _fsync_directory(directory: str) -> None:
+    # Makes the rename itself durable (POSIX; a no-op where directories cannot be opened).
+    try:
+        descriptor = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
+
+
+def _is_within(path: str, root: str) -> bool:
+    path, root = os.path.realpath(path), os.path.realpath(root)
+    return os.path.commonpath([path, root]) == root
+